@@ -1,131 +1,185 @@
 import argparse
-import datetime
 import json
-import os.path
-import atexit
-from collections import defaultdict
+import os
 
+import pandas as pd
 from ebi_eva_common_pyutils.logger import logging_config
 from ebi_eva_common_pyutils.metadata_utils import get_metadata_connection_handle
-from ebi_eva_common_pyutils.ncbi_utils import get_ncbi_assembly_dicts_from_term, get_ncbi_taxonomy_dicts_from_ids
 from ebi_eva_common_pyutils.pg_utils import get_all_results_for_query
 
-cached_dict = {}
-cached_file = 'cached_data.json'
-if os.path.exists(cached_file):
-    with open(cached_file) as open_file:
-        cached_dict = json.load(open_file)
-if 'assembly_dicts' not in cached_dict: cached_dict['assembly_dicts'] = {}
-if 'taxonomy_dicts' not in cached_dict: cached_dict['taxonomy_dicts'] = {}
-
-def exit_handler():
-    with open(cached_file, 'w') as open_file:
-        json.dump(cached_dict, open_file)
-
-
-atexit.register(exit_handler)
-
-
+from tasks.eva_3091.metadata_client import MetadataClient
 
 logging_config.add_stdout_handler()
 logger = logging_config.get_logger(__name__)
 
-def cached_get_key_from(assembly, key):
-    if assembly not in cached_dict['assembly_dicts']:
-        cached_dict['assembly_dicts'][assembly] = get_ncbi_assembly_dicts_from_term(assembly)
-    assembly_dicts = cached_dict['assembly_dicts'][assembly]
+report_columns = [
+    'taxonomy', 'scientific_name', 'assembly', 'assembly_name', 'assembly_taxonomy', 'assembly_scientific_name',
+    'other_assembly', 'other_assembly_name', 'assembly_clustering_dates', 'other_assembly_clustering_dates'
+]
+
+
+def get_tracker_tables(pg_conn):
+    """Returns the supported assemblies, the full species clustering and the new studies clustering as frames."""
+    supported_assemblies = pd.DataFrame(
+        get_all_results_for_query(pg_conn, 'select taxonomy_id, assembly_id, current '
+                                           'from evapro.supported_assembly_tracker;'),
+        columns=['taxonomy', 'assembly', 'current']
+    )
+    # Assemblies where clustering for whole species was performed
+    full_clustering = pd.DataFrame(
+        get_all_results_for_query(pg_conn, 'select taxonomy, assembly_accession, clustering_start '
+                                           'from eva_progress_tracker.clustering_release_tracker '
+                                           'where should_be_clustered=true;'),
+        columns=['taxonomy', 'assembly', 'clustering_date']
+    )
+    # Assemblies where clustering for new studies was performed
+    study_clustering = pd.DataFrame(
+        get_all_results_for_query(pg_conn, 'select taxonomy, assembly_accession, remapping_start '
+                                           'from eva_progress_tracker.remapping_tracker '
+                                           'where study_accessions is not null;'),
+        columns=['taxonomy', 'assembly', 'clustering_date']
+    )
+    return supported_assemblies, full_clustering, study_clustering
+
+
+def resolve_assembly_key(assembly, assembly_dicts, key):
     values = set([d.get(key) for d in assembly_dicts])
     if len(values) > 1:
         # Only keep the one that have the assembly accession as a synonymous and check again
-        values = set([d.get('key') for d in assembly_dicts
-                      if assembly in d['synonym'].values() or assembly == d['assemblyaccession']])
+        values = set([d.get(key) for d in assembly_dicts
+                      if assembly in d.get('synonym', {}).values() or assembly == d.get('assemblyaccession')])
     if len(values) != 1:
         raise ValueError(f"Cannot resolve assembly's {key} for assembly {assembly} in NCBI. "
                          f'Found {",".join([str(a) for a in values])}')
     return values.pop()
 
 
-def cached_get_taxonomy_from(assembly):
-    return int(cached_get_key_from(assembly, 'taxid'))
-
-
-def cached_get_assembly_name_from(assembly):
-    return cached_get_key_from(assembly, 'assemblyname')
-
-
-def cached_get_scientific_name(taxid):
-    if taxid not in cached_dict['taxonomy_dicts']:
-        cached_dict['taxonomy_dicts'][taxid] = get_ncbi_taxonomy_dicts_from_ids([str(taxid)])
-    taxonomy_dicts = cached_dict['taxonomy_dicts'][taxid]
-    scientific_names = set([d.get('scientificname') for d in taxonomy_dicts])
-    if len(scientific_names) != 1:
-        raise ValueError(f"Cannot resolve taxonomy's name for taxonomy_id {taxid} in NCBI. "
-                         f'Found {",".join([str(a) for a in scientific_names])}')
-    return scientific_names.pop()
-
-
-def detect_species_with_cross_species_target(maven_config, maven_profile):
+def get_assembly_table(metadata_client, assemblies):
+    """
+    Returns the taxonomy and name of each assembly in NCBI. All the assembly summaries are retrieved in batched
+    esummary calls. Assemblies that cannot be resolved are reported and left out.
+    """
+    assemblies = list(dict.fromkeys(assemblies))
+    id_lists = metadata_client.esearch('Assembly', [f'"{assembly}"' for assembly in assemblies])
+    summaries = metadata_client.esummary('Assembly', [uid for id_list in id_lists.values() for uid in id_list])
+    rows = []
+    for assembly in assemblies:
+        assembly_dicts = [summaries[uid] for uid in id_lists[f'"{assembly}"'] if summaries.get(uid)]
+        try:
+            rows.append((assembly, int(resolve_assembly_key(assembly, assembly_dicts, 'taxid')),
+                         resolve_assembly_key(assembly, assembly_dicts, 'assemblyname')))
+        except ValueError as e:
+            logger.error(str(e))
+    return pd.DataFrame(rows, columns=['assembly', 'assembly_taxonomy', 'assembly_name'])
+
+
+def get_taxonomy_table(metadata_client, taxonomies):
+    """Returns the scientific name of each taxonomy, retrieved in batched esummary calls."""
+    rows = []
+    for taxonomy, (rank, scientific_name) in metadata_client.species_for_taxonomies(list(set(taxonomies))).items():
+        if not scientific_name:
+            logger.error(f"Cannot resolve taxonomy's name for taxonomy_id {taxonomy} in NCBI.")
+        rows.append((taxonomy, scientific_name))
+    return pd.DataFrame(rows, columns=['taxonomy', 'scientific_name'])
+
+
+def format_dates(dates):
+    return ','.join(['Unknown' if pd.isna(d) else d.date().isoformat() for d in dates])
+
+
+def get_clustering_dates(full_clustering, study_clustering):
+    """
+    Returns the clustering dates of each taxonomy and assembly. The whole species clustering applies to the assembly
+    whatever the taxonomy, and the new studies clustering only to the taxonomy it was done for.
+    """
+    full_dates = full_clustering.groupby('assembly', sort=False)['clustering_date'].apply(list).rename('full_dates')
+    study_dates = study_clustering.groupby(['taxonomy', 'assembly'], sort=False)['clustering_date'] \
+        .apply(list).rename('study_dates')
+    return full_dates.reset_index(), study_dates.reset_index()
+
+
+def add_clustering_dates(frame, taxonomy_column, assembly_column, full_dates, study_dates, output_column):
+    """Keep the rows of the frame where clustering was performed and add the clustering dates to them."""
+    frame = frame.merge(full_dates.rename(columns={'assembly': assembly_column}), how='left', on=assembly_column)
+    frame = frame.merge(study_dates.rename(columns={'taxonomy': taxonomy_column, 'assembly': assembly_column}),
+                        how='left', on=[taxonomy_column, assembly_column])
+    frame = frame[frame['full_dates'].notna() | frame['study_dates'].notna()].copy()
+    frame[output_column] = [
+        format_dates((full if isinstance(full, list) else []) + (study if isinstance(study, list) else []))
+        for full, study in zip(frame['full_dates'], frame['study_dates'])
+    ]
+    return frame.drop(columns=['full_dates', 'study_dates'])
+
+
+def detect_cross_species_targets(supported_assemblies, assembly_table, full_clustering, study_clustering):
+    """
+    Find the taxonomies with a current target whose supported assemblies come from another taxonomy that has its own,
+    different, current target, when clustering was performed on both assemblies.
+    Returns one row per taxonomy and assembly with the other taxonomy's current target and the clustering dates.
+    """
+    current_assemblies = supported_assemblies[supported_assemblies['current'].astype(bool)] \
+        .drop_duplicates('taxonomy', keep='last')[['taxonomy', 'assembly']]
+    candidates = supported_assemblies[supported_assemblies['taxonomy'].isin(current_assemblies['taxonomy'])]
+    candidates = candidates[['taxonomy', 'assembly']].merge(assembly_table[['assembly', 'assembly_taxonomy']],
+                                                            on='assembly')
+    # No difference between the taxonomy and the assembly
+    candidates = candidates[candidates['taxonomy'] != candidates['assembly_taxonomy']]
+    # The target's taxonomy needs to have a current target itself, different from this assembly
+    candidates = candidates.merge(
+        current_assemblies.rename(columns={'taxonomy': 'assembly_taxonomy', 'assembly': 'other_assembly'}),
+        on='assembly_taxonomy'
+    )
+    candidates = candidates[candidates['assembly'] != candidates['other_assembly']]
+
+    # Clustering needs to have been performed on both assemblies
+    full_dates, study_dates = get_clustering_dates(full_clustering, study_clustering)
+    candidates = add_clustering_dates(candidates, 'taxonomy', 'assembly', full_dates, study_dates,
+                                      'assembly_clustering_dates')
+    candidates = add_clustering_dates(candidates, 'assembly_taxonomy', 'other_assembly', full_dates, study_dates,
+                                      'other_assembly_clustering_dates')
+    return candidates.reset_index(drop=True)
+
+
+def add_names(cross_species_targets, assembly_table, taxonomy_table):
+    assembly_names = assembly_table.set_index('assembly')['assembly_name']
+    scientific_names = taxonomy_table.set_index('taxonomy')['scientific_name']
+    report = cross_species_targets.copy()
+    report['assembly_name'] = report['assembly'].map(assembly_names)
+    report['other_assembly_name'] = report['other_assembly'].map(assembly_names)
+    report['scientific_name'] = report['taxonomy'].map(scientific_names)
+    report['assembly_scientific_name'] = report['assembly_taxonomy'].map(scientific_names)
+    return report[report_columns]
+
+
+def write_report(report, output_tsv=None, output_json=None):
+    if output_tsv:
+        report.to_csv(output_tsv, sep='\t', index=False)
+    if output_json:
+        with open(output_json, 'w') as open_file:
+            json.dump(json.loads(report.to_json(orient='records')), open_file, indent=2)
+
+
+def detect_species_with_cross_species_target(maven_config, maven_profile, cache_file, output_tsv=None,
+                                             output_json=None, api_key=None, num_workers=4):
     with get_metadata_connection_handle(maven_profile, maven_config) as pg_conn:
-        query = f"select taxonomy_id,assembly_id, current from evapro.supported_assembly_tracker;"
-        taxonomy_to_assemblies = defaultdict(list)
-        taxonomy_to_current_assembly = {}
-
-        for taxonomy, assembly, current in get_all_results_for_query(pg_conn, query):
-            taxonomy_to_assemblies[taxonomy].append(assembly)
-            if current:
-                taxonomy_to_current_assembly[taxonomy] = assembly
-        assemblies_to_full_clustering_dates = defaultdict(list)
-        assemblies_to_species_clustering_dates = defaultdict(list)
-
-        # Get the assemblies where clustering for whole species was performed
-        query = 'select taxonomy, assembly_accession, clustering_start from eva_progress_tracker.clustering_release_tracker where should_be_clustered=true;'
-        for taxonomy, assembly, clustering_start in get_all_results_for_query(pg_conn, query):
-            assemblies_to_full_clustering_dates[assembly].append(clustering_start)
-
-        # Get the assemblies where clustering for new studies was performed
-        query = 'select taxonomy, assembly_accession, remapping_start, study_accessions from eva_progress_tracker.remapping_tracker where study_accessions is not null;'
-        for taxonomy, assembly, remapping_start, study_accessions in get_all_results_for_query(pg_conn, query):
-            assemblies_to_species_clustering_dates[(taxonomy, assembly)].append(remapping_start)
-
-    for taxonomy in taxonomy_to_current_assembly:
-        for assembly in taxonomy_to_assemblies[taxonomy]:
-            taxonomy_from_assembly = cached_get_taxonomy_from(assembly)
-            # No difference between the taxonomy and the assembly
-            if taxonomy == taxonomy_from_assembly:
-                continue
-            # taxonomy are different but the target assembly is the same as the current one for this
-            if assembly == taxonomy_to_current_assembly.get(taxonomy_from_assembly):
-                # logger.info(f'For {taxonomy} target is {taxonomy_to_assembly[taxonomy]} which comes from {taxonomy_from_assembly} with same target {taxonomy_to_assembly.get(taxonomy_from_assembly)}')
-                continue
-            # taxonomy are different and assembly is different from the current target
-            # but the target's taxonomy has itself no remapping target
-            if taxonomy_to_current_assembly.get(taxonomy_from_assembly) is None:
-                # logger.info(f'For {taxonomy} target is {taxonomy_to_assembly[taxonomy]} which comes from {taxonomy_from_assembly} with same target {taxonomy_to_assembly.get(taxonomy_from_assembly)}')
-                continue
-
-            # Check that if a clustering was ever performed on this assembly
-            if assembly not in assemblies_to_full_clustering_dates and \
-                    (taxonomy, assembly) not in assemblies_to_species_clustering_dates:
-                continue
-            dates_for_orig_assembly = ','.join([d.date().isoformat() if d else 'Unknown' for d in assemblies_to_full_clustering_dates.get(assembly, [])])
-            dates_for_orig_assembly += ','.join([d.date().isoformat() if d else 'Unknown' for d in assemblies_to_species_clustering_dates.get((taxonomy, assembly), [])])
-
-            # Check that if a clustering was ever performed on the other assembly
-            if taxonomy_to_current_assembly.get(taxonomy_from_assembly) not in assemblies_to_full_clustering_dates and \
-                (taxonomy_from_assembly, taxonomy_to_current_assembly.get(taxonomy_from_assembly)) not in assemblies_to_species_clustering_dates:
-                continue
-            dates_for_other_assembly = ','.join([d.date().isoformat() if d else 'Unknown' for d in assemblies_to_full_clustering_dates.get(taxonomy_to_current_assembly.get(taxonomy_from_assembly), [])])
-            dates_for_other_assembly += ','.join([d.date().isoformat() if d else 'Unknown' for d in assemblies_to_species_clustering_dates.get((taxonomy_from_assembly, taxonomy_to_current_assembly.get(taxonomy_from_assembly)), [])])
-
-            species_name = cached_get_scientific_name(taxonomy)
-            species_name_from_assembly = cached_get_scientific_name(taxonomy_from_assembly)
-            logger.warning(f'For {taxonomy} ({species_name}) and target {assembly} '
-                           f'({cached_get_assembly_name_from(assembly)}), the assembly comes from '
-                           f'{taxonomy_from_assembly} ({species_name_from_assembly}) and its current is target '
-                           f'{taxonomy_to_current_assembly.get(taxonomy_from_assembly)} '
-                           f'({cached_get_assembly_name_from(taxonomy_to_current_assembly.get(taxonomy_from_assembly))}). '
-                           f'Clustering on original assembly happened  {dates_for_orig_assembly}. '
-                           f'Clustering on other assembly happened  {dates_for_other_assembly}')
+        supported_assemblies, full_clustering, study_clustering = get_tracker_tables(pg_conn)
+
+    metadata_client = MetadataClient(cache_file, api_key=api_key, num_workers=num_workers)
+    try:
+        assembly_table = get_assembly_table(metadata_client, supported_assemblies['assembly'])
+        cross_species_targets = detect_cross_species_targets(supported_assemblies, assembly_table, full_clustering,
+                                                             study_clustering)
+        taxonomy_table = get_taxonomy_table(
+            metadata_client,
+            set(cross_species_targets['taxonomy']) | set(cross_species_targets['assembly_taxonomy'])
+        )
+    finally:
+        metadata_client.close()
+    report = add_names(cross_species_targets, assembly_table, taxonomy_table)
+    write_report(report, output_tsv, output_json)
+    logger.info(f'Found {len(report)} assemblies targeted from a different taxonomy '
+                f'in {report["taxonomy"].nunique()} taxonomies')
+    return report
 
 
 if __name__ == '__main__':
@@ -133,6 +187,15 @@ if __name__ == '__main__':
     parser.add_argument("--maven_config", help="ex: /path/to/eva-maven-settings.xml", required=True)
     parser.add_argument("--maven_profile", choices=('localhost', 'development', 'production_processing'),
                         help="Profile to decide which environment should be used for making entries", required=True)
+    parser.add_argument("--output_tsv", help="Path to the TSV report", default='cross_species_targets.tsv')
+    parser.add_argument("--output_json", help="Path to an optional JSON report")
+    parser.add_argument("--cache_file", help="SQLite file where the NCBI responses are cached",
+                        default='cached_data.sqlite')
+    parser.add_argument("--ncbi_api_key", help="NCBI API key allowing a higher request rate",
+                        default=os.environ.get('NCBI_API_KEY'))
+    parser.add_argument("--num_workers", help="Number of concurrent requests to NCBI", type=int, default=4)
 
     args = parser.parse_args()
-    detect_species_with_cross_species_target(args.maven_config, args.maven_profile)
+    detect_species_with_cross_species_target(args.maven_config, args.maven_profile, args.cache_file,
+                                             output_tsv=args.output_tsv, output_json=args.output_json,
+                                             api_key=args.ncbi_api_key, num_workers=args.num_workers)
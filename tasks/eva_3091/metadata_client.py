@@ -0,0 +1,197 @@
+import json
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from ebi_eva_common_pyutils.logger import logging_config
+
+logger = logging_config.get_logger(__name__)
+
+eutils_url = 'https://eutils.ncbi.nlm.nih.gov/entrez/eutils/'
+
+# Time to live in seconds of the cached responses for each endpoint
+default_ttls = {
+    'esearch': 7 * 24 * 3600,
+    'esummary_assembly': 30 * 24 * 3600,
+    'esummary_taxonomy': 90 * 24 * 3600,
+}
+retried_status_codes = {429, 500, 502, 503, 504}
+
+
+class RateLimiter:
+    """Spread the calls made from all threads so that no more than max_rate start in any second."""
+
+    def __init__(self, max_rate):
+        self.interval = 1.0 / max_rate
+        self.next_call = 0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            wait_time = self.next_call - now
+            self.next_call = max(now, self.next_call) + self.interval
+        if wait_time > 0:
+            time.sleep(wait_time)
+
+
+class MetadataCache:
+    """
+    SQLite store of the remote responses keyed by endpoint and query. Each response is committed as soon as it is
+    received so that an interrupted run keeps all the lookups it made. Expired entries are ignored and overwritten.
+    """
+
+    def __init__(self, sqlite_file, ttls=None):
+        self.ttls = dict(default_ttls, **(ttls or {}))
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(sqlite_file, check_same_thread=False)
+        self.connection.execute('pragma journal_mode=wal')
+        self.connection.execute(
+            'create table if not exists response (endpoint text, key text, value text, fetched_at real, '
+            'primary key (endpoint, key))'
+        )
+        self.connection.commit()
+
+    def get_many(self, endpoint, keys):
+        # Returns the values of the keys present in the cache and not expired
+        min_fetched_at = time.time() - self.ttls[endpoint]
+        found = {}
+        keys = list(keys)
+        with self.lock:
+            for i in range(0, len(keys), 500):
+                chunk = keys[i:i + 500]
+                rows = self.connection.execute(
+                    f'select key, value from response where endpoint = ? and fetched_at >= ? '
+                    f'and key in ({",".join("?" * len(chunk))})',
+                    [endpoint, min_fetched_at] + chunk
+                )
+                found.update((key, json.loads(value)) for key, value in rows)
+        return found
+
+    def get(self, endpoint, key, default=None):
+        return self.get_many(endpoint, [key]).get(key, default)
+
+    def put_many(self, endpoint, values):
+        fetched_at = time.time()
+        with self.lock, self.connection:
+            self.connection.executemany(
+                'insert or replace into response values (?, ?, ?, ?)',
+                [(endpoint, key, json.dumps(value), fetched_at) for key, value in values.items()]
+            )
+
+    def put(self, endpoint, key, value):
+        self.put_many(endpoint, {key: value})
+
+    def close(self):
+        self.connection.close()
+
+
+class MetadataClient:
+    """
+    Client for the NCBI E-utilities lookups of the assemblies and taxonomies.
+    Requests are run concurrently from a thread pool while staying within NCBI's limits (3 requests per second, or 10
+    with an API key), ids are grouped into single esummary calls, and 429 and 5xx responses are retried with an
+    exponential backoff. All responses go through the SQLite cache.
+    """
+
+    def __init__(self, cache_file, api_key=None, num_workers=4, esummary_batch_size=200, max_retries=5,
+                 backoff_factor=1, ttls=None, eutils_base_url=eutils_url):
+        self.cache = MetadataCache(cache_file, ttls)
+        self.api_key = api_key
+        self.num_workers = num_workers
+        self.esummary_batch_size = esummary_batch_size
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.eutils_base_url = eutils_base_url
+        self.ncbi_rate_limiter = RateLimiter(10 if api_key else 3)
+        self.session = requests.Session()
+        self.session.mount('http://', requests.adapters.HTTPAdapter(pool_maxsize=num_workers))
+        self.session.mount('https://', requests.adapters.HTTPAdapter(pool_maxsize=num_workers))
+
+    def close(self):
+        self.session.close()
+        self.cache.close()
+
+    def _get_json(self, url, params, rate_limiter):
+        for attempt in range(self.max_retries + 1):
+            rate_limiter.wait()
+            try:
+                response = self.session.get(url, params=params, timeout=60)
+            except requests.ConnectionError as e:
+                if attempt == self.max_retries:
+                    raise
+                delay = self.backoff_factor * 2 ** attempt
+                logger.warning(f'Connection error for {url} ({e}): retrying in {delay}s')
+            else:
+                if response.status_code not in retried_status_codes:
+                    return response.json()
+                if attempt == self.max_retries:
+                    response.raise_for_status()
+                delay = self.backoff_factor * 2 ** attempt
+                if response.headers.get('Retry-After', '').isdigit():
+                    delay = max(delay, int(response.headers['Retry-After']))
+                logger.warning(f'Got {response.status_code} from {url}: retrying in {delay}s')
+            time.sleep(delay)
+
+    def _eutils_get_json(self, utility, params):
+        params = dict(params, retmode='JSON')
+        if self.api_key:
+            params['api_key'] = self.api_key
+        return self._get_json(self.eutils_base_url + utility + '.fcgi', params, self.ncbi_rate_limiter)
+
+    def _map(self, function, items):
+        with ThreadPoolExecutor(max_workers=self.num_workers) as executor:
+            return list(executor.map(function, items))
+
+    def _esearch(self, db, term):
+        """Search for all ids matching the term by depaginating the results of the search query"""
+        payload = {'db': db, 'term': term, 'retmax': 1000}
+        search_results = self._eutils_get_json('esearch', payload).get('esearchresult', {})
+        id_list = search_results.get('idlist', [])
+        while int(search_results.get('retstart')) + int(search_results.get('retmax')) < int(search_results.get('count')):
+            payload['retstart'] = int(search_results.get('retstart')) + int(search_results.get('retmax'))
+            search_results = self._eutils_get_json('esearch', payload).get('esearchresult', {})
+            id_list += search_results.get('idlist', [])
+        self.cache.put('esearch', f'{db}:{term}', id_list)
+        return id_list
+
+    def esearch(self, db, terms):
+        """Returns the list of ids found for each term, searching concurrently for the terms not in the cache."""
+        cached = self.cache.get_many('esearch', [f'{db}:{term}' for term in terms])
+        missing_terms = [term for term in terms if f'{db}:{term}' not in cached]
+        id_lists = dict(zip(missing_terms, self._map(lambda term: self._esearch(db, term), missing_terms)))
+        return {term: cached.get(f'{db}:{term}', id_lists.get(term)) for term in terms}
+
+    def _esummary_batch(self, db, ids):
+        summary_list = self._eutils_get_json('esummary', {'db': db, 'id': ','.join(ids)}).get('result', {})
+        summaries = {uid: summary_list.get(uid) for uid in summary_list.get('uids', [])}
+        # Ids without summary are cached as well to avoid asking for them again
+        self.cache.put_many(f'esummary_{db.lower()}', {uid: summaries.get(uid) for uid in ids})
+        return summaries
+
+    def esummary(self, db, ids):
+        """Returns the summary of each id, grouping the ids not in the cache into batched esummary calls."""
+        ids = list(dict.fromkeys(str(uid) for uid in ids))
+        summaries = self.cache.get_many(f'esummary_{db.lower()}', ids)
+        missing_ids = [uid for uid in ids if uid not in summaries]
+        batches = [missing_ids[i:i + self.esummary_batch_size]
+                   for i in range(0, len(missing_ids), self.esummary_batch_size)]
+        if batches:
+            logger.info(f'Query NCBI {db} summaries for {len(missing_ids)} ids in {len(batches)} batches')
+        for batch_summaries in self._map(lambda batch: self._esummary_batch(db, batch), batches):
+            summaries.update(batch_summaries)
+        return summaries
+
+    def species_for_taxonomies(self, taxids):
+        """Returns the (rank, scientific name) of each taxonomy id, or (None, None) when it does not exist."""
+        summaries = self.esummary('Taxonomy', taxids)
+        species = {}
+        for taxid in taxids:
+            summary = summaries.get(str(taxid))
+            if summary and summary.get('scientificname'):
+                species[taxid] = (summary.get('rank'), summary.get('scientificname'))
+            else:
+                species[taxid] = (None, None)
+        return species
@@ -0,0 +1,51 @@
+import datetime
+
+import pandas as pd
+
+from tasks.eva_3091.detect_cross_species_remapping import detect_cross_species_targets, resolve_assembly_key, \
+    add_names
+
+
+def test_resolve_assembly_key():
+    assembly_dicts = [
+        {'assemblyaccession': 'GCA_000000001.1', 'synonym': {'genbank': 'GCA_000000001.1'}, 'taxid': '9913'},
+        {'assemblyaccession': 'GCF_000000001.1', 'synonym': {'genbank': 'GCA_000000002.1'}, 'taxid': '9915'}
+    ]
+    assert resolve_assembly_key('GCA_000000001.1', assembly_dicts, 'taxid') == '9913'
+
+
+def test_detect_cross_species_targets():
+    supported_assemblies = pd.DataFrame([
+        # 1 targets an assembly from 2 which has its own, different, target
+        (1, 'GCA_1', False), (1, 'GCA_2', True),
+        (2, 'GCA_2', False), (2, 'GCA_3', True),
+        # 4 targets an assembly from 5 which has the same target
+        (4, 'GCA_5', True), (5, 'GCA_5', True),
+        # 6 targets an assembly from 7 which has no target
+        (6, 'GCA_7', True),
+    ], columns=['taxonomy', 'assembly', 'current'])
+    assembly_table = pd.DataFrame([
+        ('GCA_1', 1, 'asm1'), ('GCA_2', 2, 'asm2'), ('GCA_3', 2, 'asm3'), ('GCA_5', 5, 'asm5'), ('GCA_7', 7, 'asm7')
+    ], columns=['assembly', 'assembly_taxonomy', 'assembly_name'])
+    full_clustering = pd.DataFrame([
+        (1, 'GCA_2', datetime.datetime(2022, 1, 1)), (2, 'GCA_3', None)
+    ], columns=['taxonomy', 'assembly', 'clustering_date'])
+    study_clustering = pd.DataFrame([
+        (1, 'GCA_2', datetime.datetime(2023, 2, 1)), (2, 'GCA_2', datetime.datetime(2023, 3, 1))
+    ], columns=['taxonomy', 'assembly', 'clustering_date'])
+
+    targets = detect_cross_species_targets(supported_assemblies, assembly_table, full_clustering, study_clustering)
+    assert targets.to_dict('records') == [{
+        'taxonomy': 1, 'assembly': 'GCA_2', 'assembly_taxonomy': 2, 'other_assembly': 'GCA_3',
+        'assembly_clustering_dates': '2022-01-01,2023-02-01', 'other_assembly_clustering_dates': 'Unknown'
+    }]
+
+    taxonomy_table = pd.DataFrame([(1, 'Species one'), (2, 'Species two')], columns=['taxonomy', 'scientific_name'])
+    report = add_names(targets, assembly_table, taxonomy_table)
+    assert report.iloc[0][['scientific_name', 'assembly_name', 'assembly_scientific_name', 'other_assembly_name']] \
+        .tolist() == ['Species one', 'asm2', 'Species two', 'asm3']
+
+    # Nothing is reported when one of the assemblies was never clustered
+    targets = detect_cross_species_targets(supported_assemblies, assembly_table, full_clustering.iloc[:1],
+                                           study_clustering.iloc[:0])
+    assert targets.empty
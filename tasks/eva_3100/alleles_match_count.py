@@ -1,8 +1,9 @@
 import argparse
 import os.path
 import traceback
-from collections import defaultdict
-from itertools import islice
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice, chain
 
 import pymongo
 from ebi_eva_common_pyutils.logger import logging_config
@@ -16,6 +17,9 @@ SUBMITTED_VARIANT_ENTITY = "submittedVariantEntity"
 DBSNP_SUBMITTED_VARIANT_ENTITY = "dbsnpSubmittedVariantEntity"
 DBSNP_SUBMITTED_VARIANT_OPERATION_ENTITY = "dbsnpSubmittedVariantOperationEntity"
 
+sve_projection = {'accession': 1, 'allelesMatch': 1}
+sve_projection_stage = {'$project': sve_projection}
+
 
 def retrieve_dbsnp_sve_with_allelesMatch_false(mongo_source, doc_file):
     retrieve_records_with_allelesMatch_false(mongo_source, DBSNP_SUBMITTED_VARIANT_ENTITY, doc_file)
@@ -45,27 +49,37 @@ def retrieve_records_with_allelesMatch_false(mongo_source, collection_name, doc_
             cursor.close()
 
 
-def ss_with_same_accession_but_without_alleles_match_false(sve_doc_file, output_doc_file):
-    with open(sve_doc_file, 'r') as sve_file:
-        with open(output_doc_file, 'w') as output_file:
-            batch_id = 1
-            while True:
-                logger.info(f'Processing SS should have Alleles Match False - Batch Id {batch_id}')
-                batch_id = batch_id + 1
-                ss_acc_list = [int(line.split(",")[1].strip()) for line in list(islice(sve_file, 100000))]
-                if not ss_acc_list:
-                    break
-                filter_criteria = {'accession': {'$in': ss_acc_list}}
-                records = find_documents(mongo_source, SUBMITTED_VARIANT_ENTITY, filter_criteria)
-                dbsnp_records = find_documents(mongo_source, DBSNP_SUBMITTED_VARIANT_ENTITY, filter_criteria)
-                records.extend(dbsnp_records)
-
-                records = [record for record in records if 'allelesMatch' not in record]
-
-                for record in records:
-                    ss_id = record['_id']
-                    ss_accession = record['accession']
-                    output_file.write(f'{ss_id},{ss_accession}\n')
+def process_in_batches(input_file, output_file, process_batch, num_workers, batch_name, batch_size=100000):
+    """
+    Read the input file in batches of lines and process them in a pool of workers, each streaming its own queries.
+    At most twice as many batches as workers are in flight and the lines returned for each batch are written in the
+    order of the input, so memory stays bounded whatever the size of the input.
+    """
+    with open(input_file, 'r') as open_input, open(output_file, 'w') as open_output, \
+            ThreadPoolExecutor(max_workers=num_workers) as executor:
+        pending_batches = deque()
+        batch_id = 1
+        for lines in iter(lambda: list(islice(open_input, batch_size)), []):
+            logger.info(f'Processing {batch_name} Batch Id {batch_id}')
+            batch_id = batch_id + 1
+            pending_batches.append(executor.submit(process_batch, lines))
+            if len(pending_batches) >= 2 * num_workers:
+                open_output.writelines(pending_batches.popleft().result())
+        while pending_batches:
+            open_output.writelines(pending_batches.popleft().result())
+
+
+def ss_with_same_accession_but_without_alleles_match_false(mongo_source, sve_doc_file, output_doc_file, num_workers=1):
+    def process_batch(lines):
+        ss_acc_list = [int(line.split(",")[1].strip()) for line in lines]
+        filter_criteria = {'accession': {'$in': ss_acc_list}}
+        return [
+            f"{record['_id']},{record['accession']}\n"
+            for record in find_documents_in_sve_collections(mongo_source, filter_criteria, sve_projection)
+            if 'allelesMatch' not in record
+        ]
+
+    process_in_batches(sve_doc_file, output_doc_file, process_batch, num_workers, 'SS should have Alleles Match False')
 
 
 def get_rs_of_ss_with_alleles_match_false(sve_doc_file):
@@ -82,166 +96,276 @@ def get_rs_of_ss_with_alleles_match_false(sve_doc_file):
     return rs_list_full
 
 
-def ss_merged_into_ss_with_alleles_match_false(mongo_source, sve_doc_file, merged_doc_file):
-    with open(sve_doc_file, 'r') as sve_file:
-        with open(merged_doc_file, 'w') as merged_file:
-            batch_id = 1
-            while True:
-                logger.info(f'Pocessing Merge Batch Id {batch_id}')
-                batch_id = batch_id + 1
-                ss_acc_list = [int(line.split(",")[1].strip()) for line in list(islice(sve_file, 100000))]
-                if not ss_acc_list:
-                    break
-                filter_criteria = {'eventType': 'MERGED', 'mergeInto': {'$in': ss_acc_list}}
-                records = find_documents(mongo_source, DBSNP_SUBMITTED_VARIANT_OPERATION_ENTITY, filter_criteria)
-                for record in records:
-                    event_id = record['_id']
-                    merged_into_ss_accession = record['mergeInto']
-                    merged_ss_accession = record['accession']
-                    merged_ss_id = record['inactiveObjects'][0]['hashedMessage']
-                    merged_ss_rs = record['inactiveObjects'][0]['rs'] if 'rs' in record['inactiveObjects'][0] else ''
-                    merged_file.write(
-                        f'{event_id},{merged_into_ss_accession},{merged_ss_accession},{merged_ss_id},{merged_ss_rs}\n')
-
-
-def check_all_mergedInto_entities_has_alleles_match_false(merged_doc_file, output_file):
-    with open(merged_doc_file, 'r') as input_file:
-        with open(output_file, 'w') as output_file:
-            batch_id = 1
-            while True:
-                logger.info(f'Processing Merge Batch Id {batch_id}')
-                batch_id = batch_id + 1
-                lines_list = list(islice(input_file, 100000))
-                if not lines_list:
-                    break
-
-                mergeInto_acc_list = [int(line.split(",")[1].strip()) for line in lines_list]
-                filter_criteria = {'accession': {'$in': mergeInto_acc_list}}
-                records = find_documents(mongo_source, SUBMITTED_VARIANT_ENTITY, filter_criteria)
-                dbsnp_records = find_documents(mongo_source, DBSNP_SUBMITTED_VARIANT_ENTITY, filter_criteria)
-                records.extend(dbsnp_records)
-                merged_acc_records = defaultdict(list)
-                for record in records:
-                    record_acc = record['accession']
-                    merged_acc_records[record_acc].append(record)
-
-                for line in lines_list:
-                    mergee_acc = int(line.split(",")[1].strip())
-                    mergee_hash = line.split(",")[3].strip()
-                    found = False
-                    if mergee_acc in merged_acc_records:
-                        for record in merged_acc_records[mergee_acc]:
-                            if record['_id'] == mergee_hash:
-                                if 'allelesMatch' in record and record['allelesMatch'] == False:
-                                    found = True
-                                    break
-                            else:
-                                logger.info(f"record hash not found: {line}")
-
-                    if not found:
-                        output_file.write(f"{line}")
-
-
-def ss_split_from_ss_with_alleles_match_false(mongo_source, sve_doc_file, split_doc_file):
-    with open(sve_doc_file, 'r') as sve_file:
-        with open(split_doc_file, 'w') as split_file:
-            batch_id = 1
-            while True:
-                ss_acc_list = [int(line.split(",")[1].strip()) for line in list(islice(sve_file, 100000))]
-                logger.info(f'Processing Split Batch Id {batch_id}')
-                batch_id = batch_id + 1
-                if not ss_acc_list:
-                    break
-                filter_criteria = {'eventType': 'SS_SPLIT', 'accession': {'$in': ss_acc_list}}
-                records = find_documents(mongo_source, DBSNP_SUBMITTED_VARIANT_OPERATION_ENTITY, filter_criteria)
-                for record in records:
-                    event_id = record['_id']
-                    split_from_ss_accession = record['accession']
-                    split_into_ss_accession = record["splitInto"]
-                    split_file.write(f'{event_id},{split_from_ss_accession},{split_into_ss_accession}\n')
-
-
-def check_if_splitInto_ss_has_alleles_match_false(split_doc_file, split_output_file):
-    with open(split_doc_file, 'r') as sve_input_file:
-        with open(split_output_file, 'w') as sve_output_file:
-            batch_id = 1
-            while True:
-                ss_acc_list = [int(line.split(",")[2].strip()) for line in list(islice(sve_input_file, 100000))]
-                logger.info(f'Processing Split Batch Id {batch_id}')
-                batch_id = batch_id + 1
-                if not ss_acc_list:
-                    break
-                filter_criteria = {'accession': {'$in': ss_acc_list}}
-                records = find_documents(mongo_source, SUBMITTED_VARIANT_ENTITY, filter_criteria)
-                dbsnp_records = find_documents(mongo_source, DBSNP_SUBMITTED_VARIANT_ENTITY, filter_criteria)
-                records.extend(dbsnp_records)
-
-                records = [record for record in records if 'allelesMatch' in record]
-
-                for record in records:
-                    ss_id = record['_id']
-                    ss_accession = record['accession']
-                    sve_output_file.write(f"{ss_id},{ss_accession},{record['allelesMatch']}\n")
-
-
-def find_documents(mongo_source, collection_name, filter_criteria):
+def ss_merged_into_ss_with_alleles_match_false(mongo_source, sve_doc_file, merged_doc_file, num_workers=1):
+    def process_batch(lines):
+        ss_acc_list = [int(line.split(",")[1].strip()) for line in lines]
+        filter_criteria = {'eventType': 'MERGED', 'mergeInto': {'$in': ss_acc_list}}
+        merged_lines = []
+        for record in find_documents(mongo_source, DBSNP_SUBMITTED_VARIANT_OPERATION_ENTITY, filter_criteria):
+            event_id = record['_id']
+            merged_into_ss_accession = record['mergeInto']
+            merged_ss_accession = record['accession']
+            merged_ss_id = record['inactiveObjects'][0]['hashedMessage']
+            merged_ss_rs = record['inactiveObjects'][0]['rs'] if 'rs' in record['inactiveObjects'][0] else ''
+            merged_lines.append(
+                f'{event_id},{merged_into_ss_accession},{merged_ss_accession},{merged_ss_id},{merged_ss_rs}\n')
+        return merged_lines
+
+    process_in_batches(sve_doc_file, merged_doc_file, process_batch, num_workers, 'Merge')
+
+
+def check_all_mergedInto_entities_has_alleles_match_false(mongo_source, merged_doc_file, output_file, num_workers=1):
+    def process_batch(lines_list):
+        mergeInto_acc_list = [int(line.split(",")[1].strip()) for line in lines_list]
+        filter_criteria = {'accession': {'$in': mergeInto_acc_list}}
+        merged_acc_records = defaultdict(list)
+        for record in find_documents_in_sve_collections(mongo_source, filter_criteria, sve_projection):
+            record_acc = record['accession']
+            merged_acc_records[record_acc].append(record)
+
+        not_found_lines = []
+        for line in lines_list:
+            mergee_acc = int(line.split(",")[1].strip())
+            mergee_hash = line.split(",")[3].strip()
+            found = False
+            if mergee_acc in merged_acc_records:
+                for record in merged_acc_records[mergee_acc]:
+                    if record['_id'] == mergee_hash:
+                        if 'allelesMatch' in record and record['allelesMatch'] == False:
+                            found = True
+                            break
+                    else:
+                        logger.info(f"record hash not found: {line}")
+
+            if not found:
+                not_found_lines.append(line)
+        return not_found_lines
+
+    process_in_batches(merged_doc_file, output_file, process_batch, num_workers, 'Merge')
+
+
+def ss_split_from_ss_with_alleles_match_false(mongo_source, sve_doc_file, split_doc_file, num_workers=1):
+    def process_batch(lines):
+        ss_acc_list = [int(line.split(",")[1].strip()) for line in lines]
+        filter_criteria = {'eventType': 'SS_SPLIT', 'accession': {'$in': ss_acc_list}}
+        return [
+            f"{record['_id']},{record['accession']},{record['splitInto']}\n"
+            for record in find_documents(mongo_source, DBSNP_SUBMITTED_VARIANT_OPERATION_ENTITY, filter_criteria,
+                                         {'accession': 1, 'splitInto': 1})
+        ]
+
+    process_in_batches(sve_doc_file, split_doc_file, process_batch, num_workers, 'Split')
+
+
+def check_if_splitInto_ss_has_alleles_match_false(mongo_source, split_doc_file, split_output_file, num_workers=1):
+    def process_batch(lines):
+        ss_acc_list = [int(line.split(",")[2].strip()) for line in lines]
+        filter_criteria = {'accession': {'$in': ss_acc_list}}
+        return [
+            f"{record['_id']},{record['accession']},{record['allelesMatch']}\n"
+            for record in find_documents_in_sve_collections(mongo_source, filter_criteria, sve_projection)
+            if 'allelesMatch' in record
+        ]
+
+    process_in_batches(split_doc_file, split_output_file, process_batch, num_workers, 'Split')
+
+
+def find_documents(mongo_source, collection_name, filter_criteria, projection=None):
+    """Stream the documents matching the filter without loading them all in memory."""
     collection = mongo_source.mongo_handle[mongo_source.db_name][collection_name]
     cursor = collection.with_options(read_concern=ReadConcern("majority"),
                                      read_preference=pymongo.ReadPreference.PRIMARY) \
-        .find(filter_criteria, no_cursor_timeout=True)
-    records = []
+        .find(filter_criteria, projection, no_cursor_timeout=True)
     try:
         for result in cursor:
-            records.append(result)
+            yield result
     except Exception as e:
         logger.exception(traceback.format_exc())
         raise e
     finally:
         cursor.close()
 
-    return records
 
+def find_documents_in_sve_collections(mongo_source, filter_criteria, projection=None):
+    return chain(find_documents(mongo_source, SUBMITTED_VARIANT_ENTITY, filter_criteria, projection),
+                 find_documents(mongo_source, DBSNP_SUBMITTED_VARIANT_ENTITY, filter_criteria, projection))
 
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description='Count Variant stats with allelesMatch=False', add_help=False)
-    parser.add_argument("--mongo-source-uri",
-                        help="Mongo Source URI (ex: mongodb://user:@mongos-source-host:27017/admin)",
-                        required=True)
-    parser.add_argument("--mongo-source-secrets-file",
-                        help="Full path to the Mongo Source secrets file (ex: /path/to/mongo/source/secret)",
-                        required=True)
-    parser.add_argument("--res-dir", help="File containing discordant rs ids", required=True)
-    args = parser.parse_args()
-
-    mongo_source = MongoDatabase(uri=args.mongo_source_uri, secrets_file=args.mongo_source_secrets_file,
-                                 db_name="eva_accession_sharded")
 
+def aggregate(mongo_source, collection_name, pipeline):
+    collection = mongo_source.mongo_handle[mongo_source.db_name][collection_name]
+    with collection.with_options(read_concern=ReadConcern("majority"),
+                                 read_preference=pymongo.ReadPreference.PRIMARY) \
+            .aggregate(pipeline, allowDiskUse=True) as cursor:
+        for result in cursor:
+            yield result
+
+
+def count_per_category(mongo_source, collection_name, pipeline, category):
+    """Group the results of the pipeline on the provided expression on the server and return the count of each."""
+    group_stage = {'$group': {'_id': category, 'count': {'$sum': 1}}}
+    return {result['_id']: result['count'] for result in aggregate(mongo_source, collection_name,
+                                                                   pipeline + [group_stage])}
+
+
+def lookup_in_sve_collections(local_field, name, pipeline, let=None):
+    """
+    Stages adding the submitted variants of both collections with an accession equal to local_field in the array
+    name, each reduced by the provided pipeline which can use the variables in let.
+    """
+    return [
+        {'$lookup': {'from': collection_name, 'localField': local_field, 'foreignField': 'accession',
+                     'let': let or {}, 'pipeline': pipeline, 'as': name + str(index)}}
+        for index, collection_name in enumerate([SUBMITTED_VARIANT_ENTITY, DBSNP_SUBMITTED_VARIANT_ENTITY])
+    ] + [
+        {'$addFields': {name: {'$concatArrays': ['$' + name + '0', '$' + name + '1']}}},
+        {'$project': {name + '0': 0, name + '1': 0}}
+    ]
+
+
+def lookup_alleles_match_false(local_field):
+    # Stages keeping only the documents where local_field is the accession of a dbSNP SS with allelesMatch=false
+    return [
+        {'$lookup': {'from': DBSNP_SUBMITTED_VARIANT_ENTITY, 'localField': local_field, 'foreignField': 'accession',
+                     'pipeline': [{'$match': {'allelesMatch': False}}, {'$limit': 1}, {'$project': {'_id': 1}}],
+                     'as': 'alleles_match_false'}},
+        {'$match': {'alleles_match_false': {'$ne': []}}}
+    ]
+
+
+def ss_with_same_accession_server_side(mongo_source, output_doc_file):
+    pipeline = [
+        {'$match': {'allelesMatch': False}},
+        {'$project': {'accession': 1}},
+        *lookup_in_sve_collections('accession', 'same_accession', [sve_projection_stage]),
+        {'$unwind': '$same_accession'}
+    ]
+    counts = count_per_category(mongo_source, DBSNP_SUBMITTED_VARIANT_ENTITY, pipeline,
+                                {'$ifNull': ['$same_accession.allelesMatch', 'missing']})
+    with open(output_doc_file, 'w') as output_file:
+        for record in aggregate(mongo_source, DBSNP_SUBMITTED_VARIANT_ENTITY,
+                                pipeline + [{'$match': {'same_accession.allelesMatch': {'$exists': False}}}]):
+            output_file.write(f"{record['same_accession']['_id']},{record['same_accession']['accession']}\n")
+    return counts
+
+
+def merged_into_ss_with_alleles_match_false_server_side(mongo_source, output_file):
+    pipeline = [
+        {'$match': {'eventType': 'MERGED'}},
+        *lookup_alleles_match_false('mergeInto'),
+        {'$project': {'mergeInto': 1, 'accession': 1, 'merged_ss': {'$arrayElemAt': ['$inactiveObjects', 0]}}},
+        # Match the SS the event was merged into by hash as well as by accession
+        *lookup_in_sve_collections('mergeInto', 'mergee', [
+            {'$match': {'$expr': {'$eq': ['$_id', '$$hash']}}}, sve_projection_stage
+        ], let={'hash': '$merged_ss.hashedMessage'}),
+        {'$addFields': {'mergee_alleles_match_false': {'$in': [False, '$mergee.allelesMatch']}}}
+    ]
+    counts = count_per_category(mongo_source, DBSNP_SUBMITTED_VARIANT_OPERATION_ENTITY, pipeline,
+                                '$mergee_alleles_match_false')
+    with open(output_file, 'w') as open_output:
+        for record in aggregate(mongo_source, DBSNP_SUBMITTED_VARIANT_OPERATION_ENTITY,
+                                pipeline + [{'$match': {'mergee_alleles_match_false': False}}]):
+            merged_ss_rs = record['merged_ss'].get('rs', '')
+            open_output.write(f"{record['_id']},{record['mergeInto']},{record['accession']},"
+                              f"{record['merged_ss']['hashedMessage']},{merged_ss_rs}\n")
+    return counts
+
+
+def split_into_ss_with_alleles_match_false_server_side(mongo_source, output_file):
+    pipeline = [
+        {'$match': {'eventType': 'SS_SPLIT'}},
+        *lookup_alleles_match_false('accession'),
+        {'$project': {'accession': 1, 'splitInto': 1}},
+        *lookup_in_sve_collections('splitInto', 'split_into', [
+            {'$match': {'allelesMatch': {'$exists': True}}}, sve_projection_stage
+        ]),
+        {'$unwind': '$split_into'}
+    ]
+    counts = count_per_category(mongo_source, DBSNP_SUBMITTED_VARIANT_OPERATION_ENTITY, pipeline,
+                                '$split_into.allelesMatch')
+    with open(output_file, 'w') as open_output:
+        for record in aggregate(mongo_source, DBSNP_SUBMITTED_VARIANT_OPERATION_ENTITY, pipeline):
+            split_into = record['split_into']
+            open_output.write(f"{split_into['_id']},{split_into['accession']},{split_into['allelesMatch']}\n")
+    return counts
+
+
+def run_in_batches(mongo_source, res_dir, num_workers=1):
+    """
+    Run the allele match checks from the dbSNP submitted variants with allelesMatch=false, querying the related
+    submitted variants and operations in batches of accessions.
+    """
     # ##### no document with allelesMatch=false in submittedVariantEntity
-    # sve_doc_file = os.path.join(args.res_dir, "sve_records_alleles_match_false")
+    # sve_doc_file = os.path.join(res_dir, "sve_records_alleles_match_false")
     # if not os.path.isfile(sve_doc_file):
     #     retrieve_sve_with_allelesMatch_false(mongo_source, sve_doc_file)
 
-    dbsnp_sve_doc_file = os.path.join(args.res_dir, "dbsnp_sve_records_alleles_match_false")
+    dbsnp_sve_doc_file = os.path.join(res_dir, "dbsnp_sve_records_alleles_match_false")
     if not os.path.isfile(dbsnp_sve_doc_file):
         retrieve_dbsnp_sve_with_allelesMatch_false(mongo_source, dbsnp_sve_doc_file)
 
-    sve_should_have = os.path.join(args.res_dir, "ss_that_should_have_allele_match_false")
-    ss_with_same_accession_but_without_alleles_match_false(dbsnp_sve_doc_file, sve_should_have)
+    sve_should_have = os.path.join(res_dir, "ss_that_should_have_allele_match_false")
+    ss_with_same_accession_but_without_alleles_match_false(mongo_source, dbsnp_sve_doc_file, sve_should_have,
+                                                           num_workers)
 
     rs_list = get_rs_of_ss_with_alleles_match_false(dbsnp_sve_doc_file)
     if not rs_list:
         logger.info("None of the dbsnp sve retrieved has rs associated with it")
 
-    merged_doc_file = os.path.join(args.res_dir, "ss_merged_into_ss_with_alleles_match_false")
-    ss_merged_into_ss_with_alleles_match_false(mongo_source, dbsnp_sve_doc_file, merged_doc_file)
+    merged_doc_file = os.path.join(res_dir, "ss_merged_into_ss_with_alleles_match_false")
+    ss_merged_into_ss_with_alleles_match_false(mongo_source, dbsnp_sve_doc_file, merged_doc_file, num_workers)
+
+    output_file = os.path.join(res_dir, "not_mergedInto_having_alleles_match_false")
+    check_all_mergedInto_entities_has_alleles_match_false(mongo_source, merged_doc_file, output_file, num_workers)
+
+    split_doc_file = os.path.join(res_dir, "ss_split_from_ss_with_alleles_match_false")
+    ss_split_from_ss_with_alleles_match_false(mongo_source, dbsnp_sve_doc_file, split_doc_file, num_workers)
+
+    splitInto_ss_with_alleles_match_false = os.path.join(res_dir, "splitInto_ss_with_alleles_match_False")
+    check_if_splitInto_ss_has_alleles_match_false(mongo_source, split_doc_file, splitInto_ss_with_alleles_match_false,
+                                                  num_workers)
+
+
+def run_server_side(mongo_source, res_dir):
+    """
+    Run the allele match checks as aggregations: the submitted variants are matched to each other with $lookup and
+    the matches and mismatches are counted with $group, so only the mismatching records leave the server.
+    Requires MongoDB 5.1 or later for $lookup on sharded collections.
+    """
+    all_counts = {
+        'same_accession_alleles_match': ss_with_same_accession_server_side(
+            mongo_source, os.path.join(res_dir, "ss_that_should_have_allele_match_false")),
+        'merged_into_alleles_match_false': merged_into_ss_with_alleles_match_false_server_side(
+            mongo_source, os.path.join(res_dir, "not_mergedInto_having_alleles_match_false")),
+        'split_into_alleles_match': split_into_ss_with_alleles_match_false_server_side(
+            mongo_source, os.path.join(res_dir, "splitInto_ss_with_alleles_match_False"))
+    }
+    with open(os.path.join(res_dir, "alleles_match_counts.tsv"), 'w') as counts_file:
+        for check, counts in all_counts.items():
+            for category, count in sorted(counts.items(), key=lambda item: str(item[0])):
+                logger.info(f'{check} {category}: {count}')
+                counts_file.write(f'{check}\t{category}\t{count}\n')
 
-    output_file = os.path.join(args.res_dir, "not_mergedInto_having_alleles_match_false")
-    check_all_mergedInto_entities_has_alleles_match_false(merged_doc_file, output_file)
 
-    split_doc_file = os.path.join(args.res_dir, "ss_split_from_ss_with_alleles_match_false")
-    ss_split_from_ss_with_alleles_match_false(mongo_source, dbsnp_sve_doc_file, split_doc_file)
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Count Variant stats with allelesMatch=False', add_help=False)
+    parser.add_argument("--mongo-source-uri",
+                        help="Mongo Source URI (ex: mongodb://user:@mongos-source-host:27017/admin)",
+                        required=True)
+    parser.add_argument("--mongo-source-secrets-file",
+                        help="Full path to the Mongo Source secrets file (ex: /path/to/mongo/source/secret)",
+                        required=True)
+    parser.add_argument("--res-dir", help="File containing discordant rs ids", required=True)
+    parser.add_argument("--num-workers", type=int, default=4,
+                        help="Number of batches queried concurrently")
+    parser.add_argument("--server-side", action='store_true', default=False,
+                        help="Match and count the submitted variants with aggregations in MongoDB")
+    args = parser.parse_args()
 
-    splitInto_ss_with_alleles_match_false = os.path.join(args.res_dir, "splitInto_ss_with_alleles_match_False")
-    check_if_splitInto_ss_has_alleles_match_false(split_doc_file, splitInto_ss_with_alleles_match_false)
+    mongo_source = MongoDatabase(uri=args.mongo_source_uri, secrets_file=args.mongo_source_secrets_file,
+                                 db_name="eva_accession_sharded")
 
-    logger.info(f"Process Finished")
+    if args.server_side:
+        run_server_side(mongo_source, args.res_dir)
+    else:
+        run_in_batches(mongo_source, args.res_dir, args.num_workers)
+    logger.info("Process Finished")
@@ -0,0 +1,71 @@
+import os
+import tempfile
+from unittest import TestCase
+
+from ebi_eva_common_pyutils.mongodb import MongoDatabase
+
+from tasks.eva_3100.alleles_match_count import run_in_batches, run_server_side, SUBMITTED_VARIANT_ENTITY, \
+    DBSNP_SUBMITTED_VARIANT_ENTITY, DBSNP_SUBMITTED_VARIANT_OPERATION_ENTITY
+
+
+class TestAllelesMatchCount(TestCase):
+    # Tests require a MongoDB 5.1 or later running on localhost:27017
+    output_files = ['ss_that_should_have_allele_match_false', 'not_mergedInto_having_alleles_match_false',
+                    'splitInto_ss_with_alleles_match_False']
+
+    def setUp(self) -> None:
+        self.mongo_source = MongoDatabase(uri='mongodb://localhost:27017', db_name='eva_accession_sharded_test')
+        self.db = self.mongo_source.mongo_handle[self.mongo_source.db_name]
+        self.db[DBSNP_SUBMITTED_VARIANT_ENTITY].insert_many([
+            {'_id': 'DBSNP1', 'accession': 1, 'rs': 100, 'allelesMatch': False},
+            {'_id': 'DBSNP2', 'accession': 2, 'rs': 200, 'allelesMatch': False},
+            {'_id': 'DBSNP3', 'accession': 3, 'rs': 300, 'allelesMatch': False},
+            {'_id': 'DBSNP4', 'accession': 4, 'rs': 400},
+            {'_id': 'DBSNP5', 'accession': 5, 'rs': 500, 'allelesMatch': False},
+            {'_id': 'DBSNP6', 'accession': 6, 'rs': 600},
+        ])
+        self.db[SUBMITTED_VARIANT_ENTITY].insert_many([
+            # Same accession as a dbSNP SS with allelesMatch=false
+            {'_id': 'EVA1', 'accession': 1, 'rs': 100},
+            {'_id': 'EVA2', 'accession': 2, 'rs': 200, 'allelesMatch': False},
+            # SS split from ss3
+            {'_id': 'EVA7', 'accession': 7, 'rs': 700, 'allelesMatch': True},
+        ])
+        self.db[DBSNP_SUBMITTED_VARIANT_OPERATION_ENTITY].insert_many([
+            # Merged into ss2 whose hash has allelesMatch=false
+            {'_id': 'MERGED1', 'eventType': 'MERGED', 'accession': 10, 'mergeInto': 2,
+             'inactiveObjects': [{'hashedMessage': 'DBSNP2', 'rs': 200}]},
+            # Merged into ss5 but the hash does not match any SS
+            {'_id': 'MERGED2', 'eventType': 'MERGED', 'accession': 11, 'mergeInto': 5,
+             'inactiveObjects': [{'hashedMessage': 'UNKNOWN', 'rs': 500}]},
+            # Merged into a SS without allelesMatch=false
+            {'_id': 'MERGED3', 'eventType': 'MERGED', 'accession': 12, 'mergeInto': 4,
+             'inactiveObjects': [{'hashedMessage': 'DBSNP4'}]},
+            {'_id': 'SPLIT1', 'eventType': 'SS_SPLIT', 'accession': 3, 'splitInto': 7},
+            {'_id': 'SPLIT2', 'eventType': 'SS_SPLIT', 'accession': 3, 'splitInto': 6},
+            {'_id': 'SPLIT3', 'eventType': 'SS_SPLIT', 'accession': 4, 'splitInto': 7},
+        ])
+
+    def tearDown(self) -> None:
+        self.mongo_source.mongo_handle.drop_database(self.mongo_source.db_name)
+        self.mongo_source.mongo_handle.close()
+
+    @staticmethod
+    def read_lines(output_file):
+        with open(output_file) as open_file:
+            return sorted(open_file.readlines())
+
+    def test_server_side_matches_batches(self):
+        with tempfile.TemporaryDirectory() as batch_dir, tempfile.TemporaryDirectory() as server_side_dir:
+            run_in_batches(self.mongo_source, batch_dir, num_workers=2)
+            run_server_side(self.mongo_source, server_side_dir)
+            for output_file in self.output_files:
+                assert self.read_lines(os.path.join(server_side_dir, output_file)) == \
+                    self.read_lines(os.path.join(batch_dir, output_file)), output_file
+
+            assert self.read_lines(os.path.join(server_side_dir, 'ss_that_should_have_allele_match_false')) == \
+                ['EVA1,1\n']
+            assert self.read_lines(os.path.join(server_side_dir, 'not_mergedInto_having_alleles_match_false')) == \
+                ['MERGED2,5,11,UNKNOWN,500\n']
+            assert self.read_lines(os.path.join(server_side_dir, 'splitInto_ss_with_alleles_match_False')) == \
+                ['EVA7,7,True\n']
@@ -1,32 +1,151 @@
 import gzip
+import subprocess
 from argparse import ArgumentParser
+from collections import deque, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
 
 import requests
+from ebi_eva_common_pyutils.command_utils import run_command_with_output
+from ebi_eva_common_pyutils.logger import logging_config
+from ebi_eva_common_pyutils.mongodb import MongoDatabase
+from retry import retry
 
+logger = logging_config.get_logger(__name__)
 
-def get_rs_from_ss(ssid):
-    response = requests.get(f'https://www.ebi.ac.uk/eva/webservices/identifiers/v1/submitted-variants/{ssid}')
+identifiers_url = 'https://www.ebi.ac.uk/eva/webservices/identifiers/v1/submitted-variants/'
+sve_collections = ['submittedVariantEntity', 'dbsnpSubmittedVariantEntity']
+
+
+@retry(tries=4, delay=2, backoff=1.2, jitter=(1, 3))
+def get_rs_from_ss(ssid, session=requests):
+    response = session.get(f'{identifiers_url}{ssid}')
     response.raise_for_status()
     json_data = response.json()
     assert len(json_data) == 1
     return json_data[0]['data'].get('clusteredVariantAccession') or json_data[0]['data'].get('backPropagatedVariantAccession')
 
 
-parser = ArgumentParser()
-parser.add_argument('--accessioning_report')
-parser.add_argument('--annotated_vcf')
-args = parser.parse_args()
-
-input_vcf = args.accessioning_report
-output_vcf = args.annotated_vcf
-with open(output_vcf, 'w') as open_output:
-    with gzip.open(input_vcf, 'rt') as open_file:
-        for line in open_file:
-            if line.startswith('#'):
-                open_output.write(line)
-            else:
-                sp_line = line.split('\t')
-                ssid = int(sp_line[2][2:])
-                rsid = get_rs_from_ss(ssid)
-                sp_line[2] = f'rs{rsid}'
-                open_output.write('\t'.join(sp_line))
+class WebserviceRsResolver:
+    """Resolve the RS of each SS with the identifiers webservice, reusing the connections across requests."""
+
+    def __init__(self, num_connections):
+        self.session = requests.Session()
+        self.session.mount('https://', requests.adapters.HTTPAdapter(pool_maxsize=num_connections))
+
+    def get_rs_from_ss_list(self, ssids):
+        return {ssid: get_rs_from_ss(ssid, self.session) for ssid in ssids}
+
+    def close(self):
+        self.session.close()
+
+
+class MongoRsResolver:
+    """Resolve the RS of each SS with one query per submitted variant collection for the whole list of SS."""
+
+    def __init__(self, mongo_source, assembly_accession=None):
+        self.mongo_source = mongo_source
+        self.assembly_accession = assembly_accession
+
+    def get_rs_from_ss_list(self, ssids):
+        filter_criteria = {'accession': {'$in': list(ssids)}}
+        if self.assembly_accession:
+            filter_criteria['seq'] = self.assembly_accession
+        rs_per_ss = defaultdict(set)
+        for collection in sve_collections:
+            cursor = self.mongo_source.mongo_handle[self.mongo_source.db_name][collection].find(
+                filter_criteria, {'accession': 1, 'rs': 1, 'backPropRS': 1}
+            )
+            for sve in cursor:
+                rs_per_ss[sve['accession']].add(sve.get('rs') or sve.get('backPropRS'))
+        for ssid in ssids:
+            if len(rs_per_ss.get(ssid, [])) != 1:
+                raise ValueError(f'Expected one RS for ss{ssid} but found {len(rs_per_ss.get(ssid, []))}')
+        return {ssid: next(iter(rs_per_ss[ssid])) for ssid in ssids}
+
+    def close(self):
+        pass
+
+
+def annotate_lines(rs_resolver, lines):
+    ssids = [int(line.split('\t', 3)[2][2:]) for line in lines if not line.startswith('#')]
+    rs_per_ss = rs_resolver.get_rs_from_ss_list(ssids)
+    annotated_lines = []
+    for line in lines:
+        if line.startswith('#'):
+            annotated_lines.append(line)
+        else:
+            sp_line = line.split('\t')
+            ssid = int(sp_line[2][2:])
+            sp_line[2] = f'rs{rs_per_ss[ssid]}'
+            annotated_lines.append('\t'.join(sp_line))
+    return annotated_lines
+
+
+def annotate_accessioning_report(rs_resolver, input_vcf, open_output, chunk_size=1000, num_workers=4):
+    """
+    Replace the SS ids of the report with their RS ids. Chunks of lines are resolved concurrently and at most twice as
+    many chunks as workers are held in the reorder buffer, so the lines are written in the order of the input.
+    """
+    nb_lines = 0
+    with gzip.open(input_vcf, 'rt') as open_file, ThreadPoolExecutor(max_workers=num_workers) as executor:
+        pending_chunks = deque()
+        for lines in iter(lambda: list(islice(open_file, chunk_size)), []):
+            pending_chunks.append(executor.submit(annotate_lines, rs_resolver, lines))
+            if len(pending_chunks) >= 2 * num_workers:
+                annotated_lines = pending_chunks.popleft().result()
+                open_output.writelines(annotated_lines)
+                nb_lines += len(annotated_lines)
+                logger.info(f'Annotated {nb_lines} lines')
+        while pending_chunks:
+            annotated_lines = pending_chunks.popleft().result()
+            open_output.writelines(annotated_lines)
+            nb_lines += len(annotated_lines)
+    logger.info(f'Annotated {nb_lines} lines')
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--accessioning_report')
+    parser.add_argument('--annotated_vcf', help='Path to the bgzipped VCF created, indexed with tabix')
+    parser.add_argument('--mongo_source_uri',
+                        help='Mongodb source uri. When provided the RS are looked up in the accessioning database '
+                             'instead of the webservice')
+    parser.add_argument('--mongo_source_secrets_file', help='File containing the mongodb source secrets')
+    parser.add_argument('--assembly_accession',
+                        help='Assembly of the accessioning report, used to select the SS in the database')
+    parser.add_argument('--chunk_size', type=int, default=1000, help='Number of lines resolved together')
+    parser.add_argument('--num_workers', type=int, default=4, help='Number of chunks resolved concurrently')
+    parser.add_argument('--bgzip', default='bgzip', help='Path to the bgzip executable')
+    parser.add_argument('--tabix', default='tabix', help='Path to the tabix executable')
+    args = parser.parse_args()
+    logging_config.add_stdout_handler()
+
+    if args.mongo_source_uri:
+        mongo_source = MongoDatabase(uri=args.mongo_source_uri, secrets_file=args.mongo_source_secrets_file,
+                                     db_name='eva_accession_sharded')
+        rs_resolver = MongoRsResolver(mongo_source, args.assembly_accession)
+    else:
+        rs_resolver = WebserviceRsResolver(args.num_workers)
+
+    try:
+        with open(args.annotated_vcf, 'wb') as open_output:
+            # Compress while writing so that the uncompressed VCF is never stored
+            bgzip_process = subprocess.Popen([args.bgzip, '-c'], stdin=subprocess.PIPE, stdout=open_output,
+                                             text=True)
+            try:
+                annotate_accessioning_report(rs_resolver, args.accessioning_report, bgzip_process.stdin,
+                                             args.chunk_size, args.num_workers)
+            finally:
+                bgzip_process.stdin.close()
+                if bgzip_process.wait() != 0:
+                    raise subprocess.CalledProcessError(bgzip_process.returncode, args.bgzip)
+    finally:
+        rs_resolver.close()
+        if args.mongo_source_uri:
+            mongo_source.mongo_handle.close()
+    run_command_with_output(f'Index {args.annotated_vcf}', f'{args.tabix} -p vcf {args.annotated_vcf}')
+
+
+if __name__ == '__main__':
+    main()
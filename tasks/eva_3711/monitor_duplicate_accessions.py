@@ -14,13 +14,17 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import bisect
 import getpass
+import json
 import os
 import smtplib
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from urllib.parse import quote_plus
 
 import click
+from pymongo import MongoClient
 
 
 import configparser
@@ -164,18 +168,177 @@ def report_duplicate_accessions_in_mongo(pipeline_properties_file, accessions_ex
                                                          email_recipients)
 
 
+class AccessionRangeIndex:
+    """
+    Sorted list of non-overlapping inclusive [start, end] accession ranges seen in previous runs.
+    Accessions are issued in blocks so the ranges stay compact even for very large collections.
+    """
+
+    def __init__(self, ranges=None, watermark=None):
+        self.ranges = [list(accession_range) for accession_range in (ranges or [])]
+        self.watermark = watermark
+        self._starts = [start for start, _ in self.ranges]
+
+    def __contains__(self, accession):
+        position = bisect.bisect_right(self._starts, accession) - 1
+        return position >= 0 and self.ranges[position][1] >= accession
+
+    def add_ranges(self, new_ranges):
+        merged_ranges = []
+        for start, end in sorted(self.ranges + [list(accession_range) for accession_range in new_ranges]):
+            if merged_ranges and start <= merged_ranges[-1][1] + 1:
+                merged_ranges[-1][1] = max(merged_ranges[-1][1], end)
+            else:
+                merged_ranges.append([start, end])
+        self.ranges = merged_ranges
+        self._starts = [start for start, _ in self.ranges]
+
+    @classmethod
+    def load(cls, index_file):
+        if not os.path.exists(index_file):
+            return cls()
+        with open(index_file) as open_file:
+            index = json.load(open_file)
+        watermark = datetime.fromisoformat(index['watermark']) if index['watermark'] else None
+        return cls(index['ranges'], watermark)
+
+    def save(self, index_file):
+        # Write to a temporary file first so that a crash never leaves a truncated index behind
+        with open(index_file + '.tmp', 'w') as open_file:
+            json.dump({'watermark': self.watermark.isoformat() if self.watermark else None,
+                       'ranges': self.ranges}, open_file)
+        os.replace(index_file + '.tmp', index_file)
+
+
+def accessions_to_ranges(sorted_accessions):
+    ranges = []
+    for accession in sorted_accessions:
+        if ranges and accession <= ranges[-1][1] + 1:
+            ranges[-1][1] = max(ranges[-1][1], accession)
+        else:
+            ranges.append([accession, accession])
+    return ranges
+
+
+def get_accession_partitions(collection, query, number_of_partitions):
+    lowest = collection.find_one(query, {'accession': 1}, sort=[('accession', 1)])
+    if not lowest:
+        return []
+    highest = collection.find_one(query, {'accession': 1}, sort=[('accession', -1)])
+    lower_bound, upper_bound = lowest['accession'], highest['accession'] + 1
+    partition_size = max(1, -(-(upper_bound - lower_bound) // number_of_partitions))
+    return [(start, min(start + partition_size, upper_bound))
+            for start in range(lower_bound, upper_bound, partition_size)]
+
+
+def find_duplicates_in_partition(collection, query, partition, previous_accessions):
+    """
+    Returns the duplicate accessions of the partition and the ranges covering all its accessions. The distinct
+    accessions come sorted out of a single aggregation and are streamed into the ranges so that the accessions of the
+    partition are never all held in memory.
+    """
+    partition_query = dict(query, accession={'$gte': partition[0], '$lt': partition[1]})
+    duplicate_accessions = set()
+
+    def distinct_accessions():
+        for result in collection.aggregate([
+            {'$match': partition_query},
+            {'$group': {'_id': '$accession', 'count': {'$sum': 1}}},
+            {'$sort': {'_id': 1}}
+        ], allowDiskUse=True, batchSize=10000):
+            # Accessions created since the last run that collide with one seen in a previous run are also duplicates
+            if result['count'] > 1 or result['_id'] in previous_accessions:
+                duplicate_accessions.add(result['_id'])
+            yield result['_id']
+
+    new_ranges = accessions_to_ranges(distinct_accessions())
+    return duplicate_accessions, new_ranges
+
+
+def get_new_accessions_query(study, run_start, watermark=None):
+    """
+    Query for the accessions created between the watermark of the last run and the start of this run. On the first run
+    the documents without createdDate are included as well: they predate the watermark of any later run.
+    """
+    query = {"study": study, "remappedFrom": {"$exists": False}}
+    if watermark:
+        query["createdDate"] = {"$gte": watermark, "$lt": run_start}
+    else:
+        query["$or"] = [{"createdDate": {"$lt": run_start}}, {"createdDate": {"$exists": False}}]
+    return query
+
+
+def report_duplicate_accessions_in_database(pipeline_properties_file, accessions_export_output_dir, collection_name,
+                                            study, email_recipients, number_of_partitions):
+    mongo_connection_properties = get_mongo_connection_details_from_properties_file(pipeline_properties_file)
+    index_file = os.path.join(accessions_export_output_dir, "accession_index_{0}_{1}_{2}.json"
+                              .format(mongo_connection_properties["mongo_db"], collection_name, study))
+    duplicates_output_filename = os.path.join(accessions_export_output_dir,
+                                              "duplicate_accessions_in_{0}_{1}_at_{2}_as_of_{3}.csv"
+                                              .format(mongo_connection_properties["mongo_db"], collection_name,
+                                                      mongo_connection_properties["mongo_host"],
+                                                      datetime.today().strftime('%Y%m%d%H%M%S')))
+    previous_accessions = AccessionRangeIndex.load(index_file)
+    run_start = datetime.utcnow()
+    query = get_new_accessions_query(study, run_start, previous_accessions.watermark)
+
+    logger.info("Checking duplicate accessions in the {0} collection in the {1} database at {2} created since {3}..."
+                .format(collection_name, mongo_connection_properties["mongo_db"],
+                        mongo_connection_properties["mongo_host"], previous_accessions.watermark or "the beginning"))
+
+    with MongoClient(get_mongo_uri(mongo_connection_properties)) as mongo_client:
+        collection = mongo_client[mongo_connection_properties["mongo_db"]][collection_name]
+        partitions = get_accession_partitions(collection, query, number_of_partitions)
+        with ThreadPoolExecutor(max_workers=number_of_partitions) as executor:
+            results = list(executor.map(
+                lambda partition: find_duplicates_in_partition(collection, query, partition, previous_accessions),
+                partitions
+            ))
+
+    duplicate_accessions = sorted(set().union(*[duplicates for duplicates, _ in results]))
+    with open(duplicates_output_filename, 'w') as open_file:
+        for accession in duplicate_accessions:
+            open_file.write(str(accession) + '\n')
+
+    for _, new_ranges in results:
+        previous_accessions.add_ranges(new_ranges)
+    previous_accessions.watermark = run_start
+    previous_accessions.save(index_file)
+
+    if duplicate_accessions:
+        notify_by_email(mongo_connection_properties, collection_name, duplicates_output_filename,
+                        len(duplicate_accessions), email_recipients)
+    else:
+        logger.info("NO duplicate accessions were found in the {0} collection in the {1} database at {2}..."
+                    .format(collection_name, mongo_connection_properties["mongo_db"],
+                            mongo_connection_properties["mongo_host"]))
+    # Use exit code 0 as scheduler will also send email on crash
+    return 0
+
+
 @click.option("-p", "--pipeline-properties-file", required=True)
 @click.option("-o", "--accessions-export-output-dir", required=True)
 @click.option("-s", "--study", required=True)
 @click.option("-e", "--email-recipients", multiple=True, required=True)
+@click.option("--in-database", is_flag=True, default=False,
+              help="Find duplicates with aggregations in MongoDB, only scanning accessions created since the last run")
+@click.option("--number-of-partitions", default=8, type=int,
+              help="Number of accession ranges checked concurrently when using --in-database")
 @click.argument("collection-names", nargs=-1, required=True)
 @click.command()
-def main(pipeline_properties_file, accessions_export_output_dir, study, email_recipients, collection_names):
+def main(pipeline_properties_file, accessions_export_output_dir, study, email_recipients, in_database,
+         number_of_partitions, collection_names):
     exit_code = 0
     for collection_name in collection_names:
-        exit_code = exit_code or \
-                    report_duplicate_accessions_in_mongo(pipeline_properties_file, accessions_export_output_dir,
-                                                         collection_name, study, email_recipients)
+        if in_database:
+            exit_code = exit_code or \
+                        report_duplicate_accessions_in_database(pipeline_properties_file, accessions_export_output_dir,
+                                                                collection_name, study, email_recipients,
+                                                                number_of_partitions)
+        else:
+            exit_code = exit_code or \
+                        report_duplicate_accessions_in_mongo(pipeline_properties_file, accessions_export_output_dir,
+                                                             collection_name, study, email_recipients)
     sys.exit(exit_code)
 
 
@@ -0,0 +1,107 @@
+import os
+import tempfile
+from datetime import datetime
+from unittest import TestCase
+from unittest.mock import patch
+
+import mongomock
+
+from tasks.eva_3711.monitor_duplicate_accessions import AccessionRangeIndex, accessions_to_ranges, \
+    find_duplicates_in_partition, get_new_accessions_query, report_duplicate_accessions_in_database
+
+
+class TestAccessionRangeIndex(TestCase):
+
+    def test_accessions_to_ranges(self):
+        assert accessions_to_ranges(iter([1, 2, 3, 5, 7, 8])) == [[1, 3], [5, 5], [7, 8]]
+        assert accessions_to_ranges([]) == []
+
+    def test_contains_and_add_ranges(self):
+        index = AccessionRangeIndex([[10, 20], [30, 30]])
+        assert 10 in index and 20 in index and 30 in index
+        assert 9 not in index and 21 not in index and 31 not in index
+
+        index.add_ranges([[21, 25], [40, 45], [1, 2]])
+        assert index.ranges == [[1, 2], [10, 25], [30, 30], [40, 45]]
+        assert 22 in index and 26 not in index
+
+    def test_save_and_load(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            index_file = os.path.join(tmp_dir, 'index.json')
+            assert AccessionRangeIndex.load(index_file).watermark is None
+            AccessionRangeIndex([[1, 5]], datetime(2023, 1, 2, 3, 4, 5)).save(index_file)
+            index = AccessionRangeIndex.load(index_file)
+            assert index.ranges == [[1, 5]]
+            assert index.watermark == datetime(2023, 1, 2, 3, 4, 5)
+
+
+class TestFindDuplicates(TestCase):
+
+    def setUp(self):
+        self.collection = mongomock.MongoClient()['eva_accession_sharded']['submittedVariantEntity']
+
+    def insert(self, accessions, created_date=None, study='PRJEB1'):
+        documents = []
+        for accession in accessions:
+            document = {'accession': accession, 'study': study}
+            if created_date:
+                document['createdDate'] = created_date
+            documents.append(document)
+        self.collection.insert_many(documents)
+
+    def test_new_accessions_query(self):
+        run_start = datetime(2023, 2, 1)
+        query = get_new_accessions_query('PRJEB1', run_start)
+        # Documents without createdDate are only checked on the first run
+        self.insert([1, 2], created_date=None)
+        self.insert([3], created_date=datetime(2023, 1, 1))
+        self.insert([4], created_date=datetime(2023, 3, 1))
+        assert sorted(d['accession'] for d in self.collection.find(query)) == [1, 2, 3]
+
+        query = get_new_accessions_query('PRJEB1', run_start, watermark=datetime(2022, 12, 1))
+        assert sorted(d['accession'] for d in self.collection.find(query)) == [3]
+
+    def test_find_duplicates_in_partition(self):
+        self.insert([1, 2, 2, 3, 10, 11])
+        query = get_new_accessions_query('PRJEB1', datetime(2023, 1, 1))
+        duplicates, ranges = find_duplicates_in_partition(self.collection, query, (0, 11),
+                                                          AccessionRangeIndex([[10, 10]]))
+        assert duplicates == {2, 10}
+        assert ranges == [[1, 3], [10, 10]]
+
+    def test_incremental_runs(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            properties_file = os.path.join(tmp_dir, 'pipeline.properties')
+            with open(properties_file, 'w') as open_file:
+                open_file.write('spring.data.mongodb.host=localhost\nspring.data.mongodb.port=27017\n'
+                                'spring.data.mongodb.database=eva_accession_sharded\n'
+                                'spring.data.mongodb.username=user\nspring.data.mongodb.password=pass\n'
+                                'spring.data.mongodb.authentication-database=admin\n')
+            mongo_client = mongomock.MongoClient()
+            self.collection = mongo_client['eva_accession_sharded']['submittedVariantEntity']
+
+            def run(run_start):
+                with patch('tasks.eva_3711.monitor_duplicate_accessions.MongoClient', return_value=mongo_client), \
+                        patch('tasks.eva_3711.monitor_duplicate_accessions.notify_by_email') as notify, \
+                        patch('tasks.eva_3711.monitor_duplicate_accessions.datetime') as mock_datetime:
+                    mock_datetime.utcnow.return_value = run_start
+                    mock_datetime.today.return_value = run_start
+                    mock_datetime.fromisoformat = datetime.fromisoformat
+                    report_duplicate_accessions_in_database(properties_file, tmp_dir, 'submittedVariantEntity',
+                                                            'PRJEB1', ['eva@example.com'], 2)
+                    return notify.call_args[0][3] if notify.called else 0
+
+            self.insert([1, 2, 3])
+            self.insert([4, 4], created_date=datetime(2023, 1, 1))
+            assert run(datetime(2023, 2, 1)) == 1
+            index = AccessionRangeIndex.load(os.path.join(tmp_dir, 'accession_index_eva_accession_sharded_'
+                                                                   'submittedVariantEntity_PRJEB1.json'))
+            assert index.ranges == [[1, 4]]
+            assert index.watermark == datetime(2023, 2, 1)
+
+            # Only the accessions created since the watermark are scanned, against the index of the previous runs
+            self.insert([3, 7], created_date=datetime(2023, 2, 15))
+            assert run(datetime(2023, 3, 1)) == 1
+            index = AccessionRangeIndex.load(os.path.join(tmp_dir, 'accession_index_eva_accession_sharded_'
+                                                                   'submittedVariantEntity_PRJEB1.json'))
+            assert index.ranges == [[1, 4], [7, 7]]
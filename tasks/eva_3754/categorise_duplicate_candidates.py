@@ -3,7 +3,13 @@ import itertools
 import json
 import sys
 from argparse import ArgumentParser
-from collections import Counter
+from collections import Counter, deque
+from multiprocessing import Pool
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 
 def convert_date(datetime_dict):
@@ -14,9 +20,9 @@ def convert_date(datetime_dict):
     return datetime.datetime(**date_tmp)
 
 def min_time_gap_between_create_date(cve_list):
-    date_list = [convert_date(cve.get('createdDate')) for cve in cve_list]
-    delta_dates = [abs(d1-d2) for d1,d2 in  itertools.combinations(date_list, 2)]
-    min_delta_date = min(delta_dates)
+    # Once sorted, the smallest gap is always between two neighbouring dates
+    date_list = sorted(convert_date(cve.get('createdDate')) for cve in cve_list)
+    min_delta_date = min(d2 - d1 for d1, d2 in zip(date_list, date_list[1:]))
     return min_delta_date
 
 def more_than_cve_with_assembly(cve_list):
@@ -29,6 +35,9 @@ def are_taxonomy_consistent(sve_map):
     taxonomy_set_list = []
     for sve_group in sve_map:
         taxonomy_set_list.append(set(sve.get('taxonomy') for sve in sve_map[sve_group]))
+    # Usually one taxonomy is shared by all the groups and there is no need to compare them two by two
+    if not taxonomy_set_list or set.intersection(*taxonomy_set_list):
+        return True
     for taxonomy_set1, taxonomy_set2 in itertools.combinations(taxonomy_set_list, 2):
         if not taxonomy_set1.intersection(taxonomy_set2):
             return False
@@ -66,20 +75,86 @@ def categorise_from_json(accession, json_doc):
 
     return '\t'.join(out)
 
+def load_json(json_string):
+    if orjson:
+        try:
+            return orjson.loads(json_string)
+        except orjson.JSONDecodeError:
+            # orjson does not support everything the json module does, like integers over 64 bits
+            pass
+    return json.loads(json_string)
+
+
 def parse_line(line):
     sp_line = line.strip().split(' ')
     rsid = sp_line[0]
-    json_doc = json.loads(' '.join(sp_line[1:]))
+    json_doc = load_json(' '.join(sp_line[1:]))
     out = categorise_from_json(accession=int(rsid), json_doc=json_doc)
-    print(f'{rsid}\t{out}')
+    return f'{rsid}\t{out}'
+
+
+def parse_lines(lines):
+    """Categorise a chunk of lines and return the output lines with the number of RS in each category."""
+    outputs = [parse_line(line) for line in lines]
+    tallies = Counter(category for output in outputs for category in output.split('\t')[1:])
+    return outputs, tallies
+
+
+def read_chunks(open_file, chunk_size):
+    while True:
+        lines = list(itertools.islice(open_file, chunk_size))
+        if not lines:
+            return
+        yield lines
+
+
+def categorise_file(input_file, output_file, num_processes=1, chunk_size=10000):
+    """
+    Categorise all the duplicate candidates of the input file, spreading chunks of lines across a process pool.
+    At most twice as many chunks as processes are read ahead, and the output lines are written in the order of the
+    input. Returns the number of RS in each category.
+    """
+    tallies = Counter()
+
+    def write_chunk(outputs, chunk_tallies):
+        for output in outputs:
+            print(output, file=output_file)
+        tallies.update(chunk_tallies)
+
+    with open(input_file) as open_file:
+        if num_processes > 1:
+            with Pool(num_processes) as pool:
+                pending_chunks = deque()
+                for lines in read_chunks(open_file, chunk_size):
+                    pending_chunks.append(pool.apply_async(parse_lines, (lines,)))
+                    if len(pending_chunks) >= 2 * num_processes:
+                        write_chunk(*pending_chunks.popleft().get())
+                while pending_chunks:
+                    write_chunk(*pending_chunks.popleft().get())
+        else:
+            for lines in read_chunks(open_file, chunk_size):
+                write_chunk(*parse_lines(lines))
+    return tallies
+
+
+def write_tallies(tallies, open_file):
+    for category, count in sorted(tallies.items()):
+        print(f'{category}\t{count}', file=open_file)
+
 
 def main():
     arg_parse = ArgumentParser(description='Categorise duplicate candidates')
     arg_parse.add_argument('file', help='files to process')
+    arg_parse.add_argument('--num_processes', type=int, default=4, help='number of processes categorising the lines')
+    arg_parse.add_argument('--chunk_size', type=int, default=10000, help='number of lines sent to a process at once')
+    arg_parse.add_argument('--tallies', help='file where the number of RS per category is written (default stderr)')
     args = arg_parse.parse_args()
-    with open(args.file) as open_file:
-        for line in open_file:
-            parse_line(line)
+    tallies = categorise_file(args.file, sys.stdout, args.num_processes, args.chunk_size)
+    if args.tallies:
+        with open(args.tallies, 'w') as open_tallies:
+            write_tallies(tallies, open_tallies)
+    else:
+        write_tallies(tallies, sys.stderr)
 
     return 0
 
@@ -0,0 +1,49 @@
+import io
+import json
+import os
+import tempfile
+from unittest import TestCase
+
+from tasks.eva_3754.categorise_duplicate_candidates import categorise_file
+
+
+def created_date(day, hour):
+    return {'date': {'year': 2022, 'month': 1, 'day': day}, 'time': {'hour': hour, 'minute': 0, 'second': 0, 'nano': 0}}
+
+
+def candidate_line(rsid):
+    json_doc = {
+        'clusteredVariantEntityList': [
+            {'assemblyAccession': 'GCA_000001.1', 'createdDate': created_date(1, 0)},
+            {'assemblyAccession': 'GCA_000001.1' if rsid % 2 else 'GCA_000002.1',
+             'createdDate': created_date(1 + rsid % 3, 1)}
+        ],
+        'submittedVariantEntityMap': {
+            'group1': [{'taxonomy': 9031}],
+            'group2': [{'taxonomy': 9031 if rsid % 5 else 9913}]
+        }
+    }
+    return f'{rsid} {json.dumps(json_doc)}\n'
+
+
+class TestCategoriseFile(TestCase):
+
+    def test_pool_matches_serial(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            input_file = os.path.join(tmp_dir, 'duplicate_candidates.txt')
+            with open(input_file, 'w') as open_file:
+                for rsid in [1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 5000000001, 5000100002]:
+                    open_file.write(candidate_line(rsid))
+
+            serial_output = io.StringIO()
+            serial_tallies = categorise_file(input_file, serial_output, num_processes=1, chunk_size=2)
+            pool_output = io.StringIO()
+            pool_tallies = categorise_file(input_file, pool_output, num_processes=2, chunk_size=2)
+
+            assert pool_output.getvalue() == serial_output.getvalue()
+            assert pool_tallies == serial_tallies
+            assert len(pool_output.getvalue().splitlines()) == 13
+            assert pool_tallies['INCONSISTENT_TAXONOMY'] == 2
+            assert pool_tallies['RECENT_ACCESSION_5000100000'] == 1
+            assert pool_output.getvalue().splitlines()[0] == \
+                '1\tCREATED_SEPARATELY\tIN_SAME_ASSEMBLIES_GCA_000001.1\tOLD_ACCESSION\tCONSISTENT_TAXONOMY'
@@ -1,17 +1,25 @@
+import json
 import logging
+import os
 import sys
+import threading
 from argparse import ArgumentParser
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from itertools import islice
 
 from ebi_eva_common_pyutils.logger import logging_config as log_cfg
 from ebi_eva_internal_pyutils.mongo_utils import get_mongo_connection_handle
-from pymongo import ReadPreference
+from pymongo import ASCENDING, DeleteOne
 
 logger = log_cfg.get_logger(__name__)
 
 
 assembly_to_delete = 'GCA_002263795.4'
 db_name = 'eva_accession_sharded'
+submitted_collections = ['submittedVariantEntity', 'dbsnpSubmittedVariantEntity']
+cluster_collections = ['clusteredVariantEntity', 'dbsnpClusteredVariantEntity']
+operation_collections = ['submittedVariantOperationEntity', 'dbsnpSubmittedVariantOperationEntity']
 
 
 def chunked_iterable(iterable, size):
@@ -19,91 +27,189 @@ def chunked_iterable(iterable, size):
     while chunk := list(islice(iterator, size)):
         yield chunk
 
-def delete_variants_no_search(collections, find_filter, private_config_xml_file, profile, chunk_size = 1000):
-    with get_mongo_connection_handle(profile, private_config_xml_file, read_preference = ReadPreference.SECONDARY_PREFERRED, write_concern=0) as mongo_conn:
-        for source_collection in collections:
-            collection_obj = mongo_conn[db_name][source_collection]
-            cursor = collection_obj.find(find_filter, no_cursor_timeout=True)
-            chunk_num = 1
-            total_deletion = 0
-            for variants_chunk in chunked_iterable(cursor, chunk_size):
-                logger.info(f"Processing chunk {chunk_num} : {chunk_num * chunk_size} in {source_collection}")
-                chunk_num += 1
-                hash_to_delete = [variant.get('_id') for variant in variants_chunk]
-                collection_obj.delete_many({'_id': {'$in': list(hash_to_delete)}})
-                total_deletion += chunk_size
-                logger.info(f"Deleted {chunk_size} (Total {total_deletion}) documents from {source_collection}.")
-
-def delete_variants2(private_config_xml_file, profile, chunk_size = 1000):
-    submitted_collections = ['submittedVariantEntity', 'dbsnpSubmittedVariantEntity']
-    cluster_collections = ['clusteredVariantEntity', 'dbsnpClusteredVariantEntity']
-    operation_collections = ['submittedVariantOperationEntity', 'dbsnpSubmittedVariantOperationEntity']
-    sve_find_filter = {"seq": assembly_to_delete, 'remappedFrom': {'$exists': 1}}
-    cve_find_filter = {"asm": assembly_to_delete}
-    svoe_find_filter = {'inactiveObjects.seq': assembly_to_delete, 'eventType': {'$ne':'RS_BACK_PROPAGATED'}}
-
-    delete_variants_no_search(submitted_collections, sve_find_filter, private_config_xml_file, profile, chunk_size = chunk_size)
-    delete_variants_no_search(cluster_collections, cve_find_filter, private_config_xml_file, profile, chunk_size = chunk_size)
-    delete_variants_no_search(operation_collections, svoe_find_filter, private_config_xml_file, profile, chunk_size = chunk_size)
-
-
-def delete_variants(private_config_xml_file, profile, source_collection, chunk_size = 1000):
+
+
+def id_partitions(number_of_partitions):
+    """Split the space of the hexadecimal hashes used as _id into contiguous ranges of about the same size."""
+    boundaries = [format(i * 256 // number_of_partitions, '02X') for i in range(1, number_of_partitions)]
+    lower_bounds = [None] + boundaries
+    upper_bounds = boundaries + [None]
+    return list(zip(lower_bounds, upper_bounds))
+
+
+class DeletionCheckpoint:
+    """
+    JSON file recording, for each anchor collection and _id range, the last _id of which the deletion is complete.
+    """
+
+    def __init__(self, checkpoint_file):
+        self.checkpoint_file = checkpoint_file
+        self.lock = threading.Lock()
+        self.last_ids = {}
+        if checkpoint_file and os.path.isfile(checkpoint_file):
+            with open(checkpoint_file) as open_file:
+                self.last_ids = json.load(open_file)
+
+    def get(self, key):
+        return self.last_ids.get(key)
+
+    def set(self, key, last_id):
+        if not self.checkpoint_file:
+            return
+        with self.lock:
+            self.last_ids[key] = last_id
+            with open(self.checkpoint_file + '.tmp', 'w') as open_file:
+                json.dump(self.last_ids, open_file)
+            os.replace(self.checkpoint_file + '.tmp', self.checkpoint_file)
+
+
+class CascadingDeleter:
+    """
+    Delete the submitted variants matching a filter along with what depends on them: their operations in the
+    assembly and the clustered variants that no surviving submitted variant of the assembly refers to anymore.
+    The anchor collections are split in _id ranges processed by concurrent workers. For each batch the dependent
+    documents are resolved with a query per collection and deleted before the submitted variants, in acknowledged
+    bulk writes, so that an interrupted run can be resumed from the checkpoint without leaving orphans.
+    """
+
+    def __init__(self, mongo_conn, assembly, anchor_filter, checkpoint_file=None, chunk_size=1000, num_workers=4,
+                 num_partitions=16, dry_run=False):
+        self.db = mongo_conn[db_name]
+        self.assembly = assembly
+        self.anchor_filter = anchor_filter
+        self.checkpoint = DeletionCheckpoint(checkpoint_file)
+        self.chunk_size = chunk_size
+        self.num_workers = num_workers
+        self.num_partitions = num_partitions
+        self.dry_run = dry_run
+        self.counts = Counter()
+        self.counts_lock = threading.Lock()
+        # Documents shared by several batches are only counted once when nothing is deleted
+        self.dry_run_ids = defaultdict(set)
+
+    def add_count(self, collection_name, count):
+        with self.counts_lock:
+            self.counts[collection_name] += count
+
+    def delete_ids(self, collection_name, ids):
+        if not ids:
+            return 0
+        if self.dry_run:
+            with self.counts_lock:
+                new_ids = set(ids) - self.dry_run_ids[collection_name]
+                self.dry_run_ids[collection_name].update(new_ids)
+            deleted_count = len(new_ids)
+        else:
+            result = self.db[collection_name].bulk_write([DeleteOne({'_id': _id}) for _id in ids], ordered=False)
+            deleted_count = result.deleted_count
+        self.add_count(collection_name, deleted_count)
+        return deleted_count
+
+    def find_ids(self, collection_name, query):
+        return [document['_id'] for document in self.db[collection_name].find(query, {'_id': 1})]
+
+    def find_operations_to_delete(self, sve_accessions):
+        return {
+            collection_name: self.find_ids(collection_name, {
+                'accession': {'$in': sve_accessions}, 'inactiveObjects.seq': self.assembly,
+                'eventType': {'$ne': 'RS_BACK_PROPAGATED'}
+            })
+            for collection_name in operation_collections
+        }
+
+    def find_clusters_to_delete(self, rs_accessions):
+        # RS still referenced by a submitted variant of the assembly that is not to be deleted are kept
+        rs_to_keep = set()
+        for collection_name in submitted_collections:
+            rs_to_keep.update(self.db[collection_name].distinct('rs', {
+                '$and': [{'rs': {'$in': rs_accessions}, 'seq': self.assembly}, {'$nor': [self.anchor_filter]}]
+            }))
+        rs_to_delete = [rs for rs in rs_accessions if rs not in rs_to_keep]
+        if not rs_to_delete:
+            return {}
+        return {
+            collection_name: self.find_ids(collection_name, {'accession': {'$in': rs_to_delete}, 'asm': self.assembly})
+            for collection_name in cluster_collections
+        }
+
+    def delete_batch(self, collection_name, variants):
+        sve_accessions = list({variant['accession'] for variant in variants})
+        rs_accessions = list({variant['rs'] for variant in variants if variant.get('rs')})
+        dependents = self.find_operations_to_delete(sve_accessions)
+        if rs_accessions:
+            dependents.update(self.find_clusters_to_delete(rs_accessions))
+        for dependent_collection, ids in dependents.items():
+            self.delete_ids(dependent_collection, ids)
+        self.delete_ids(collection_name, [variant['_id'] for variant in variants])
+
+    def delete_partition(self, collection_name, lower_bound, upper_bound):
+        # The key includes both bounds so that a checkpoint is not reused with a different number of partitions
+        checkpoint_key = f'{collection_name}:{lower_bound or ""}-{upper_bound or ""}'
+        last_id = self.checkpoint.get(checkpoint_key)
+        if last_id == 'done':
+            logger.info(f'{collection_name} from {lower_bound} to {upper_bound} already processed')
+            return
+        id_range = {}
+        if last_id or lower_bound:
+            id_range['$gt' if last_id else '$gte'] = last_id or lower_bound
+        if upper_bound:
+            id_range['$lt'] = upper_bound
+        query = {'$and': [self.anchor_filter, {'_id': id_range}]} if id_range else self.anchor_filter
+        cursor = self.db[collection_name].find(query, {'_id': 1, 'accession': 1, 'rs': 1},
+                                               no_cursor_timeout=True).sort('_id', ASCENDING)
+        try:
+            for variants in chunked_iterable(cursor, self.chunk_size):
+                self.delete_batch(collection_name, variants)
+                if not self.dry_run:
+                    self.checkpoint.set(checkpoint_key, variants[-1]['_id'])
+        finally:
+            cursor.close()
+        if not self.dry_run:
+            self.checkpoint.set(checkpoint_key, 'done')
+        logger.info(f'{collection_name} from {lower_bound} to {upper_bound} processed. Counts so far: '
+                    f'{dict(self.counts)}')
+
+    def run(self):
+        tasks = [(collection_name, lower_bound, upper_bound) for collection_name in submitted_collections
+                 for lower_bound, upper_bound in id_partitions(self.num_partitions)]
+        with ThreadPoolExecutor(max_workers=self.num_workers) as executor:
+            # Iterate over the results to raise the errors of the workers
+            list(executor.map(lambda task: self.delete_partition(*task), tasks))
+        action = 'Would delete' if self.dry_run else 'Deleted'
+        for collection_name in submitted_collections + operation_collections + cluster_collections:
+            logger.info(f'{action} {self.counts[collection_name]} documents from {collection_name}')
+        return self.counts
+
+
+def delete_remapped_variants(private_config_xml_file, profile, assembly, checkpoint_file=None, chunk_size=1000,
+                             num_workers=4, num_partitions=16, dry_run=False):
+    anchor_filter = {'seq': assembly, 'remappedFrom': {'$exists': 1}}
     with get_mongo_connection_handle(profile, private_config_xml_file) as mongo_conn:
-        sve_find_filter = {"seq": assembly_to_delete, 'remappedFrom':{'$exists':1}}
-        operation_collections = ['submittedVariantOperationEntity', 'dbsnpSubmittedVariantOperationEntity']
-        cluster_collections = ['clusteredVariantEntity', 'dbsnpClusteredVariantEntity']
-        submitted_collections = ['submittedVariantEntity', 'dbsnpSubmittedVariantEntity']
-        sve_coll = mongo_conn[db_name][source_collection]
-        cursor = sve_coll.find(sve_find_filter)
-
-        chunk_num = 1
-        for variants_chunk in chunked_iterable(cursor, chunk_size):
-            logger.info(f"Processing chunk {chunk_num} : {chunk_num * chunk_size}")
-            chunk_num += 1
-            hash_to_delete = [variant.get('_id') for variant in variants_chunk]
-            sve_accessions = [variant.get('accession') for variant in variants_chunk]
-            cve_accessions = set([variant.get('rs') for variant in variants_chunk if variant.get('rs')])
-
-            # delete SVE
-            delete_result = sve_coll.delete_many({'_id': {'$in': list(hash_to_delete)}})
-            logger.info(f"Deleted {delete_result.deleted_count} documents from {source_collection}.")
-
-            # Delete submitted variant operation if they exists
-            for collection in operation_collections:
-                tmp_svoe_coll = mongo_conn[db_name][collection]
-                hash_to_delete = [op.get('_id') for op in tmp_svoe_coll.find(
-                    {'accession': {'$in': sve_accessions}, 'inactiveObjects.seq': assembly_to_delete}, {'_id': 1}
-                )]
-                if hash_to_delete:
-                    delete_result = tmp_svoe_coll.delete_many({'_id': {'$in': hash_to_delete}})
-                    logger.info(f"Deleted {delete_result.deleted_count} documents from {collection}.")
-
-            # delete clustered variants if they are orphan
-            cve_accession_to_keep = set()
-            for collection in submitted_collections:
-                tmp_sve_coll = mongo_conn[db_name][collection]
-                variants_for_these_rs = list(tmp_sve_coll.find({'rs': {'$in': list(cve_accessions)}, 'seq': assembly_to_delete}))
-                cve_accession_to_keep.update(set([variant.get('rs') for variant in variants_for_these_rs] ))
-            cve_accessions_to_delete = cve_accessions - cve_accession_to_keep
-            for collection in cluster_collections:
-                tmp_cve_coll = mongo_conn[db_name][collection]
-                hash_to_delete = [cluster.get('_id') for cluster in tmp_cve_coll.find(
-                    {'accession': {'$in': list(cve_accessions_to_delete)}, 'asm':assembly_to_delete},
-                    {'_id': 1})]
-                if hash_to_delete:
-                    delete_result = tmp_cve_coll.delete_many({'_id': {'$in': hash_to_delete}})
-                    logger.info(f"Deleted {delete_result.deleted_count} documents from {collection}.")
+        return CascadingDeleter(mongo_conn, assembly, anchor_filter, checkpoint_file, chunk_size, num_workers,
+                                num_partitions, dry_run).run()
+
 
 def main():
     arg_parse = ArgumentParser(description='Delete variants remapped to  RS')
     arg_parse.add_argument('--private-config-xml-file',
                            help="Maven configuration file where connection to mongodb can be found", required=True)
     arg_parse.add_argument('--profile', help='e.g. production, development or local', required=True)
+    arg_parse.add_argument('--assembly', default=assembly_to_delete,
+                           help='Assembly from which the remapped variants are deleted')
+    arg_parse.add_argument('--checkpoint-file',
+                           help='File recording the progress of the deletion so that it can be resumed')
+    arg_parse.add_argument('--chunk-size', type=int, default=1000, help='Number of variants deleted per batch')
+    arg_parse.add_argument('--num-workers', type=int, default=4, help='Number of _id ranges processed concurrently')
+    arg_parse.add_argument('--num-partitions', type=int, default=16,
+                           help='Number of _id ranges each submitted variant collection is split into')
+    arg_parse.add_argument('--dry-run', action='store_true', default=False,
+                           help='Count the documents that would be deleted without deleting them')
 
     args = arg_parse.parse_args()
     log_cfg.add_stdout_handler(level=logging.INFO)
     # delete variant in the remapped assembly
-    delete_variants2(args.private_config_xml_file, args.profile)
+    delete_remapped_variants(args.private_config_xml_file, args.profile, args.assembly, args.checkpoint_file,
+                             args.chunk_size, args.num_workers, args.num_partitions, args.dry_run)
 
     return 0
 
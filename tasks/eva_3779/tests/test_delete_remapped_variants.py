@@ -0,0 +1,49 @@
+from unittest import TestCase
+
+import mongomock
+
+from tasks.eva_3779.delete_remapped_variants import CascadingDeleter, db_name
+
+
+class TestCascadingDeleter(TestCase):
+    assembly = 'GCA_002263795.4'
+    anchor_filter = {'seq': assembly, 'remappedFrom': {'$exists': 1}}
+
+    def setUp(self) -> None:
+        self.mongo_conn = mongomock.MongoClient()
+        db = self.mongo_conn[db_name]
+        remapped = {'seq': self.assembly, 'remappedFrom': 'GCA_000003055.5'}
+        # The SS are in different _id partitions but share their RS and their operations
+        db['submittedVariantEntity'].insert_many([
+            {'_id': '10AA', 'accession': 1, 'rs': 100, **remapped},
+            {'_id': 'F0BB', 'accession': 1, 'rs': 100, **remapped},
+            # Not remapped: keeps rs200
+            {'_id': '20DD', 'accession': 3, 'rs': 200, 'seq': self.assembly},
+        ])
+        db['dbsnpSubmittedVariantEntity'].insert_many([
+            {'_id': '50CC', 'accession': 2, 'rs': 100, **remapped},
+            {'_id': '60EE', 'accession': 4, 'rs': 200, **remapped},
+        ])
+        db['clusteredVariantEntity'].insert_many([{'_id': 'CVE100', 'accession': 100, 'asm': self.assembly}])
+        db['dbsnpClusteredVariantEntity'].insert_many([{'_id': 'CVE200', 'accession': 200, 'asm': self.assembly}])
+        db['submittedVariantOperationEntity'].insert_many([
+            {'_id': 'OP1', 'accession': 1, 'eventType': 'UPDATED', 'inactiveObjects': [{'seq': self.assembly}]},
+            {'_id': 'OP2', 'accession': 1, 'eventType': 'RS_BACK_PROPAGATED',
+             'inactiveObjects': [{'seq': self.assembly}]},
+        ])
+
+    def run_deleter(self, dry_run):
+        return CascadingDeleter(self.mongo_conn, self.assembly, self.anchor_filter, chunk_size=1, num_workers=4,
+                                num_partitions=16, dry_run=dry_run).run()
+
+    def test_dry_run_counts_match_deletion(self):
+        dry_run_counts = self.run_deleter(dry_run=True)
+        assert self.mongo_conn[db_name]['clusteredVariantEntity'].count_documents({}) == 1
+        counts = self.run_deleter(dry_run=False)
+        assert dict(counts) == {
+            'submittedVariantEntity': 2, 'dbsnpSubmittedVariantEntity': 2, 'clusteredVariantEntity': 1,
+            'submittedVariantOperationEntity': 1
+        }
+        assert dict(dry_run_counts) == dict(counts)
+        assert self.mongo_conn[db_name]['clusteredVariantEntity'].count_documents({}) == 0
+        assert self.mongo_conn[db_name]['dbsnpClusteredVariantEntity'].count_documents({}) == 1
@@ -0,0 +1,111 @@
+import json
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from ebi_eva_common_pyutils.logger import logging_config
+
+logger = logging_config.get_logger(__name__)
+
+skipped_databases = ['admin', 'config', 'local']
+
+
+def list_namespaces(mongo_client, collection_names=None):
+    # Returns the (database, collection) pairs in the MongoDB instance, optionally restricted to some collections
+    namespaces = []
+    for db_name in mongo_client.list_database_names():
+        if db_name in skipped_databases:
+            continue
+        for collection_name in mongo_client[db_name].list_collection_names():
+            if collection_names is None or collection_name in collection_names:
+                namespaces.append((db_name, collection_name))
+    return sorted(namespaces)
+
+
+def get_namespace_stats(mongo_client, database, collection):
+    logger.info(f"reading collection info for db({database}) and collection({collection})")
+    collection_info = mongo_client[database].command("collstats", collection)
+    return {
+        "database": database,
+        "collection": collection,
+        "size": int(collection_info.get("size", 0)),
+        "storage_size": int(collection_info.get("storageSize", 0)),
+        "document_count": int(collection_info.get("count", 0)),
+        "total_index_size": int(collection_info.get("totalIndexSize", 0)),
+        "index_sizes": {index: int(size) for index, size in collection_info.get("indexSizes", {}).items()},
+        "shards": {shard: {"size": int(shard_info.get("size", 0))}
+                   for shard, shard_info in collection_info.get("shards", {}).items()}
+    }
+
+
+def collect_stats(mongo_client, namespaces, num_workers=8):
+    """
+    Gather the collStats of every namespace concurrently.
+    """
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        return list(executor.map(lambda namespace: get_namespace_stats(mongo_client, *namespace), namespaces))
+
+
+class StatsSnapshotStore:
+    """
+    SQLite file keeping the collection stats of every run so that reports can show the growth between runs.
+    """
+
+    def __init__(self, sqlite_file):
+        self.connection = sqlite3.connect(sqlite_file)
+        self.connection.execute(
+            "create table if not exists namespace_stats (snapshot_time text, database text, collection text, "
+            "size integer, storage_size integer, document_count integer, total_index_size integer, "
+            "index_sizes text)"
+        )
+        self.connection.execute(
+            "create table if not exists shard_stats (snapshot_time text, database text, collection text, "
+            "shard text, size integer, no_of_chunks integer)"
+        )
+        self.connection.commit()
+
+    def save_snapshot(self, all_stats, snapshot_time=None):
+        snapshot_time = (snapshot_time or datetime.now()).isoformat(timespec='seconds')
+        with self.connection:
+            self.connection.executemany(
+                "insert into namespace_stats values (?, ?, ?, ?, ?, ?, ?, ?)",
+                [(snapshot_time, stats["database"], stats["collection"], stats["size"], stats["storage_size"],
+                  stats["document_count"], stats["total_index_size"], json.dumps(stats["index_sizes"]))
+                 for stats in all_stats]
+            )
+            self.connection.executemany(
+                "insert into shard_stats values (?, ?, ?, ?, ?, ?)",
+                [(snapshot_time, stats["database"], stats["collection"], shard, shard_stats["size"],
+                  shard_stats.get("no_of_chunks"))
+                 for stats in all_stats for shard, shard_stats in stats["shards"].items()]
+            )
+        return snapshot_time
+
+    def get_latest_sizes(self, before_time=None):
+        # Returns the size of each namespace in the latest snapshot taken before the provided time
+        query = "select max(snapshot_time) from namespace_stats"
+        params = ()
+        if before_time:
+            query += " where snapshot_time < ?"
+            params = (before_time,)
+        latest_snapshot_time = self.connection.execute(query, params).fetchone()[0]
+        if latest_snapshot_time is None:
+            return None, {}
+        rows = self.connection.execute("select database, collection, size from namespace_stats "
+                                       "where snapshot_time = ?", (latest_snapshot_time,))
+        return latest_snapshot_time, {(database, collection): size for database, collection, size in rows}
+
+    def add_growth(self, all_stats, snapshot_time=None):
+        """
+        Add the growth in size since the previous snapshot to the stats, or None for namespaces that were not present.
+        """
+        previous_snapshot_time, previous_sizes = self.get_latest_sizes(before_time=snapshot_time)
+        if previous_snapshot_time:
+            logger.info(f"Computing growth since the snapshot taken at {previous_snapshot_time}")
+        for stats in all_stats:
+            previous_size = previous_sizes.get((stats["database"], stats["collection"]))
+            stats["size_growth"] = None if previous_size is None else stats["size"] - previous_size
+        return all_stats
+
+    def close(self):
+        self.connection.close()
@@ -4,36 +4,39 @@ import csv
 from ebi_eva_common_pyutils.logger import logging_config
 from pymongo import MongoClient
 
+from tasks.eva_3824.collection_stats import list_namespaces, collect_stats, StatsSnapshotStore
+
 logging_config.add_stdout_handler()
 logger = logging_config.get_logger(__name__)
 
 
-def get_variants_collection_size(db):
-    # Returns the size of the collection 'variants_2_0' if it exists, else 0.
-    if 'variants_2_0' in db.list_collection_names():
-        stats = db.command("collstats", "variants_2_0")
-        return stats.get("size", 0)
-    return 0
-
-
 def main():
     parser = argparse.ArgumentParser(
         description="Sort the MongoDB databases based on the size of the collection variants_2_0")
     parser.add_argument("--mongouri", help="MongoDB URI")
     parser.add_argument("--output_file", help="Output CSV file to save the results")
+    parser.add_argument("--num_workers", type=int, default=8,
+                        help="Number of collections to get the stats of concurrently")
+    parser.add_argument("--snapshot_db", default=None,
+                        help="SQLite file where the sizes are saved at each run to report the growth since the last run")
     args = parser.parse_args()
 
     client = MongoClient(args.mongouri)
-    db_sizes = []
+    all_stats = collect_stats(client, list_namespaces(client, collection_names=['variants_2_0']), args.num_workers)
+    if args.snapshot_db:
+        snapshot_store = StatsSnapshotStore(args.snapshot_db)
+        snapshot_store.add_growth(all_stats)
+        snapshot_store.save_snapshot(all_stats)
+        snapshot_store.close()
 
+    db_sizes = []
+    dbs_with_variants = set()
+    for stats in all_stats:
+        if stats["size"] > 0:
+            db_sizes.append((stats["database"], stats["size"], stats.get("size_growth")))
+            dbs_with_variants.add(stats["database"])
     for db_name in client.list_database_names():
-        if db_name in ['config']:
-            continue
-        db = client[db_name]
-        size = get_variants_collection_size(db)
-        if size > 0:
-            db_sizes.append((db_name, size))
-        else:
+        if db_name not in dbs_with_variants and db_name not in ['config']:
             logger.warn(f"DB {db_name} does not have collection variants_2_0 or it does not contains any variants")
 
     sorted_dbs = sorted(db_sizes, key=lambda x: x[1])
@@ -41,8 +44,11 @@ def main():
     # Write the results to file
     with open(args.output_file, mode='w', newline='') as f:
         writer = csv.writer(f)
-        for db_name, size in sorted_dbs:
-            writer.writerow([db_name, size])
+        for db_name, size, size_growth in sorted_dbs:
+            if args.snapshot_db:
+                writer.writerow([db_name, size, size_growth])
+            else:
+                writer.writerow([db_name, size])
 
 
 if __name__ == "__main__":
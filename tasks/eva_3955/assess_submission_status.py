@@ -1,12 +1,15 @@
+import argparse
 import csv
+import json
 import os
+import signal
 import subprocess
 import sys
-from time import sleep
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import yaml
 from ebi_eva_common_pyutils.logger import logging_config as log_cfg
-from ebi_eva_common_pyutils.command_utils import run_command_with_output
 
 logger = log_cfg.get_logger(__name__)
 
@@ -26,7 +29,19 @@ def delete_eload(eload):
     if not eload_dir:
         logger.error(f'No folder for the specified ELOAD {eload_string}')
 
-def run_qc_submission(eload):
+def run_command_with_timeout(command, timeout):
+    # Run the command in its own process group so that the whole pipeline can be killed on timeout
+    with subprocess.Popen(command, shell=True, start_new_session=True) as process:
+        try:
+            return_code = process.wait(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            os.killpg(process.pid, signal.SIGKILL)
+            raise
+    if return_code != 0:
+        raise subprocess.CalledProcessError(return_code, command)
+
+
+def run_qc_submission(eload, timeout=None):
     log_file = os.path.join(get_eload_folder(eload), 'qc_submission.txt')
     command = f'qc_submission.py --eload {eload} > {log_file}'
 
@@ -39,11 +54,11 @@ def run_qc_submission(eload):
             if checks:
                 already_run = True
     if not already_run:
+        logger.info(f'run qc_submission.py for eload {eload} > {log_file}')
         try:
-            run_command_with_output(f'run qc_submission.py for eload {eload} > {log_file}', command)
+            run_command_with_timeout(command, timeout)
         except subprocess.CalledProcessError:
             return 'FAIL'
-        sleep(1)
 
     config_file = get_eload_config(eload)
     if os.path.isfile(config_file):
@@ -61,16 +76,21 @@ def run_qc_submission(eload):
     else:
         return 'FAIL'
 
-def run_submission_status(eload):
+def run_submission_status(eload, timeout=None):
     log_file = os.path.join(get_eload_folder(eload), 'submission_status.txt')
 
     command = f'submission_status.py --eload {eload} > {log_file}'
     if not os.path.exists(log_file):
+        logger.info(f'run submission_status.py for eload {eload} > {log_file}')
         try:
-            run_command_with_output(f'run submission_status.py for eload {eload} > {log_file}', command)
-        except subprocess.CalledProcessError:
+            run_command_with_timeout(command, timeout)
+        except (subprocess.CalledProcessError, subprocess.TimeoutExpired) as e:
+            # Do not leave a partial log behind as it would be read on the next run
+            if os.path.exists(log_file):
+                os.remove(log_file)
+            if isinstance(e, subprocess.TimeoutExpired):
+                raise
             return 'FAIL'
-        sleep(1)
 
     with open(log_file, 'r') as f:
         for line in f:
@@ -93,54 +113,138 @@ def load_eloads_from_jira(jira_csv):
             status = row.get('Status')
             yield eload, status
 
-def eload_size(eload):
-    log_file = os.path.join(get_eload_folder(eload), 'eload_size.txt')
-    command_sh = f'du -s {get_eload_folder(eload)} >  {log_file}'
-    if not os.path.exists(log_file):
-        run_command_with_output(f'run du for eload {eload} ', command_sh, return_process_output=True)
-        sleep(1)
-    with open(log_file, 'r') as f:
-        text=f.readline().strip()
-        sp_txt = text.split()
-        if len(sp_txt[0]) > 1 and sp_txt[0].isdigit():
-            return sp_txt[0]
-        else:
-            logger.error(f'Could not determine size of eload {eload}')
-            return '0'
+def directory_size(directory, size_cache):
+    """
+    Size in bytes of the disk space used by the directory and its content, like du. The size of the files directly in each directory is
+    cached with the directory mtime, which only changes when entries are added or removed, so that unchanged
+    directories do not need to be scanned again.
+    """
+    directory_stat = os.stat(directory)
+    mtime = directory_stat.st_mtime
+    cached = size_cache.get(directory)
+    if not cached or cached['mtime'] != mtime:
+        files_size = 0
+        subdirectories = []
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirectories.append(entry.path)
+                else:
+                    files_size += entry.stat(follow_symlinks=False).st_blocks * 512
+        cached = size_cache[directory] = {'mtime': mtime, 'files_size': files_size, 'subdirectories': subdirectories}
+    return directory_stat.st_blocks * 512 + cached['files_size'] + \
+        sum(directory_size(subdirectory, size_cache) for subdirectory in cached['subdirectories'])
+
+
+class DirectorySizeCache:
+    """
+    JSON file keeping the cached sizes of the scanned directories, keyed by directory path. It is stored outside of
+    the submission folder so that read-only ELOAD folders can be measured and the cache is never part of the size.
+    """
+
+    def __init__(self, cache_file):
+        self.cache_file = cache_file
+        self.lock = threading.Lock()
+        self.entries = {}
+        if os.path.exists(cache_file):
+            with open(cache_file) as open_file:
+                self.entries = json.load(open_file)
+
+    def get_entries_under(self, directory):
+        with self.lock:
+            return {path: entry for path, entry in self.entries.items()
+                    if path == directory or path.startswith(directory + os.sep)}
+
+    def update(self, entries):
+        with self.lock:
+            self.entries.update(entries)
+            with open(self.cache_file + '.tmp', 'w') as open_file:
+                json.dump(self.entries, open_file)
+            os.replace(self.cache_file + '.tmp', self.cache_file)
+
+
+def eload_size(eload, size_cache):
+    eload_folder = os.path.abspath(get_eload_folder(eload))
+    # Each ELOAD is measured with its own copy of its entries so that concurrent ELOADs do not share a dict
+    eload_entries = size_cache.get_entries_under(eload_folder)
+    try:
+        # Same unit as du -s
+        size = directory_size(eload_folder, eload_entries) // 1024
+    except OSError as e:
+        logger.error(f'Could not determine size of eload {eload}: {e}')
+        return '0'
+    size_cache.update(eload_entries)
+    return str(size)
+
+
+def assess_eload(eload, status, timeout, size_cache):
+    accepted_status = ['Done', 'Cancelled']
+    if not os.path.isdir(get_eload_folder(eload)) or not os.path.isfile(get_eload_config(eload)):
+        return [eload, status, '0', 'NO DIR', 'NO DIR']
+    if status not in accepted_status:
+        return [eload, status, eload_size(eload, size_cache), 'Not completed', 'Not completed']
+    return [eload, status, eload_size(eload, size_cache), run_submission_status(eload, timeout), run_qc_submission(eload, timeout)]
+
+
+def load_completed_results(results_file):
+    # ELOADs already assessed successfully in a previous run, the failed and timed out ones will be retried
+    completed_results = {}
+    if os.path.exists(results_file):
+        with open(results_file) as open_file:
+            for line in open_file:
+                sp_line = line.rstrip('\n').split('\t')
+                if sp_line[-1] == 'OK':
+                    completed_results[sp_line[0]] = sp_line[:-1]
+    return completed_results
 
 
 def main():
+    global submission_folder
+    parser = argparse.ArgumentParser(description='Assess the status of the ELOADs listed in a JIRA export')
+    parser.add_argument('jira_csv', help='CSV export of the JIRA tickets with "Issue key" and "Status" columns')
+    parser.add_argument('--submission_folder', default=submission_folder,
+                        help='Folder containing the ELOAD directories')
+    parser.add_argument('--results_file', default='assess_submission_status_results.tsv',
+                        help='Table where the outcome of each ELOAD is recorded so that the assessment can be resumed. '
+                             'The cached directory sizes are kept next to it in eload_size_cache.json')
+    parser.add_argument('--workers', type=int, default=8, help='Number of ELOADs assessed concurrently')
+    parser.add_argument('--timeout', type=int, default=3600,
+                        help='Maximum time in seconds for each qc_submission.py and submission_status.py run')
+    args = parser.parse_args()
+
+    submission_folder = args.submission_folder
     if not submission_folder:
         print('Provide the submission folder')
         sys.exit(1)
-    accepted_status = ['Done', 'Cancelled']
-    for eload, status in load_eloads_from_jira(sys.argv[1]):
-
-        if status in accepted_status and os.path.isdir(get_eload_folder(eload)) and os.path.isfile(get_eload_config(eload)):
-            results = [
-                eload,
-                status,
-                eload_size(eload),
-                run_submission_status(eload),
-                run_qc_submission(eload)
-            ]
-        elif not os.path.isdir(get_eload_folder(eload)) or not os.path.isfile(get_eload_config(eload)):
-            results = [
-                eload,
-                status,
-                '0',
-                'NO DIR',
-                'NO DIR'
-            ]
-        else:
-            results = [
-                eload,
-                status,
-                eload_size(eload),
-                'Not completed',
-                'Not completed'
-            ]
-        print('\t'.join(results))
+
+    completed_results = load_completed_results(args.results_file)
+    size_cache = DirectorySizeCache(os.path.join(os.path.dirname(os.path.abspath(args.results_file)),
+                                                 'eload_size_cache.json'))
+    eloads_and_status = list(load_eloads_from_jira(args.jira_csv))
+    with open(args.results_file, 'a') as results_handle, ThreadPoolExecutor(max_workers=args.workers) as executor:
+        future_to_eload = {
+            executor.submit(assess_eload, eload, status, args.timeout, size_cache): (eload, status)
+            for eload, status in eloads_and_status if eload not in completed_results
+        }
+        for future in as_completed(future_to_eload):
+            eload, status = future_to_eload[future]
+            try:
+                results = future.result()
+                outcome = 'OK'
+            except subprocess.TimeoutExpired:
+                logger.error(f'Assessment of eload {eload} timed out')
+                results, outcome = [eload, status, '', '', ''], 'TIMEOUT'
+            except Exception as e:
+                logger.error(f'Assessment of eload {eload} failed: {e}')
+                results, outcome = [eload, status, '', '', ''], 'ERROR'
+            results_handle.write('\t'.join(results + [outcome]) + '\n')
+            results_handle.flush()
+            if outcome == 'OK':
+                completed_results[eload] = results
+
+    for eload, status in eloads_and_status:
+        if eload in completed_results:
+            print('\t'.join(completed_results[eload]))
     return
 
 
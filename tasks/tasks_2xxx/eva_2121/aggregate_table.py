@@ -1,6 +1,9 @@
 #!/usr/bin/env python
 import csv
+import fcntl
+import fnmatch
 import glob
+import hashlib
 import json
 import logging
 import os
@@ -13,8 +16,13 @@ import psycopg2
 from ebi_eva_common_pyutils.assembly import NCBIAssembly
 from ebi_eva_common_pyutils.config_utils import get_pg_metadata_uri_for_eva_profile
 from ebi_eva_common_pyutils.logger import logging_config as log_cfg
-from ebi_eva_common_pyutils.pg_utils import get_all_results_for_query
+from ebi_eva_common_pyutils.mongodb import MongoDatabase
 
+from tasks.eva_2121.tempmongo_scheduler import estimate_taxonomy_loads, get_variant_counts_per_assembly_from_mongo, \
+    parse_variant_counts_per_assembly, schedule_taxonomies, write_host_loads
+
+# ioctl request cloning a file on Linux (see ioctl_ficlone(2))
+FICLONE = 0x40049409
 assigned_number_variant = 0
 number_of_tempmongo_instances = 10
 eva_accession_path = ''
@@ -98,45 +106,155 @@ def assign_tempmongo_host_round_robin(number_variants, total_number_of_variant):
     return 'tempmongo-' + str(instance_number)
 
 
-def look_for_assembly_file(assembly_path, scientific_name, assembly_accession, pattern):
-    accession_dir = os.path.join(
-        assembly_path,
-        scientific_name.lower().replace(' ', '_'),
-        assembly_accession
-    )
-    file_paths = glob.glob(os.path.join(accession_dir, pattern))
-    if len(file_paths) == 1:
-        logger.debug('Found a single file in %s with pattern %s: %s', accession_dir, pattern, file_paths[0])
-        return file_paths[0]
-    else:
-        logger.debug('Cannot find a single file in %s with pattern %s. Found %s', accession_dir, pattern, len(file_paths))
-
-
-def search_for_assembly_in_dir(scientific_name, assembly_accession, assembly_search_paths):
-    fasta, report = None, None
-    for assembly_search_path in assembly_search_paths:
-
-        if not fasta:
-            fasta = look_for_assembly_file(assembly_search_path, scientific_name, assembly_accession, assembly_accession + '_custom.fa')
-        if not fasta:
-            fasta = look_for_assembly_file(assembly_search_path, scientific_name, assembly_accession, assembly_accession + '.fa')
-        if not fasta:
-            fasta = look_for_assembly_file(assembly_search_path, scientific_name, assembly_accession, '*.fa')
-        if not fasta:
-            fasta = look_for_assembly_file(assembly_search_path, scientific_name, assembly_accession, '*.fna')
-        if not report:
-            report = look_for_assembly_file(assembly_search_path, scientific_name, 'dbsnp_import', '*_custom_assembly_report.txt')
-        if not report:
-            report = look_for_assembly_file(assembly_search_path, scientific_name, 'dbsnp_import', '*_assembly_report_CUSTOM.txt')
-        if not report:
-            report = look_for_assembly_file(assembly_search_path, scientific_name, assembly_accession, '*_assembly_report.txt')
-
-    if fasta and report:
-        logger.info('Found Assembly fasta and report for %s, %s', scientific_name, assembly_accession)
-        logger.info('fasta file: %s', fasta)
-        logger.info('report file: %s', report)
+class AssemblyLocator:
+    """
+    Index of the files found in <assembly_dir>/<species>/<accession or dbsnp_import>/ for all the assembly
+    directories, built with a single scan so that locating the fasta and report of an assembly does not touch the
+    filesystem again.
+    """
 
-    return fasta, report
+    fasta_patterns = ['{accession}_custom.fa', '{accession}.fa', '*.fa', '*.fna']
+    # Each report pattern is searched in the dbsnp_import or in the assembly accession directory
+    report_patterns = [('dbsnp_import', '*_custom_assembly_report.txt'),
+                       ('dbsnp_import', '*_assembly_report_CUSTOM.txt'),
+                       (None, '*_assembly_report.txt')]
+
+    def __init__(self, assembly_search_paths):
+        self.assembly_search_paths = assembly_search_paths
+        self.files_per_dir = {}
+        for assembly_search_path in assembly_search_paths:
+            self._scan(assembly_search_path)
+        logger.info('Indexed %s assembly directories in %s', len(self.files_per_dir),
+                    ', '.join(assembly_search_paths))
+
+    def _scan(self, assembly_search_path):
+        if not os.path.isdir(assembly_search_path):
+            return
+        for species_entry in os.scandir(assembly_search_path):
+            if not species_entry.is_dir():
+                continue
+            for accession_entry in os.scandir(species_entry.path):
+                if accession_entry.is_dir():
+                    self.files_per_dir[accession_entry.path] = sorted(
+                        entry.name for entry in os.scandir(accession_entry.path) if entry.is_file()
+                    )
+
+    def look_for_assembly_file(self, assembly_path, scientific_name, assembly_accession, pattern):
+        accession_dir = os.path.join(
+            assembly_path,
+            scientific_name.lower().replace(' ', '_'),
+            assembly_accession
+        )
+        file_names = fnmatch.filter(self.files_per_dir.get(accession_dir, []), pattern)
+        if len(file_names) == 1:
+            logger.debug('Found a single file in %s with pattern %s: %s', accession_dir, pattern, file_names[0])
+            return os.path.join(accession_dir, file_names[0])
+        else:
+            logger.debug('Cannot find a single file in %s with pattern %s. Found %s', accession_dir, pattern,
+                         len(file_names))
+
+    def search(self, scientific_name, assembly_accession):
+        fasta, report = None, None
+        for assembly_search_path in self.assembly_search_paths:
+            for pattern in self.fasta_patterns:
+                if not fasta:
+                    fasta = self.look_for_assembly_file(assembly_search_path, scientific_name, assembly_accession,
+                                                        pattern.format(accession=assembly_accession))
+            for directory, pattern in self.report_patterns:
+                if not report:
+                    report = self.look_for_assembly_file(assembly_search_path, scientific_name,
+                                                         directory or assembly_accession, pattern)
+
+        if fasta and report:
+            logger.info('Found Assembly fasta and report for %s, %s', scientific_name, assembly_accession)
+            logger.info('fasta file: %s', fasta)
+            logger.info('report file: %s', report)
+
+        return fasta, report
+
+
+def md5_checksum(file_path):
+    md5 = hashlib.md5()
+    with open(file_path, 'rb') as open_file:
+        for chunk in iter(lambda: open_file.read(1024 * 1024), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def reflink(source, destination):
+    """Clone the source file into destination sharing its blocks, on filesystems that support it (btrfs, xfs)."""
+    with open(source, 'rb') as source_file, open(destination, 'wb') as destination_file:
+        try:
+            fcntl.ioctl(destination_file.fileno(), FICLONE, source_file.fileno())
+        except OSError:
+            destination_file.close()
+            os.remove(destination)
+            raise
+
+
+def copy_with_checksum(source, destination):
+    """
+    Copy the source file into destination, computing the checksum of the source while it is read, then verify the
+    size and checksum of the file written.
+    """
+    source_md5 = hashlib.md5()
+    with open(source, 'rb') as source_file, open(destination, 'wb') as destination_file:
+        for chunk in iter(lambda: source_file.read(1024 * 1024), b''):
+            source_md5.update(chunk)
+            destination_file.write(chunk)
+    shutil.copystat(source, destination)
+    if os.path.getsize(source) != os.path.getsize(destination) or \
+            source_md5.hexdigest() != md5_checksum(destination):
+        os.remove(destination)
+        raise ValueError('Copy {} differs from its source {}'.format(destination, source))
+
+
+def is_staged(source, destination, allow_hardlink):
+    # Copies keep the size and modification time of their source, hardlinks staged before are replaced by a copy
+    # unless they are allowed
+    if not os.path.exists(destination):
+        return False
+    if os.path.samefile(source, destination):
+        return allow_hardlink
+    source_stat, destination_stat = os.stat(source), os.stat(destination)
+    return source_stat.st_size == destination_stat.st_size and source_stat.st_mtime == destination_stat.st_mtime
+
+
+def stage_file(source, destination, allow_hardlink=False):
+    """
+    Make an independent copy of the source file at destination, so that the staged file can be modified in place
+    without altering the source: reflink on filesystems that support it, otherwise a full copy verified against the
+    source size and checksum. Reflinks share the blocks of the source so only their size is checked. With
+    allow_hardlink, a hardlink sharing the source file is tried first.
+    Returns the method used.
+    """
+    if is_staged(source, destination, allow_hardlink):
+        logger.debug('%s is already staged in %s', source, destination)
+        return 'existing'
+    tmp_destination = destination + '.tmp'
+    if os.path.lexists(tmp_destination):
+        os.remove(tmp_destination)
+    method = None
+    if allow_hardlink:
+        try:
+            os.link(source, tmp_destination)
+            method = 'hardlink'
+        except OSError:
+            pass
+    if not method:
+        try:
+            reflink(source, tmp_destination)
+            shutil.copystat(source, tmp_destination)
+            method = 'reflink'
+        except OSError:
+            copy_with_checksum(source, tmp_destination)
+            method = 'copy'
+        if method == 'reflink' and os.path.getsize(source) != os.path.getsize(tmp_destination):
+            os.remove(tmp_destination)
+            raise ValueError('Size of {} differs from its source {}'.format(tmp_destination, source))
+    os.replace(tmp_destination, destination)
+    logger.info('Staged %s in %s using a %s', source, destination, method)
+    return method
 
 
 def download_assembly(scientific_name, assembly_accession, download_dir, assembly_report=None):
@@ -163,13 +281,13 @@ def count_variants(rows, only_variant_to_process=True):
 
 
 def prepare_location_of_report_and_fasta(path_per_assemblies_from_release1, assembly, scientific_name, download_dir,
-                                         assembly_dirs, release2_reference_folder):
+                                         assembly_locator, release2_reference_folder, hardlink_genomes=False):
     # First check previous release for a suitable assembly
     fasta, report = path_per_assemblies_from_release1.get(assembly, (None, None))
 
     # If not found then search for existing assembly in different directories
     if not report or not os.path.isfile(report):
-        fasta, report = search_for_assembly_in_dir(scientific_name, assembly, assembly_dirs)
+        fasta, report = assembly_locator.search(scientific_name, assembly)
     else:
         logger.info('Found Assembly fasta and report for %s, %s In RELEASE1', scientific_name, assembly)
         logger.info('fasta file: %s', fasta)
@@ -184,21 +302,68 @@ def prepare_location_of_report_and_fasta(path_per_assemblies_from_release1, asse
 
     assembly_folder = os.path.join(release2_reference_folder, scientific_name.lower().replace(' ', '_'), assembly)
     os.makedirs(assembly_folder, exist_ok=True)
-    shutil.copyfile(fasta, os.path.join(assembly_folder, assembly + '.fa'))
-    shutil.copyfile(report, os.path.join(assembly_folder, assembly + '_assembly_report.txt'))
+    stage_file(fasta, os.path.join(assembly_folder, assembly + '.fa'), allow_hardlink=hardlink_genomes)
+    stage_file(report, os.path.join(assembly_folder, assembly + '_assembly_report.txt'),
+               allow_hardlink=hardlink_genomes)
     return os.path.join(assembly_folder, assembly + '.fa'), os.path.join(assembly_folder, assembly + '_assembly_report.txt')
 
 
-def get_dbsnp_database_name(pg_conn, scientific_name):
-    query = "select database_name from dbsnp_ensembl_species.import_progress where scientific_name='{}';"
-    database_names = list(set([database_name for database_name, in get_all_results_for_query(pg_conn, query.format(scientific_name))]))
-    assert len(database_names) < 2, "Species {} has more than one database associated: {}".format(scientific_name, database_names)
-    if database_names:
-        return database_names[0]
+def get_dbsnp_database_names(pg_conn, scientific_names):
+    """Returns the dbSNP database associated with each of the species that have one, using a single query."""
+    query = ("select distinct scientific_name, database_name from dbsnp_ensembl_species.import_progress "
+             "where scientific_name in %s;")
+    database_names_per_species = defaultdict(list)
+    if scientific_names:
+        with pg_conn.cursor() as cursor:
+            cursor.execute(query, (tuple(set(scientific_names)),))
+            for scientific_name, database_name in cursor.fetchall():
+                database_names_per_species[scientific_name].append(database_name)
+    for scientific_name, database_names in database_names_per_species.items():
+        assert len(database_names) < 2, "Species {} has more than one database associated: {}".format(scientific_name, database_names)
+    return {scientific_name: database_names[0] for scientific_name, database_names in database_names_per_species.items()}
+
+
+def get_tempmongo_hosts():
+    return ['tempmongo-' + str(instance_number) for instance_number in range(1, number_of_tempmongo_instances + 1)]
+
+
+def assign_tempmongo_hosts(data_per_taxid_and_assembly, taxids_to_copy, size_table=None,
+                           mongo_source=None, max_disk_per_host=None, max_memory_per_host=None,
+                           output_tempmongo_load_tsv=None):
+    """
+    Spread the taxonomies to copy across the tempmongo hosts according to their estimated load. The number of
+    variants per assembly comes from the size table, the accessioning database or the input counts in that order.
+    """
+    assemblies_per_taxid = {
+        taxid: [assembly for t, assembly in data_per_taxid_and_assembly if t == taxid and assembly != 'Unmapped']
+        for taxid in taxids_to_copy
+    }
+    if size_table:
+        counts_per_assembly = parse_variant_counts_per_assembly(size_table)
+    elif mongo_source:
+        counts_per_assembly = get_variant_counts_per_assembly_from_mongo(
+            mongo_source, [assembly for assemblies in assemblies_per_taxid.values() for assembly in assemblies]
+        )
+    else:
+        counts_per_assembly = {}
+        for taxid in taxids_to_copy:
+            for assembly in assemblies_per_taxid[taxid]:
+                counts_per_assembly[assembly] = (count_variants(data_per_taxid_and_assembly[(taxid, assembly)]), 0)
+    loads = estimate_taxonomy_loads(assemblies_per_taxid, counts_per_assembly)
+    taxid_to_tempmongo, host_loads = schedule_taxonomies(loads, get_tempmongo_hosts(), max_disk_per_host,
+                                                         max_memory_per_host)
+    for host, load in host_loads.items():
+        logger.info('%s: %s taxonomies, %s documents, %s bytes on disk', host, load['taxonomies'],
+                    load['documents'], load['disk'])
+    if output_tempmongo_load_tsv:
+        write_host_loads(host_loads, output_tempmongo_load_tsv, max_disk_per_host, max_memory_per_host)
+    return taxid_to_tempmongo
 
 
 def aggregate_list_of_species(input_file, properties_path, assembly_dirs, download_dir, release2_reference_folder,
-                              output_assemblies_tsv, output_taxonmomy_tsv, private_config_xml_file):
+                              output_assemblies_tsv, output_taxonmomy_tsv, private_config_xml_file, size_table=None,
+                              mongo_source=None, max_disk_per_host=None, max_memory_per_host=None,
+                              output_tempmongo_load_tsv=None, round_robin=False, hardlink_genomes=False):
     data_per_taxid, data_per_taxid_and_assembly = parse_input(input_file)
     only_unmapped_tax_id = []
     unchanged_taxid = []
@@ -229,6 +394,13 @@ def aggregate_list_of_species(input_file, properties_path, assembly_dirs, downlo
         else:
             mixture.append(taxid)
 
+    if not round_robin:
+        taxid_to_tempmongo = assign_tempmongo_hosts(
+            data_per_taxid_and_assembly,
+            [taxid for taxid in data_per_taxid if taxid not in unchanged_taxid + only_unmapped_tax_id],
+            size_table, mongo_source, max_disk_per_host, max_memory_per_host, output_tempmongo_load_tsv
+        )
+
     # Iterate a second time to assign a temp mongodb per taxonomy
     with open(output_taxonmomy_tsv, 'w') as open_output:
         headers = ['taxonomy_id', 'scientific_name', 'tempmongo_instance', 'should_be_copied',
@@ -239,8 +411,9 @@ def aggregate_list_of_species(input_file, properties_path, assembly_dirs, downlo
             rows = data_per_taxid[taxid]
             scientific_name = {row['Scientific Name From Taxid'] for row in rows}.pop()
             number_variants_to_process = count_variants(rows)
-            taxid_to_tempmongo[taxid] = assign_tempmongo_host_round_robin(number_variants_to_process,
-                                                                          total_number_variant)
+            if round_robin:
+                taxid_to_tempmongo[taxid] = assign_tempmongo_host_round_robin(number_variants_to_process,
+                                                                              total_number_variant)
 
             if taxid in unchanged_taxid + only_unmapped_tax_id:
                 to_copy = 'no'
@@ -259,10 +432,14 @@ def aggregate_list_of_species(input_file, properties_path, assembly_dirs, downlo
             ]), file=open_output)
 
     path_per_assemblies_from_release1 = resolve_fasta_and_report_path_from_release1(properties_path)
+    assembly_locator = AssemblyLocator(assembly_dirs)
 
     pg_conn = psycopg2.connect(
         get_pg_metadata_uri_for_eva_profile("development", private_config_xml_file), user="evadev"
     )
+    dbsnp_database_names = get_dbsnp_database_names(pg_conn, [
+        {row['Scientific Name From Taxid'] for row in rows}.pop() for rows in data_per_taxid_and_assembly.values()
+    ])
 
     with open(output_assemblies_tsv, 'w') as open_output:
         headers = ['taxonomy_id', 'scientific_name', 'assembly', 'sources', 'fasta_path', 'report_path',
@@ -272,7 +449,7 @@ def aggregate_list_of_species(input_file, properties_path, assembly_dirs, downlo
         for taxid, assembly in data_per_taxid_and_assembly:
             rows = data_per_taxid_and_assembly[(taxid, assembly)]
             scientific_name = {row['Scientific Name From Taxid'] for row in rows}.pop()
-            dbsnps_database_name = get_dbsnp_database_name(pg_conn, scientific_name) or ''
+            dbsnps_database_name = dbsnp_database_names.get(scientific_name) or ''
 
             if taxid in unchanged_taxid + only_unmapped_tax_id or assembly == 'Unmapped':
                 to_process = 'no'
@@ -281,7 +458,7 @@ def aggregate_list_of_species(input_file, properties_path, assembly_dirs, downlo
                 to_process = 'yes'
                 fasta, report = prepare_location_of_report_and_fasta(
                     path_per_assemblies_from_release1, assembly, scientific_name,  download_dir,
-                    assembly_dirs, release2_reference_folder
+                    assembly_locator, release2_reference_folder, hardlink_genomes
                 )
                 temp_mongo = taxid_to_tempmongo[taxid]
 
@@ -304,6 +481,7 @@ def aggregate_list_of_species(input_file, properties_path, assembly_dirs, downlo
     pg_conn.close()
 
 def main():
+    global eva_accession_path, number_of_tempmongo_instances
     argparse = ArgumentParser()
     argparse.add_argument('--input', help='Path to the file containing the taxonomies and assemblies', required=True)
     argparse.add_argument('--properties_dir', help='Path to the directory where the release1 application.properties are stored', required=True)
@@ -314,6 +492,24 @@ def main():
     argparse.add_argument('--output_taxonomy_tsv', help='Path to the tsv file that will contain the list of species to process', required=True)
     argparse.add_argument('--eva_accession_path', help='path to the directory that contain eva-accession code and private json file.')
     argparse.add_argument("--private_config_xml_file", help="ex: /path/to/eva-maven-settings.xml", required=True)
+    argparse.add_argument('--size_table',
+                          help='Path to a tsv file with the number of variants per assembly (columns assembly, '
+                               'number_sve and number_cve) used to balance the tempmongo hosts')
+    argparse.add_argument('--mongo_source_uri',
+                          help='Mongo Source URI of the accessioning database to count the variants per assembly')
+    argparse.add_argument('--mongo_source_secrets_file', help='Full path to the Mongo Source secrets file')
+    argparse.add_argument('--number_of_tempmongo_instances', type=int, default=number_of_tempmongo_instances,
+                          help='Number of tempmongo hosts available')
+    argparse.add_argument('--max_disk_per_host', type=int, help='Disk space available on each tempmongo host in bytes')
+    argparse.add_argument('--max_memory_per_host', type=int, help='Memory available on each tempmongo host in bytes')
+    argparse.add_argument('--output_tempmongo_load_tsv',
+                          help='Path to the tsv file that will contain the projected load of each tempmongo host')
+    argparse.add_argument('--round_robin', action='store_true', default=False,
+                          help='Assign the tempmongo hosts in round robin instead of balancing their load')
+    argparse.add_argument('--hardlink_genomes', action='store_true', default=False,
+                          help='Stage the fasta and report with hardlinks when possible. By default they are reflinked '
+                               'or, where the filesystem does not support reflinks, fully copied. Hardlinks are only '
+                               'safe if the staged files are never modified in place')
     argparse.add_argument('--debug', help='Set login level to debug', action='store_true', default=False)
 
     args = argparse.parse_args()
@@ -321,12 +517,19 @@ def main():
     if args.debug:
         log_cfg.set_log_level(level=logging.DEBUG)
 
-    global eva_accession_path
     if args.eva_accession_path:
             eva_accession_path = args.eva_accession_path
-    
+    number_of_tempmongo_instances = args.number_of_tempmongo_instances
+
+    mongo_source = None
+    if args.mongo_source_uri:
+        mongo_source = MongoDatabase(uri=args.mongo_source_uri, secrets_file=args.mongo_source_secrets_file,
+                                     db_name="eva_accession_sharded")
+
     aggregate_list_of_species(args.input, args.properties_dir, args.assembly_dirs, args.download_dir, args.release2_reference_folder,
-                              args.output_assemblies_tsv, args.output_taxonomy_tsv, args.private_config_xml_file)
+                              args.output_assemblies_tsv, args.output_taxonomy_tsv, args.private_config_xml_file,
+                              args.size_table, mongo_source, args.max_disk_per_host, args.max_memory_per_host,
+                              args.output_tempmongo_load_tsv, args.round_robin, args.hardlink_genomes)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,104 @@
+import csv
+from collections import defaultdict
+
+from ebi_eva_common_pyutils.logger import logging_config as log_cfg
+
+logger = log_cfg.get_logger(__name__)
+
+sve_collections = ['submittedVariantEntity', 'dbsnpSubmittedVariantEntity']
+cve_collections = ['clusteredVariantEntity', 'dbsnpClusteredVariantEntity']
+
+# Rough size of a document and of its index entries in the tempmongo instances
+default_bytes_per_sve = 700
+default_bytes_per_cve = 400
+default_index_bytes_per_document = 120
+
+
+def get_variant_counts_per_assembly_from_mongo(mongo_source, assemblies):
+    """Returns the number of submitted and clustered variants of each assembly in the accessioning database."""
+    counts = defaultdict(lambda: [0, 0])
+    for collections, assembly_field, index in [(sve_collections, 'seq', 0), (cve_collections, 'asm', 1)]:
+        for collection in collections:
+            logger.info('Counting documents per assembly in %s', collection)
+            pipeline = [
+                {'$match': {assembly_field: {'$in': list(assemblies)}}},
+                {'$group': {'_id': '$' + assembly_field, 'count': {'$sum': 1}}}
+            ]
+            for result in mongo_source.mongo_handle[mongo_source.db_name][collection].aggregate(pipeline,
+                                                                                              allowDiskUse=True):
+                counts[result['_id']][index] += result['count']
+    return {assembly: tuple(sve_cve) for assembly, sve_cve in counts.items()}
+
+
+def parse_variant_counts_per_assembly(size_table):
+    """Parse a tsv file with the columns assembly, number_sve and number_cve."""
+    counts = {}
+    with open(size_table) as open_file:
+        for row in csv.DictReader(open_file, delimiter='\t'):
+            counts[row['assembly']] = (int(row['number_sve']), int(row['number_cve']))
+    return counts
+
+
+def estimate_taxonomy_loads(assemblies_per_taxid, counts_per_assembly, bytes_per_sve=default_bytes_per_sve,
+                            bytes_per_cve=default_bytes_per_cve,
+                            index_bytes_per_document=default_index_bytes_per_document):
+    """
+    Estimate the load each taxonomy puts on a tempmongo from the variants of its assemblies: the number of documents
+    drives the processing time, the data and indexes the disk usage and the indexes the memory usage.
+    """
+    loads = {}
+    for taxid, assemblies in assemblies_per_taxid.items():
+        number_sve = sum(counts_per_assembly.get(assembly, (0, 0))[0] for assembly in assemblies)
+        number_cve = sum(counts_per_assembly.get(assembly, (0, 0))[1] for assembly in assemblies)
+        index_bytes = (number_sve + number_cve) * index_bytes_per_document
+        loads[taxid] = {
+            'documents': number_sve + number_cve,
+            'disk': number_sve * bytes_per_sve + number_cve * bytes_per_cve + index_bytes,
+            'memory': index_bytes
+        }
+    return loads
+
+
+def schedule_taxonomies(loads, hosts, max_disk_per_host=None, max_memory_per_host=None):
+    """
+    Assign each taxonomy to a host using the longest-processing-time-first heuristic: taxonomies are taken from the
+    largest to the smallest and each one goes to the least loaded host that still has the disk and memory for it.
+    When no host can fit a taxonomy it goes to the least loaded host and a warning is logged.
+    Returns the host of each taxonomy and the projected load of each host.
+    """
+    host_loads = {host: {'documents': 0, 'disk': 0, 'memory': 0, 'taxonomies': 0} for host in hosts}
+    assignment = {}
+
+    def fits(host, load):
+        return (
+            (max_disk_per_host is None or host_loads[host]['disk'] + load['disk'] <= max_disk_per_host) and
+            (max_memory_per_host is None or host_loads[host]['memory'] + load['memory'] <= max_memory_per_host)
+        )
+
+    # Sort on the taxid as well so that the assignment is the same from one run to the next
+    for taxid, load in sorted(loads.items(), key=lambda item: (-item[1]['documents'], str(item[0]))):
+        candidate_hosts = [host for host in hosts if fits(host, load)]
+        if not candidate_hosts:
+            logger.warning('No tempmongo host has the capacity for taxonomy %s (%s documents, %s bytes on disk): '
+                           'assigning it to the least loaded host', taxid, load['documents'], load['disk'])
+            candidate_hosts = hosts
+        host = min(candidate_hosts, key=lambda h: (host_loads[h]['documents'], hosts.index(h)))
+        assignment[taxid] = host
+        for key in ['documents', 'disk', 'memory']:
+            host_loads[host][key] += load[key]
+        host_loads[host]['taxonomies'] += 1
+    return assignment, host_loads
+
+
+def write_host_loads(host_loads, output_tsv, max_disk_per_host=None, max_memory_per_host=None):
+    with open(output_tsv, 'w') as open_output:
+        headers = ['tempmongo_instance', 'number_of_taxonomies', 'number_of_documents', 'projected_disk_bytes',
+                   'projected_memory_bytes', 'over_capacity']
+        print('\t'.join(headers), file=open_output)
+        for host, load in host_loads.items():
+            over_capacity = (
+                (max_disk_per_host is not None and load['disk'] > max_disk_per_host) or
+                (max_memory_per_host is not None and load['memory'] > max_memory_per_host)
+            )
+            print('\t'.join([host, str(load['taxonomies']), str(load['documents']), str(load['disk']),
+                             str(load['memory']), 'yes' if over_capacity else 'no']), file=open_output)
@@ -1,4 +1,7 @@
+import os
+import tempfile
 from unittest import TestCase
+from unittest.mock import patch
 
 from tasks.eva_2121 import aggregate_table
 
@@ -34,3 +37,58 @@ class TestAggregateTable(TestCase):
         assert aggregate_table.assign_tempmongo_host_round_robin(10, total_number_variants) == 'tempmongo-4'
         assert aggregate_table.assign_tempmongo_host_round_robin(10, total_number_variants) == 'tempmongo-4'
         assert aggregate_table.assign_tempmongo_host_round_robin(10, total_number_variants) == 'tempmongo-4'
+
+    def test_assembly_locator(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            assembly_dir1 = os.path.join(tmp_dir, 'genomes1')
+            assembly_dir2 = os.path.join(tmp_dir, 'genomes2')
+            files = [
+                (assembly_dir1, 'GCA_000001.1', 'GCA_000001.1.fa'),
+                (assembly_dir2, 'GCA_000001.1', 'GCA_000001.1_assembly_report.txt'),
+                (assembly_dir2, 'GCA_000001.1', 'GCA_000001.1_custom.fa'),
+                (assembly_dir2, 'dbsnp_import', 'GCA_000001.1_custom_assembly_report.txt'),
+                (assembly_dir1, 'GCA_000002.1', 'genome1.fa'),
+                (assembly_dir1, 'GCA_000002.1', 'genome2.fa'),
+            ]
+            for assembly_dir, sub_dir, file_name in files:
+                os.makedirs(os.path.join(assembly_dir, 'gallus_gallus', sub_dir), exist_ok=True)
+                open(os.path.join(assembly_dir, 'gallus_gallus', sub_dir, file_name), 'w').close()
+
+            locator = aggregate_table.AssemblyLocator([assembly_dir1, assembly_dir2])
+            assert locator.search('Gallus gallus', 'GCA_000001.1') == (
+                os.path.join(assembly_dir1, 'gallus_gallus', 'GCA_000001.1', 'GCA_000001.1.fa'),
+                os.path.join(assembly_dir2, 'gallus_gallus', 'dbsnp_import', 'GCA_000001.1_custom_assembly_report.txt')
+            )
+            # Several fasta files match: none is selected
+            assert locator.search('Gallus gallus', 'GCA_000002.1')[0] is None
+            assert locator.search('Bos taurus', 'GCA_000001.1') == (None, None)
+
+    def test_stage_file(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            source = os.path.join(tmp_dir, 'source.fa')
+            with open(source, 'w') as open_file:
+                open_file.write('>chr1\nACGT\n')
+            destination = os.path.join(tmp_dir, 'staged.fa')
+            assert aggregate_table.stage_file(source, destination) in ('reflink', 'copy')
+            assert not os.path.samefile(source, destination)
+            assert aggregate_table.stage_file(source, destination) == 'existing'
+            # Appending to the staged file leaves the source untouched
+            with open(destination, 'a') as open_file:
+                open_file.write('>chr2\nTTTT\n')
+            with open(source) as open_file:
+                assert open_file.read() == '>chr1\nACGT\n'
+
+            hardlinked = os.path.join(tmp_dir, 'hardlinked.fa')
+            assert aggregate_table.stage_file(source, hardlinked, allow_hardlink=True) == 'hardlink'
+            assert os.path.samefile(source, hardlinked)
+            assert aggregate_table.stage_file(source, hardlinked, allow_hardlink=True) == 'existing'
+            # A copy that differs from its source is rejected
+            with patch.object(aggregate_table, 'reflink', side_effect=OSError), \
+                    patch.object(aggregate_table, 'md5_checksum', return_value='corrupted'):
+                with self.assertRaises(ValueError):
+                    aggregate_table.stage_file(source, os.path.join(tmp_dir, 'corrupted.fa'))
+            assert not os.path.exists(os.path.join(tmp_dir, 'corrupted.fa.tmp'))
+
+            # A hardlink staged before is replaced by a copy when hardlinks are not allowed
+            assert aggregate_table.stage_file(source, hardlinked) in ('reflink', 'copy')
+            assert not os.path.samefile(source, hardlinked)
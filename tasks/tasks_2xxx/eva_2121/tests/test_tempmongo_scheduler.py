@@ -0,0 +1,37 @@
+from unittest import TestCase
+
+from tasks.eva_2121.tempmongo_scheduler import estimate_taxonomy_loads, schedule_taxonomies
+
+
+class TestTempmongoScheduler(TestCase):
+
+    def test_estimate_taxonomy_loads(self):
+        counts_per_assembly = {'GCA_000002315.5': (100, 50), 'GCA_000002315.3': (10, 5)}
+        loads = estimate_taxonomy_loads({'9031': ['GCA_000002315.5', 'GCA_000002315.3'], '9913': ['GCA_000003055.5']},
+                                        counts_per_assembly, bytes_per_sve=10, bytes_per_cve=5,
+                                        index_bytes_per_document=1)
+        assert loads == {
+            '9031': {'documents': 165, 'disk': 1100 + 275 + 165, 'memory': 165},
+            '9913': {'documents': 0, 'disk': 0, 'memory': 0}
+        }
+
+    def test_schedule_taxonomies_longest_first(self):
+        loads = {taxid: {'documents': documents, 'disk': documents, 'memory': 0}
+                 for taxid, documents in [('9913', 90), ('9031', 80), ('9823', 30), ('9940', 20), ('8030', 10)]}
+        assignment, host_loads = schedule_taxonomies(loads, ['tempmongo-1', 'tempmongo-2'])
+        assert assignment == {'9913': 'tempmongo-1', '9031': 'tempmongo-2', '9823': 'tempmongo-2',
+                              '9940': 'tempmongo-1', '8030': 'tempmongo-1'}
+        assert host_loads['tempmongo-1']['documents'] == 120
+        assert host_loads['tempmongo-2']['documents'] == 110
+
+    def test_schedule_taxonomies_with_caps(self):
+        loads = {taxid: {'documents': documents, 'disk': documents, 'memory': 0}
+                 for taxid, documents in [('9913', 90), ('9031', 80), ('9823', 30)]}
+        assignment, host_loads = schedule_taxonomies(loads, ['tempmongo-1', 'tempmongo-2', 'tempmongo-3'],
+                                                     max_disk_per_host=100)
+        # Neither of the loaded hosts has the capacity for 9823
+        assert assignment == {'9913': 'tempmongo-1', '9031': 'tempmongo-2', '9823': 'tempmongo-3'}
+
+        # Nothing fits: the taxonomy still goes to the least loaded host
+        assignment, host_loads = schedule_taxonomies(loads, ['tempmongo-1', 'tempmongo-2'], max_disk_per_host=50)
+        assert assignment == {'9913': 'tempmongo-1', '9031': 'tempmongo-2', '9823': 'tempmongo-2'}
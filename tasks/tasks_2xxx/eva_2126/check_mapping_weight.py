@@ -1,5 +1,9 @@
 #!/usr/bin/env python
+import json
 from argparse import ArgumentParser
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from csv import DictWriter
 from urllib.parse import quote_plus
 
 import pymongo
@@ -13,81 +17,129 @@ def get_mongo_connection_handle(host, port=27017, username=None, password=None,
     return pymongo.MongoClient(mongo_connection_uri, **kwargs)
 
 
-def check_mapping_weight(mongo_host, database_name, username, password, assembly_accession):
+def get_accession_counts(accessioning_mongo_handle, database_name, assembly_accession):
     """
-    Connect to mongodb and retrieve all clustered variants of specific assembly that have high mapping weight (>1) to check
-    if they can be found multiple times. When they can't, check that they fall in one of the following categories:
-     - One or several clustered variants have been merged with another variant
-     - One or several submitted variants have been declustered (because its definition in dbsnp was inconsistent) leaving
-     a clustered variant without evidence
+    Count in one aggregation, for each accession of the assembly, the number of clustered variants, the number of
+    them with a mapping weight greater than 1 or without mapping weight, and the highest mapping weight.
+    Only the accessions relevant to one of the checks are returned.
     """
-    with get_mongo_connection_handle(mongo_host, username=username, password=password) as accessioning_mongo_handle:
-        dbsnp_cve_collection = accessioning_mongo_handle[database_name]["dbsnpClusteredVariantEntity"]
-        cursor = dbsnp_cve_collection.find({'asm': assembly_accession, 'mapWeight': {'$gt': 1}}, no_cursor_timeout=True)
-        count_clustered_variants = 0
-        list_variants_inconsistent = []
-        inconsistent_recovered_merged = 0
-        inconsistent_recovered_declusted = 0
-        for variant in cursor:
-            count = dbsnp_cve_collection.count({'asm': assembly_accession, 'accession': variant['accession']})
-            count_clustered_variants += 1
-            if count < 2:
-                list_variants_inconsistent.append(variant)
-
-        dbsnp_cve_op_collection = accessioning_mongo_handle[database_name]["dbsnpClusteredVariantOperationEntity"]
-        dbsnp_sve_op_collection = accessioning_mongo_handle[database_name]["dbsnpSubmittedVariantOperationEntity"]
-        try:
-            for variant in list_variants_inconsistent:
-                merged_cve_operation = list(dbsnp_cve_op_collection.find({'accession': variant['accession'], 'eventType': 'MERGED'}))
-                updated_sve_operation = list(dbsnp_sve_op_collection.find({'inactiveObjects.rs': variant['accession'], 'eventType': 'UPDATED'}))
-
-                if merged_cve_operation:
-                    inconsistent_recovered_merged += 1
-                elif updated_sve_operation and any([op['reason'].startswith('Declustered:') for op in updated_sve_operation]):
-                    inconsistent_recovered_declusted += 1
-                else:
-                    print(
-                        "rs%s Should have more than 1 variant because mapWeight = %s" % (
-                        str(variant['accession']), variant['mapWeight'])
-                    )
-                    print("Found %s operation for clustered variants" % len(merged_cve_operation))
-                    print("Found %s operation for submitted variants" % len(updated_sve_operation))
-        except:
-            pass
-        finally:
-            cursor.close()
-
-        print("Checked %s clustered variants" % count_clustered_variants)
-        print("Found %s inconsistent variants" % len(list_variants_inconsistent))
-        print("Found %s inconsistent variants that are due to merged" % inconsistent_recovered_merged)
-        print("Found %s inconsistent variants that are due to declustering" % inconsistent_recovered_declusted)
-
-
-def check_variant_counts(mongo_host, database_name, username, password, assembly_accession):
+    dbsnp_cve_collection = accessioning_mongo_handle[database_name]["dbsnpClusteredVariantEntity"]
+    return dbsnp_cve_collection.aggregate(
+        [
+            {"$match": {"asm": assembly_accession}},
+            {"$group": {
+                "_id": "$accession",
+                "count": {"$sum": 1},
+                "count_high_map_weight": {"$sum": {"$cond": [{"$gt": ["$mapWeight", 1]}, 1, 0]}},
+                # Null and missing values sort before numbers
+                "count_no_map_weight": {"$sum": {"$cond": [{"$gt": ["$mapWeight", None]}, 0, 1]}},
+                "map_weight": {"$max": "$mapWeight"}
+            }},
+            {"$match": {"$or": [{"count": {"$gt": 1}}, {"count_high_map_weight": {"$gt": 0}}]}}
+        ],
+        allowDiskUse=True
+    )
+
+
+def find_explained_accessions(accessioning_mongo_handle, database_name, accessions):
+    """
+    Return the accessions that have been merged into another clustered variant and the ones that have lost
+    submitted variants by declustering, using one query per operation collection.
+    """
+    dbsnp_cve_op_collection = accessioning_mongo_handle[database_name]["dbsnpClusteredVariantOperationEntity"]
+    dbsnp_sve_op_collection = accessioning_mongo_handle[database_name]["dbsnpSubmittedVariantOperationEntity"]
+    merged_accessions = set(dbsnp_cve_op_collection.distinct(
+        'accession', {'accession': {'$in': accessions}, 'eventType': 'MERGED'}
+    ))
+    declustered_accessions = set()
+    for operation in dbsnp_sve_op_collection.find(
+            {'inactiveObjects.rs': {'$in': accessions}, 'eventType': 'UPDATED', 'reason': {'$regex': '^Declustered:'}},
+            {'inactiveObjects.rs': 1}):
+        declustered_accessions.update(inactive_object.get('rs') for inactive_object in operation['inactiveObjects'])
+    return merged_accessions, declustered_accessions
+
+
+def check_mapping_weight(mongo_host, database_name, username, password, assembly_accession, batch_size=1000):
     """
+    Connect to mongodb and retrieve the clustered variants of specific assembly to check in a single pass that:
+     - the variants that have high mapping weight (>1) can be found multiple times. When they can't, check that they
+     fall in one of the following categories:
+       - One or several clustered variants have been merged with another variant
+       - One or several submitted variants have been declustered (because its definition in dbsnp was inconsistent)
+       leaving a clustered variant without evidence
+     - the variants found multiple times all have a mapping weight
+    Returns the list of inconsistencies found, each as a dict with the assembly, the accession and the category.
     """
+    inconsistencies = []
+    counts = defaultdict(int)
     with get_mongo_connection_handle(mongo_host, username=username, password=password) as accessioning_mongo_handle:
-        dbsnp_cve_collection = accessioning_mongo_handle[database_name]["dbsnpClusteredVariantEntity"]
-        cursor = dbsnp_cve_collection.aggregate(
-            [
-                {"$match": {"asm": assembly_accession}},
-                    {"$group":{"_id": '$accession', "count": {"$sum": 1}, "variants": {"$push": {"contig": "$contig", "start": "$start", "mapWeight": "$mapWeight"} }}},
-                {"$match": {"count": {"$gt": 1}}}
-            ],
-            allowDiskUse=True
-        )
-        accession_checked = number_variants = problematic_accession = 0
-        for accession_record in cursor:
-            accession_checked += 1
-            number_variants += accession_record['count']
-            map_weights = set([variant['mapWeight'] for variant in accession_record['variants']])
-            if None in map_weights:
-                problematic_accession += 1
-                print("Accession %s has %s entries and no mapping weight entries" % (accession_record['_id'], accession_record['count']))
-
-    print("Checked %s accessions (%s variants) with multiple copies and found %s without mapping weight" % (
-        accession_checked, number_variants, problematic_accession
+
+        def categorise_inconsistent(variants):
+            merged_accessions, declustered_accessions = find_explained_accessions(
+                accessioning_mongo_handle, database_name, [variant['_id'] for variant in variants]
+            )
+            for variant in variants:
+                if variant['_id'] in merged_accessions:
+                    category = 'merged'
+                elif variant['_id'] in declustered_accessions:
+                    category = 'declustered'
+                else:
+                    category = 'unexplained_map_weight'
+                    print("rs%s Should have more than 1 variant because mapWeight = %s" % (
+                        str(variant['_id']), variant['map_weight']))
+                counts[category] += 1
+                inconsistencies.append({'assembly': assembly_accession, 'accession': variant['_id'],
+                                        'category': category, 'count': variant['count'],
+                                        'map_weight': variant['map_weight']})
+
+        list_variants_inconsistent = []
+        for accession_record in get_accession_counts(accessioning_mongo_handle, database_name, assembly_accession):
+            counts['clustered_variants_high_map_weight'] += accession_record['count_high_map_weight']
+            if accession_record['count'] > 1:
+                counts['accessions_with_multiple_copies'] += 1
+                counts['variants_with_multiple_copies'] += accession_record['count']
+                if accession_record['count_no_map_weight'] > 0:
+                    counts['missing_map_weight'] += 1
+                    print("Accession %s has %s entries and no mapping weight entries" % (
+                        accession_record['_id'], accession_record['count']))
+                    inconsistencies.append({'assembly': assembly_accession, 'accession': accession_record['_id'],
+                                            'category': 'missing_map_weight', 'count': accession_record['count'],
+                                            'map_weight': accession_record['map_weight']})
+            elif accession_record['count_high_map_weight'] > 0:
+                list_variants_inconsistent.append(accession_record)
+                counts['inconsistent'] += 1
+                if len(list_variants_inconsistent) == batch_size:
+                    categorise_inconsistent(list_variants_inconsistent)
+                    list_variants_inconsistent = []
+        if list_variants_inconsistent:
+            categorise_inconsistent(list_variants_inconsistent)
+
+    print("%s: Checked %s clustered variants" % (assembly_accession, counts['clustered_variants_high_map_weight']))
+    print("%s: Found %s inconsistent variants" % (assembly_accession, counts['inconsistent']))
+    print("%s: Found %s inconsistent variants that are due to merged" % (assembly_accession, counts['merged']))
+    print("%s: Found %s inconsistent variants that are due to declustering" % (assembly_accession,
+                                                                              counts['declustered']))
+    print("%s: Checked %s accessions (%s variants) with multiple copies and found %s without mapping weight" % (
+        assembly_accession, counts['accessions_with_multiple_copies'], counts['variants_with_multiple_copies'],
+        counts['missing_map_weight']
     ))
+    return inconsistencies, dict(counts)
+
+
+def write_report(report_file, inconsistencies_per_assembly):
+    """Write the inconsistencies as a tab separated file with one line per accession."""
+    headers = ['assembly', 'accession', 'category', 'count', 'map_weight']
+    with open(report_file, 'w') as open_file:
+        writer = DictWriter(open_file, fieldnames=headers, delimiter='\t')
+        writer.writeheader()
+        for inconsistencies in inconsistencies_per_assembly:
+            writer.writerows(inconsistencies)
+
+
+def write_summary(summary_file, counts_per_assembly):
+    """Write the number of variants in each category for each assembly as JSON."""
+    with open(summary_file, 'w') as open_file:
+        json.dump(counts_per_assembly, open_file, indent=2)
 
 
 def main():
@@ -96,11 +148,24 @@ def main():
     argparse.add_argument('--database_name', help='', required=True)
     argparse.add_argument('--username', help='', default=None)
     argparse.add_argument('--password', help='', default=None)
-    argparse.add_argument('--assembly_accession', help='', required=True)
+    argparse.add_argument('--assembly_accession', help='One or several assemblies to check', required=True,
+                          nargs='+')
+    argparse.add_argument('--num_workers', help='Number of assemblies checked concurrently', type=int, default=4)
+    argparse.add_argument('--report', help='Path to the tab separated file listing the inconsistent accessions')
+    argparse.add_argument('--summary', help='Path to the JSON file with the counts per category for each assembly')
     args = argparse.parse_args()
 
-    check_mapping_weight(args.host, args.database_name, args.username, args.password, args.assembly_accession)
-    check_variant_counts(args.host, args.database_name, args.username, args.password, args.assembly_accession)
+    with ThreadPoolExecutor(max_workers=args.num_workers) as executor:
+        results = list(executor.map(
+            lambda assembly_accession: check_mapping_weight(args.host, args.database_name, args.username,
+                                                            args.password, assembly_accession),
+            args.assembly_accession
+        ))
+    if args.report:
+        write_report(args.report, [inconsistencies for inconsistencies, _ in results])
+    if args.summary:
+        write_summary(args.summary, {assembly_accession: counts for assembly_accession, (_, counts)
+                                     in zip(args.assembly_accession, results)})
 
 
 if __name__ == "__main__":
@@ -15,7 +15,7 @@
 from eva_2150 import init_logger
 from ebi_eva_common_pyutils.variation import contig_utils
 from ebi_eva_common_pyutils.config_utils import get_pg_metadata_uri_for_eva_profile, get_mongo_uri_for_eva_profile
-from ebi_eva_common_pyutils.pg_utils import execute_query, get_all_results_for_query
+from ebi_eva_common_pyutils.pg_utils import execute_query
 
 import click
 import psycopg2
@@ -23,24 +23,46 @@ import psycopg2.extras
 import sys
 import traceback
 
+from concurrent.futures import ThreadPoolExecutor
 from pymongo import MongoClient
 
 logger = init_logger()
 mongo_genbank_contigs_table_name = "eva_tasks.eva2150_mongo_genbank_contigs"
-
-
-def get_chromosome_name_from_asm_report(metadata_connection_handle, assembly_accession, contig_accession):
-    query = "select chromosome_name from eva_tasks.eva2150_asm_report_genbank_contigs " \
-            "where assembly_accession = '{0}' and contig_accession = '{1}'"\
-        .format(assembly_accession, contig_accession)
-    results = get_all_results_for_query(metadata_connection_handle, query)
-    if len(results) == 0:
-        return None
-    if len(results) > 1:
-        logger.error(
-            "More than one chromosome name found for assembly: {0} and contig: {1}".format(assembly_accession,
-                                                                                           contig_accession))
-    return results[0][0]
+main_collections = ["dbsnpSubmittedVariantEntity", "submittedVariantEntity"]
+ops_collections = ["dbsnpSubmittedVariantOperationEntity", "submittedVariantOperationEntity"]
+insert_page_size = 10000
+
+
+def get_chromosome_names_from_asm_report(metadata_connection_handle, assembly_accession):
+    """Returns the chromosome name of each contig of the assembly report, loaded with a single query."""
+    query = "select contig_accession, chromosome_name from eva_tasks.eva2150_asm_report_genbank_contigs " \
+            "where assembly_accession = %s"
+    with metadata_connection_handle.cursor() as cursor:
+        cursor.execute(query, (assembly_accession,))
+        results = cursor.fetchall()
+    chromosome_names = {}
+    for contig_accession, chromosome_name in results:
+        if contig_accession in chromosome_names:
+            logger.error(
+                "More than one chromosome name found for assembly: {0} and contig: {1}".format(assembly_accession,
+                                                                                               contig_accession))
+            continue
+        chromosome_names[contig_accession] = chromosome_name
+    return chromosome_names
+
+
+def get_chromosome_names_for_contig_accessions(contig_accessions, num_remote_workers):
+    """
+    Resolve the chromosome names of the contigs missing from the assembly report with the remote service. Each contig is
+    looked up only once, however many studies and collections it appears in, and the lookups run concurrently.
+    """
+    contig_accessions = sorted(set(contig_accessions))
+    if not contig_accessions:
+        return {}
+    logger.info("Resolving {0} contigs missing from the assembly report".format(len(contig_accessions)))
+    with ThreadPoolExecutor(max_workers=num_remote_workers) as executor:
+        chromosome_names = executor.map(contig_utils.get_chromosome_name_for_contig_accession, contig_accessions)
+        return dict(zip(contig_accessions, chromosome_names))
 
 
 def create_table_to_collect_mongo_genbank_contigs(private_config_xml_file):
@@ -65,12 +87,13 @@ def insert_contigs_to_db(metadata_connection_handle, contig_info_list):
                                            "(source, assembly_accession, study, contig_accession, chromosome_name, "
                                            "num_entries_in_db, is_contig_in_asm_report) "
                                            "VALUES %s".format(mongo_genbank_contigs_table_name), contig_info_list,
-                                           page_size=100)
+                                           page_size=insert_page_size)
 
 
-def insert_contig_info_to_db(collection, assembly_accession, metadata_connection_handle, mongo_connection_handle,
-                             assembly_attribute_prefix=""):
+def get_contig_counts(collection, assembly_accession, mongo_connection_handle, assembly_attribute_prefix=""):
+    """Returns the number of entries of each study and contig of the assembly in the collection."""
     collection_handle = mongo_connection_handle["eva_accession_sharded"][collection]
+    contig_counts = []
     with collection_handle.aggregate([{'$match': {assembly_attribute_prefix + 'seq': assembly_accession}},
                                       {'$group': {'_id': {'study': '$' + assembly_attribute_prefix + 'study',
                                                           'contig': '$' + assembly_attribute_prefix + 'contig'},
@@ -78,54 +101,67 @@ def insert_contig_info_to_db(collection, assembly_accession, metadata_connection
                                       {"$project": {"study": "$_id.study", "contig": "$_id.contig",
                                                     "count": 1, "_id": 0}}
                                       ], allowDiskUse=True) as cursor:
-        insert_chunk_size = 100
-        contig_info_list = []
         for result in cursor:
-            is_contig_in_asm_report = False
             study = result["study"][0] if assembly_attribute_prefix else result["study"]
             genbank_accession = result["contig"][0] if assembly_attribute_prefix else result["contig"]
-            count = result["count"]
-            chromosome_name = get_chromosome_name_from_asm_report(metadata_connection_handle,
-                                                                  assembly_accession, genbank_accession)
-            if chromosome_name is not None:
-                is_contig_in_asm_report = True
-            else:
-                chromosome_name = contig_utils.get_chromosome_name_for_contig_accession(genbank_accession)
-            contig_info_list.append((collection, assembly_accession, study, genbank_accession,
-                                     chromosome_name, count, is_contig_in_asm_report))
-            if len(contig_info_list) == insert_chunk_size:
-                insert_contigs_to_db(metadata_connection_handle, contig_info_list)
-                contig_info_list = []
-        insert_contigs_to_db(metadata_connection_handle, contig_info_list)
-
-
-def collect_mongo_genbank_contigs(private_config_xml_file, assembly_accession):
+            contig_counts.append((collection, study, genbank_accession, result["count"]))
+    return contig_counts
+
+
+def insert_contig_info_to_db(assembly_accession, metadata_connection_handle, mongo_connection_handle,
+                             num_remote_workers=4):
+    # The aggregations of the four collections run in parallel
+    with ThreadPoolExecutor(max_workers=len(main_collections) + len(ops_collections)) as executor:
+        futures = [executor.submit(get_contig_counts, collection, assembly_accession, mongo_connection_handle)
+                   for collection in main_collections]
+        futures += [executor.submit(get_contig_counts, collection, assembly_accession, mongo_connection_handle,
+                                    assembly_attribute_prefix="inactiveObjects.")
+                    for collection in ops_collections]
+        contig_counts = [contig_count for future in futures for contig_count in future.result()]
+
+    asm_report_chromosome_names = get_chromosome_names_from_asm_report(metadata_connection_handle, assembly_accession)
+    remote_chromosome_names = get_chromosome_names_for_contig_accessions(
+        [genbank_accession for _, _, genbank_accession, _ in contig_counts
+         if asm_report_chromosome_names.get(genbank_accession) is None],
+        num_remote_workers
+    )
+    contig_info_list = []
+    for collection, study, genbank_accession, count in contig_counts:
+        chromosome_name = asm_report_chromosome_names.get(genbank_accession)
+        is_contig_in_asm_report = chromosome_name is not None
+        if not is_contig_in_asm_report:
+            chromosome_name = remote_chromosome_names[genbank_accession]
+        contig_info_list.append((collection, assembly_accession, study, genbank_accession,
+                                 chromosome_name, count, is_contig_in_asm_report))
+    insert_contigs_to_db(metadata_connection_handle, contig_info_list)
+
+
+def collect_mongo_genbank_contigs(private_config_xml_file, assembly_accession, num_remote_workers=4):
+    logger.info("Processing assembly: " + assembly_accession)
     try:
         with psycopg2.connect(get_pg_metadata_uri_for_eva_profile("development", private_config_xml_file),
                               user="evadev") \
                 as metadata_connection_handle, MongoClient(get_mongo_uri_for_eva_profile("development",
                                                                                          private_config_xml_file)) \
                 as mongo_connection_handle:
-            main_collections = ["dbsnpSubmittedVariantEntity", "submittedVariantEntity"]
-            for collection in main_collections:
-                insert_contig_info_to_db(collection, assembly_accession,
-                                         metadata_connection_handle, mongo_connection_handle)
-            ops_collections = ["dbsnpSubmittedVariantOperationEntity", "submittedVariantOperationEntity"]
-            for collection in ops_collections:
-                insert_contig_info_to_db(collection, assembly_accession,
-                                         metadata_connection_handle, mongo_connection_handle,
-                                         assembly_attribute_prefix="inactiveObjects.")
+            insert_contig_info_to_db(assembly_accession, metadata_connection_handle, mongo_connection_handle,
+                                     num_remote_workers)
     except Exception:
         logger.error(traceback.format_exc())
 
 
 @click.option("--private-config-xml-file", help="ex: /path/to/eva-maven-settings.xml", required=True)
+@click.option("--num-concurrent-assemblies", help="Number of assemblies processed at the same time", default=4)
+@click.option("--num-remote-workers", help="Number of concurrent lookups of the contigs missing from the assembly "
+                                           "report", default=4)
 @click.command()
-def main(private_config_xml_file):
+def main(private_config_xml_file, num_concurrent_assemblies, num_remote_workers):
     create_table_to_collect_mongo_genbank_contigs(private_config_xml_file)
-    for assembly_accession in sys.stdin:
-        logger.info("Processing assembly: " + assembly_accession)
-        collect_mongo_genbank_contigs(private_config_xml_file, assembly_accession.strip())
+    assembly_accessions = [assembly_accession.strip() for assembly_accession in sys.stdin if assembly_accession.strip()]
+    with ThreadPoolExecutor(max_workers=num_concurrent_assemblies) as executor:
+        for assembly_accession in assembly_accessions:
+            executor.submit(collect_mongo_genbank_contigs, private_config_xml_file, assembly_accession,
+                            num_remote_workers)
 
 
 if __name__ == "__main__":
@@ -6,91 +6,51 @@ from os import path
 from ebi_eva_common_pyutils.logger import logging_config
 from pymongo import MongoClient
 
+from tasks.eva_2385.collection_stats import get_chunk_distribution, collect_stats, StatsSnapshotStore
+
 logger = logging_config.get_logger(__name__)
 logging_config.add_stdout_handler()
 
 
-def read_chunks_info(uri, mongo_password):
+def read_chunks_info(uri, mongo_password, num_workers=8, snapshot_db=None):
     mongo_client = MongoClient(uri, password=mongo_password)
-    config_db = mongo_client["config"]
-    chunk_collection = config_db["chunks"]
-
-    skip_config_db = {
-        "$match":
-            {
-                "ns": {
-                    "$nin": ["config.system.sessions"],
-                }
-            }
-    }
-    group_by_collection_and_shard = {
-        "$group":
-            {
-                "_id": {"collection": "$ns", "shard": "$shard"},
-                "chunks": {"$sum": 1},
-            }
-    }
-    sort_by_db_collection_shard = {
-        "$sort":
-            {
-                "_id.collection": 1,
-                "_id.shard": 1
-            }
-    }
-
-    pipeline = [
-        skip_config_db,
-        group_by_collection_and_shard,
-        sort_by_db_collection_shard
-    ]
-
-    logger.info("reading chunk info from config db's chunk collection...")
-    aggregated_chunk_info = chunk_collection.aggregate(pipeline, batchSize=0)
+    chunk_distribution = get_chunk_distribution(mongo_client)
+    all_stats = collect_stats(mongo_client, sorted(chunk_distribution), num_workers, chunk_distribution)
+    if snapshot_db:
+        snapshot_store = StatsSnapshotStore(snapshot_db)
+        snapshot_store.add_growth(all_stats)
+        snapshot_store.save_snapshot(all_stats)
+        snapshot_store.close()
+    mongo_client.close()
 
     result = {}
-    for agg_chunk in aggregated_chunk_info:
-        ns = agg_chunk["_id"]["collection"]
-        curr_shard = agg_chunk["_id"]["shard"]
-        no_of_chunks = agg_chunk["chunks"]
-
-        if ns in result.keys():
-            result[ns]["shards"][curr_shard]["no_of_chunks"] = no_of_chunks
-        else:
-            database = ns.split(".")[0]
-            collection = ns.split(".")[1]
-
-            logger.info(f"reading collection info for db({database}) and collection({collection})")
-            collection_info = mongo_client[database].command("collstats", collection)
-            collection_size = int(collection_info["size"])
-            collection_size_gb = round(collection_size / 1024 / 1024 / 1024, 2)
-
-            result[ns] = {
-                "database": database,
-                "collection": collection,
-                "collection_size": collection_size,
-                "collection_size_gb": collection_size_gb,
-                "shards": {}
-            }
-
-            shard_dict = collection_info["shards"]
-            for shard_key in sorted(shard_dict.keys()):
-                shard_size = int(shard_dict[shard_key]["size"])
-                shard_size_gb = round(shard_size / 1024 / 1024 / 1024, 2)
-                result[ns]["shards"][shard_key] = {
-                    "shard_size": shard_size,
-                    "shard_size_gb": shard_size_gb
+    for stats in all_stats:
+        collection_size = stats["size"]
+        result[f'{stats["database"]}.{stats["collection"]}'] = {
+            "database": stats["database"],
+            "collection": stats["collection"],
+            "collection_size": collection_size,
+            "collection_size_gb": round(collection_size / 1024 / 1024 / 1024, 2),
+            "collection_size_growth": stats.get("size_growth"),
+            "total_index_size": stats["total_index_size"],
+            "shards": {
+                shard_key: {
+                    "shard_size": shard["size"],
+                    "shard_size_gb": round(shard["size"] / 1024 / 1024 / 1024, 2),
+                    "no_of_chunks": shard.get("no_of_chunks", 0)
                 }
-
-            result[ns]["shards"][curr_shard]["no_of_chunks"] = no_of_chunks
-
-    mongo_client.close()
+                for shard_key, shard in stats["shards"].items()
+            }
+        }
 
     return result
 
 
-def write_chunk_info_to_csv(result_data, report_dir):
+def write_chunk_info_to_csv(result_data, report_dir, with_growth=False):
     rows = [["Database", "Collection", "Collection_Size - Bytes", "Collection_Size - GB", "Shard", "Shard_Size - Bytes",
              "Shard_Size - GB", "No_Of_Chunks"]]
+    if with_growth:
+        rows[0] += ["Collection_Size_Growth - Bytes", "Total_Index_Size - Bytes"]
 
     for key, value in result_data.items():
         database = value["database"]
@@ -100,8 +60,11 @@ def write_chunk_info_to_csv(result_data, report_dir):
         for shard_key in sorted(value["shards"].keys()):
             shard = value["shards"][shard_key]
             print(database, collection, shard)
-            rows.append([database, collection, collection_size, collection_size_gb, shard_key,
-                         shard["shard_size"], shard["shard_size_gb"], shard["no_of_chunks"]])
+            row = [database, collection, collection_size, collection_size_gb, shard_key,
+                   shard["shard_size"], shard["shard_size_gb"], shard["no_of_chunks"]]
+            if with_growth:
+                row += [value["collection_size_growth"], value["total_index_size"]]
+            rows.append(row)
 
     with open(path.join(report_dir, 'Shard_Report.csv'), 'w') as csv_file:
         csv_writer = csv.writer(csv_file)
@@ -117,13 +80,18 @@ def main():
     parser.add_argument("--report-dir",
                         help="Top-level directory where report will be saved (ex: /path/to/report_dir)",
                         required=True)
+    parser.add_argument("--num-workers", help="Number of collections to get the stats of concurrently", type=int,
+                        default=8, required=False)
+    parser.add_argument("--snapshot-db",
+                        help="SQLite file where the stats are saved at each run to report the growth since the "
+                             "previous one (ex: /path/to/sharding_snapshots.sqlite)", required=False)
     parser.add_argument('--help', action='help', help='Show this help message and exit')
 
     args = parser.parse_args()
 
     mongo_password = getpass.getpass(prompt='Please Enter Mongo Source Password: ')
-    result = read_chunks_info(args.mongo_source_uri, mongo_password)
-    write_chunk_info_to_csv(result, args.report_dir)
+    result = read_chunks_info(args.mongo_source_uri, mongo_password, args.num_workers, args.snapshot_db)
+    write_chunk_info_to_csv(result, args.report_dir, with_growth=args.snapshot_db is not None)
 
 
 if __name__ == "__main__":
@@ -17,8 +17,11 @@ import glob
 import inspect
 import math
 import os
+import subprocess
 import sys
+from concurrent.futures import ThreadPoolExecutor
 
+from ebi_eva_common_pyutils.command_utils import run_command_with_output
 from ebi_eva_common_pyutils.logger import logging_config
 from ebi_eva_common_pyutils.nextflow import NextFlowPipeline, NextFlowProcess
 from tasks.eva_2389 import vcf_vertical_concat
@@ -38,7 +41,8 @@ def get_python_process_command_string(python_program, args: dict, log_file: str)
 
 
 def get_multistage_vertical_concat_pipeline(vcf_files, concat_processing_dir, concat_chunk_size, bcftools_binary,
-                                            stage=0, prev_stage_processes=[], pipeline=NextFlowPipeline()):
+                                            stage=0, prev_stage_processes=[], pipeline=NextFlowPipeline(),
+                                            regions=None):
     """
     # Generate Nextflow pipeline for multi-stage VCF concatenation of 5 VCF files with 2-VCFs concatenated at a time (CONCAT_CHUNK_SIZE=2)
     # For illustration purposes only. Usually the CONCAT_CHUNK_SIZE is much higher (ex: 500).
@@ -56,9 +60,24 @@ def get_multistage_vertical_concat_pipeline(vcf_files, concat_processing_dir, co
     # Stage2:	  		 		   \		 	                      /
     # -------	   		  			\	                            /
     #						      vcf1_2_3_4_5=concat(vcf1_2_3_4,vcf5)          <----- Final result
+    #
+    # When regions are provided, the first stage only keeps the records in these regions.
+    """
+    pipeline, output_vcf_file, _ = _add_multistage_vertical_concat(vcf_files, concat_processing_dir, concat_chunk_size,
+                                                                   bcftools_binary, stage, prev_stage_processes,
+                                                                   pipeline, regions, name_prefix="")
+    return pipeline, output_vcf_file
+
+
+def _add_multistage_vertical_concat(vcf_files, concat_processing_dir, concat_chunk_size, bcftools_binary, stage,
+                                    prev_stage_processes, pipeline, regions, name_prefix):
     """
-    if len(vcf_files) == 1: # If we are left with only one file, this means we have reached the last concat stage
-        return pipeline, vcf_files[0]
+    Add the concatenation stages to the pipeline and return the final output file with the processes producing it
+    """
+    # If we are left with only one file, this means we have reached the last concat stage
+    # unless the file still has to be restricted to the regions
+    if len(vcf_files) == 1 and (stage > 0 or regions is None):
+        return pipeline, vcf_files[0], prev_stage_processes
     num_batches_in_stage = math.ceil(len(vcf_files) / concat_chunk_size)
     curr_stage_processes = []
     output_vcf_files_from_stage = []
@@ -69,13 +88,16 @@ def get_multistage_vertical_concat_pipeline(vcf_files, concat_processing_dir, co
         concat_stage_batch_name = f"concat_stage{stage}_batch{batch}"
         log_file_name = os.path.join(concat_processing_dir, f"{concat_stage_batch_name}.log")
         output_vcf_file = get_output_vcf_file_name(stage, batch, concat_processing_dir)
-        process = NextFlowProcess(process_name=concat_stage_batch_name,
+        concat_args = {"files-to-concat-list": files_to_concat_list,
+                       "concat-processing-dir": concat_processing_dir,
+                       "output-vcf-file": output_vcf_file,
+                       "bcftools-binary": bcftools_binary}
+        if regions and stage == 0:
+            concat_args["regions"] = regions
+        process = NextFlowProcess(process_name=f"{name_prefix}{concat_stage_batch_name}",
                                   command_to_run=str(get_python_process_command_string(
                                       vcf_vertical_concat,
-                                      {"files-to-concat-list": files_to_concat_list,
-                                       "concat-processing-dir": concat_processing_dir,
-                                       "output-vcf-file": output_vcf_file,
-                                       "bcftools-binary": bcftools_binary},
+                                      concat_args,
                                       log_file=log_file_name
                                   )
                                   )
@@ -90,11 +112,110 @@ def get_multistage_vertical_concat_pipeline(vcf_files, concat_processing_dir, co
         prev_stage_dependencies = prev_stage_processes[(concat_chunk_size * batch):(concat_chunk_size * (batch + 1))]
         pipeline.add_dependencies({process: prev_stage_dependencies})
     prev_stage_processes = curr_stage_processes
-    return get_multistage_vertical_concat_pipeline(output_vcf_files_from_stage,
-                                                   concat_processing_dir, concat_chunk_size,
-                                                   bcftools_binary,
-                                                   stage=stage+1, prev_stage_processes=prev_stage_processes,
-                                                   pipeline=pipeline)
+    return _add_multistage_vertical_concat(output_vcf_files_from_stage, concat_processing_dir, concat_chunk_size,
+                                           bcftools_binary, stage + 1, prev_stage_processes, pipeline, regions,
+                                           name_prefix)
+
+
+def get_region_split_concat_pipeline(vcf_files, concat_processing_dir, concat_chunk_size, bcftools_binary,
+                                     region_block_size=None):
+    """
+    # Generate Nextflow pipeline concatenating each block of regions independently then joining the blocks in order.
+    # Each block is concatenated with the multi-stage pipeline above, restricted to the regions in the block.
+    #
+    #           vcf1      vcf2      vcf3      vcf4      vcf5          <---- all files go to every block
+    #                 \         \      |      /         /
+    #     block0 (chr1)    block1 (chr2,chr3)    block2 (chr4:1-1000000) ...    <---- run in parallel
+    #                 \                 |                 /
+    #                   join in order (--naive when headers match)             <---- Final result
+    #
+    # Only the final join waits for all the blocks: there is no barrier between the stages of different blocks.
+    """
+    index_vcf_files(vcf_files, bcftools_binary)
+    region_blocks = get_region_blocks(get_contig_lengths(vcf_files, bcftools_binary), region_block_size)
+    pipeline = NextFlowPipeline()
+    block_output_files = []
+    block_processes = []
+    for block_index, regions in enumerate(region_blocks):
+        block_processing_dir = os.path.join(concat_processing_dir, "regions", f"block_{block_index}")
+        pipeline, block_output_file, final_processes = _add_multistage_vertical_concat(
+            vcf_files, block_processing_dir, concat_chunk_size, bcftools_binary, stage=0, prev_stage_processes=[],
+            pipeline=pipeline, regions=",".join(regions), name_prefix=f"block{block_index}_"
+        )
+        block_output_files.append(block_output_file)
+        block_processes.extend(final_processes)
+
+    files_to_join_list = os.path.join(concat_processing_dir, "regions", "blocks_to_be_joined.txt")
+    os.makedirs(os.path.dirname(files_to_join_list), exist_ok=True)
+    with open(files_to_join_list, "w") as handle:
+        for filename in block_output_files:
+            handle.write(filename + "\n")
+    output_vcf_file = get_joined_output_vcf_file_name(concat_processing_dir)
+    join_process = NextFlowProcess(process_name="join_region_blocks",
+                                   command_to_run=str(get_python_process_command_string(
+                                       vcf_vertical_concat,
+                                       {"files-to-concat-list": files_to_join_list,
+                                        "concat-processing-dir": concat_processing_dir,
+                                        "output-vcf-file": output_vcf_file,
+                                        "bcftools-binary": bcftools_binary,
+                                        "join-in-order": ""},
+                                       log_file=os.path.join(concat_processing_dir, "join_region_blocks.log")
+                                   )))
+    pipeline.add_dependencies({join_process: block_processes})
+    return pipeline, output_vcf_file
+
+
+def index_vcf_files(vcf_files, bcftools_binary, num_workers=8):
+    """
+    Create CSI indexes for the VCF files that do not have one yet
+    """
+    def index_vcf_file(vcf_file):
+        if not (os.path.exists(vcf_file + ".csi") or os.path.exists(vcf_file + ".tbi")):
+            run_command_with_output(f"Indexing {vcf_file}...", f"{bcftools_binary} index --csi {vcf_file}")
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        list(executor.map(index_vcf_file, vcf_files))
+
+
+def get_contig_lengths(vcf_files, bcftools_binary):
+    """
+    Get the length of the contigs present in the VCF files from their indexes, in the order of the indexes
+    """
+    contig_lengths = {}
+    for vcf_file in vcf_files:
+        index_stats = subprocess.check_output([bcftools_binary, "index", "--stats", vcf_file], text=True)
+        for line in index_stats.splitlines():
+            contig, length, _ = line.split("\t")
+            if contig not in contig_lengths or contig_lengths[contig] is None:
+                contig_lengths[contig] = int(length) if length.isdigit() else None
+    return contig_lengths
+
+
+def get_region_blocks(contig_lengths, region_block_size=None):
+    """
+    Group consecutive contigs into blocks of at most region_block_size bases, splitting the contigs longer than that.
+    Without a block size, or when the length of a contig is unknown, each contig is its own block.
+    """
+    region_blocks = []
+    current_block = []
+    current_block_size = 0
+    for contig, length in contig_lengths.items():
+        if region_block_size and length is not None and current_block_size + length <= region_block_size:
+            current_block.append(contig)
+            current_block_size += length
+            continue
+        if current_block:
+            region_blocks.append(current_block)
+            current_block, current_block_size = [], 0
+        if not region_block_size or length is None:
+            region_blocks.append([contig])
+        elif length > region_block_size:
+            region_blocks.extend([[f"{contig}:{start}-{min(start + region_block_size - 1, length)}"]
+                                  for start in range(1, length + 1, region_block_size)])
+        else:
+            current_block, current_block_size = [contig], length
+    if current_block:
+        region_blocks.append(current_block)
+    return region_blocks
 
 
 def write_files_to_concat_list(files_to_concat, concat_stage, concat_batch, concat_processing_dir):
@@ -123,11 +244,21 @@ def get_output_vcf_file_name(concat_stage_index: int, concat_batch_index: int, c
                         f"concat_output_stage{concat_stage_index}_batch{concat_batch_index}.vcf.gz")
 
 
+def get_joined_output_vcf_file_name(concat_processing_dir: str):
+    return os.path.join(concat_processing_dir, "regions", "concat_output_joined.vcf.gz")
+
+
 def run_vcf_vertical_concat_pipeline(toplevel_vcf_dir, concat_processing_dir, concat_chunk_size,
-                                     bcftools_binary, nextflow_binary, nextflow_config_file, resume):
+                                     bcftools_binary, nextflow_binary, nextflow_config_file, resume,
+                                     split_by_region=False, region_block_size=None):
     vcf_files = sorted(glob.glob(f"{toplevel_vcf_dir}/**/*.vcf.gz", recursive=True))
-    pipeline, concat_result_file = get_multistage_vertical_concat_pipeline(vcf_files, concat_processing_dir,
-                                                                           concat_chunk_size, bcftools_binary)
+    if split_by_region:
+        pipeline, concat_result_file = get_region_split_concat_pipeline(vcf_files, concat_processing_dir,
+                                                                        concat_chunk_size, bcftools_binary,
+                                                                        region_block_size)
+    else:
+        pipeline, concat_result_file = get_multistage_vertical_concat_pipeline(vcf_files, concat_processing_dir,
+                                                                               concat_chunk_size, bcftools_binary)
     pipeline.run_pipeline(workflow_file_path=os.path.join(concat_processing_dir, "vertical_concat.nf"),
                           nextflow_binary_path=nextflow_binary, nextflow_config_path=nextflow_config_file,
                           resume=resume)
@@ -154,6 +285,12 @@ def main():
     parser.add_argument("--resume",
                         help="Indicate if a previous concatenation job is to be resumed", action='store_true',
                         required=False)
+    parser.add_argument("--split-by-region",
+                        help="Concatenate each chromosome/region block independently then join the blocks in order",
+                        action='store_true', required=False)
+    parser.add_argument("--region-block-size",
+                        help="Maximum number of bases in a region block when splitting by region "
+                             "(default: one block per contig)", type=int, default=None, required=False)
     args = parser.parse_args()
     run_vcf_vertical_concat_pipeline(**vars(args))
 
@@ -0,0 +1,42 @@
+import os
+import tempfile
+from unittest import TestCase
+from unittest.mock import patch
+
+from tasks.eva_2389.vcf_vertical_concat import VerticalConcatProcess
+
+
+class TestVerticalConcatProcess(TestCase):
+    header = "##fileformat=VCFv4.2\n##contig=<ID=chr1>\n#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n"
+
+    def run_concat(self, tempdir, headers, **kwargs):
+        files_to_concat_list = os.path.join(tempdir, "files_to_be_concatenated.txt")
+        with open(files_to_concat_list, "w") as handle:
+            handle.write("\n".join(headers) + "\n")
+        output_vcf_file = os.path.join(tempdir, "output", "joined.vcf.gz")
+        with patch("tasks.eva_2389.vcf_vertical_concat.subprocess.check_output",
+                   side_effect=lambda command, text: headers[command[-1]]), \
+                patch("tasks.eva_2389.vcf_vertical_concat.run_command_with_output") as run_command:
+            VerticalConcatProcess(files_to_concat_list, tempdir, output_vcf_file, **kwargs).vertical_concat()
+        return run_command.call_args_list[0][0][1]
+
+    def test_intermediate_concat_has_no_version(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            self.assertIn("--no-version", self.run_concat(tempdir, {"s0.vcf.gz": self.header}))
+            self.assertIn("--no-version", self.run_concat(tempdir, {"s0.vcf.gz": self.header}, regions="chr1"))
+
+    def test_join_in_order_is_naive_when_headers_only_differ_by_bcftools_lines(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            block_headers = {
+                "block_0.vcf.gz": self.header.replace("#CHROM", "##bcftools_concatCommand=concat block_0\n#CHROM"),
+                "block_1.vcf.gz": self.header.replace("#CHROM", "##bcftools_concatCommand=concat block_1\n#CHROM")
+            }
+            self.assertIn("--naive", self.run_concat(tempdir, block_headers, join_in_order=True))
+
+    def test_join_in_order_is_not_naive_when_headers_differ(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            block_headers = {
+                "block_0.vcf.gz": self.header,
+                "block_1.vcf.gz": self.header.replace("#CHROM", "##contig=<ID=chr2>\n#CHROM")
+            }
+            self.assertNotIn("--naive", self.run_concat(tempdir, block_headers, join_in_order=True))
@@ -2,7 +2,8 @@ import glob
 import os
 import tempfile
 from ebi_eva_common_pyutils.command_utils import run_command_with_output
-from tasks.eva_2389.run_vcf_vertical_concat_pipeline import run_vcf_vertical_concat_pipeline, get_output_vcf_file_name
+from tasks.eva_2389.run_vcf_vertical_concat_pipeline import run_vcf_vertical_concat_pipeline, get_output_vcf_file_name, \
+    get_joined_output_vcf_file_name, get_region_blocks
 from unittest import TestCase
 
 
@@ -43,3 +44,34 @@ class TestVCFVerticalConcat(TestCase):
                                             f'<(zcat {output_vcf_from_multi_stage_concat} | grep -v ^#)"',
                                             return_process_output=True)
             self.assertEqual("", diffs.strip())
+
+    def test_concat_split_by_region(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            vcf_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "resources")
+            run_vcf_vertical_concat_pipeline(toplevel_vcf_dir=vcf_dir, concat_processing_dir=tempdir,
+                                             concat_chunk_size=2, bcftools_binary="bcftools",
+                                             nextflow_binary="nextflow", nextflow_config_file=None, resume=False,
+                                             split_by_region=True)
+            output_vcf_from_region_concat = get_joined_output_vcf_file_name(concat_processing_dir=tempdir)
+
+            input_vcfs = sorted(glob.glob(f"{vcf_dir}/*.vcf.gz"))
+            output_vcf_from_single_stage_concat = f"{tempdir}/single_stage_concat_result.vcf.gz"
+            run_command_with_output("Concatenate VCFs with single stage...", f"bcftools concat {' '.join(input_vcfs)} "
+                                                                             f"--allow-overlaps --remove-duplicates "
+                                                                             f"-O z "
+                                                                             f"-o {output_vcf_from_single_stage_concat}"
+                                    )
+            diffs = run_command_with_output("Compare outputs from single stage and region concat processes...",
+                                            f'bash -c "diff '
+                                            f'<(zcat {output_vcf_from_single_stage_concat} | grep -v ^#) '
+                                            f'<(zcat {output_vcf_from_region_concat} | grep -v ^#)"',
+                                            return_process_output=True)
+            self.assertEqual("", diffs.strip())
+
+    def test_get_region_blocks(self):
+        contig_lengths = {"chr1": 100, "chr2": 30, "chr3": 50, "chr4": 250, "chr5": None, "chr6": 10}
+        self.assertEqual([["chr1"], ["chr2"], ["chr3"], ["chr4"], ["chr5"], ["chr6"]],
+                         get_region_blocks(contig_lengths))
+        self.assertEqual([["chr1"], ["chr2", "chr3"], ["chr4:1-100"], ["chr4:101-200"], ["chr4:201-250"], ["chr5"],
+                          ["chr6"]],
+                         get_region_blocks(contig_lengths, region_block_size=100))
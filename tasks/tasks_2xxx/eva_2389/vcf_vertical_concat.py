@@ -28,22 +28,47 @@
 
 import argparse
 import os
+import subprocess
 from ebi_eva_common_pyutils.command_utils import run_command_with_output
 
 
 class VerticalConcatProcess:
     def __init__(self, files_to_concat_list: str, concat_processing_dir: str, output_vcf_file: str,
-                 bcftools_binary: str = "bcftools"):
+                 bcftools_binary: str = "bcftools", regions: str = None, join_in_order: bool = False):
         self.files_to_concat_list = files_to_concat_list
         self.concat_processing_dir = concat_processing_dir
         self.output_vcf_file = output_vcf_file
         self.bcftools_binary = bcftools_binary
+        self.regions = regions
+        self.join_in_order = join_in_order
+
+    def _headers_match(self):
+        with open(self.files_to_concat_list) as handle:
+            files_to_concat = [line.strip() for line in handle if line.strip()]
+        headers = set(self._get_header(vcf_file) for vcf_file in files_to_concat)
+        return len(headers) <= 1
+
+    def _get_header(self, vcf_file):
+        # The command lines added by bcftools differ between files without affecting their content
+        header = subprocess.check_output([self.bcftools_binary, "view", "-h", "--no-version", vcf_file], text=True)
+        return "".join(line for line in header.splitlines(keepends=True) if not line.startswith("##bcftools_"))
 
     def vertical_concat(self):
         os.makedirs(os.path.dirname(self.output_vcf_file), exist_ok=True)
+        if self.join_in_order:
+            # Files are disjoint and already in genomic order: when their headers are identical
+            # the compressed blocks can be copied as they are without decompressing
+            concat_options = "--naive" if self._headers_match() else ""
+        elif self.regions:
+            # Only keep the records starting in the regions so that neighbouring regions never overlap
+            # and can be joined afterwards without checking for duplicates
+            concat_options = f"--allow-overlaps --remove-duplicates --no-version " \
+                             f"--regions {self.regions} --regions-overlap pos"
+        else:
+            # No command line added to the header so that the outputs can be joined with --naive afterwards
+            concat_options = "--allow-overlaps --remove-duplicates --no-version"
         run_command_with_output(f"Running bcftools concat with the file list {self.files_to_concat_list}...",
-                                f"{self.bcftools_binary} concat "
-                                "--allow-overlaps --remove-duplicates "
+                                f"{self.bcftools_binary} concat {concat_options} "
                                 f"--file-list {self.files_to_concat_list} -o {self.output_vcf_file} -O z")
         # Use CSI indexes because they can support longer genomes
         # see http://www.htslib.org/doc/tabix.html
@@ -51,10 +76,12 @@ class VerticalConcatProcess:
                                 f"{self.bcftools_binary} index --csi {self.output_vcf_file}")
 
 
-def vcf_vertical_concat(files_to_concat_list, concat_processing_dir, output_vcf_file, bcftools_binary):
+def vcf_vertical_concat(files_to_concat_list, concat_processing_dir, output_vcf_file, bcftools_binary, regions=None,
+                        join_in_order=False):
     concat_process = VerticalConcatProcess(files_to_concat_list=files_to_concat_list,
                                            concat_processing_dir=concat_processing_dir, output_vcf_file=output_vcf_file,
-                                           bcftools_binary=bcftools_binary)
+                                           bcftools_binary=bcftools_binary, regions=regions,
+                                           join_in_order=join_in_order)
     concat_process.vertical_concat()
 
 
@@ -69,9 +96,15 @@ def main():
                         help="Full path to the concatenation output file", required=True)
     parser.add_argument("--bcftools-binary",
                         help="Full path to the binary for bcftools", default="bcftools", required=False)
+    parser.add_argument("--regions",
+                        help="Comma-separated list of regions to restrict the concatenation to", default=None,
+                        required=False)
+    parser.add_argument("--join-in-order",
+                        help="Indicate that the files are disjoint and listed in genomic order", action='store_true',
+                        required=False)
     args = parser.parse_args()
     vcf_vertical_concat(args.files_to_concat_list, args.concat_processing_dir, args.output_vcf_file,
-                        args.bcftools_binary)
+                        args.bcftools_binary, args.regions, args.join_in_order)
 
 
 if __name__ == "__main__":
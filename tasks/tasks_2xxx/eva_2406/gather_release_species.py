@@ -1,72 +1,34 @@
 #!/usr/bin/env python
-import csv
-import json
 import operator
 import os
-import re
 from argparse import ArgumentParser
-from collections import defaultdict
-
-import atexit
 
 import pandas as pd
 import psycopg2
 import psycopg2.extras
-import requests
 from ebi_eva_common_pyutils.config_utils import get_pg_metadata_uri_for_eva_profile
 from ebi_eva_common_pyutils.logger import logging_config
 from ebi_eva_common_pyutils.pg_utils import execute_query, get_all_results_for_query
 
+from tasks.eva_2406.metadata_client import MetadataClient
+
 logger = logging_config.get_logger(__name__)
 logging_config.add_stdout_handler()
 
 
-eutils_url = 'https://eutils.ncbi.nlm.nih.gov/entrez/eutils/'
-esearch_url = eutils_url + 'esearch.fcgi'
-esummary_url = eutils_url + 'esummary.fcgi'
-efetch_url = eutils_url + 'efetch.fcgi'
-ensembl_url = 'http://rest.ensembl.org/info/assembly'
-
-
-cache_file = 'cache.json'
-
-
-def load_cache():
-    global cache
-    if os.path.exists(cache_file):
-        with open(cache_file) as open_file:
-            cache.update(json.load(open_file))
-
-
-def save_cache():
-    with open(cache_file, 'w') as open_file:
-        json.dump(cache, open_file)
-
-
-atexit.register(save_cache)
+# Client for the NCBI and Ensembl lookups, created in main
+metadata_client = None
 
 
-cache = defaultdict(dict)
-load_cache()
+def init_metadata_client(cache_file, api_key=None, num_workers=4):
+    global metadata_client
+    metadata_client = MetadataClient(cache_file, api_key=api_key, num_workers=num_workers)
+    return metadata_client
 
 
 def retrieve_assembly_summary_from_species_name(species):
-    """Search for all ids of assemblies associated with a species by depaginating the results of the search query"""
-    payload = {'db': 'Assembly', 'term': '"{}[ORGN]"'.format(species), 'retmode': 'JSON', 'retmax': 100}
-    response = requests.get(esearch_url, params=payload)
-    data = response.json()
-    search_results = data.get('esearchresult', {})
-    id_list = search_results.get('idlist', [])
-    while int(search_results.get('retstart')) + int(search_results.get('retmax')) < int(search_results.get('count')):
-        payload['retstart'] = int(search_results.get('retstart')) + int(search_results.get('retmax'))
-        response = requests.get(esearch_url, params=payload)
-        data = response.json()
-        search_results = data.get('esearchresult', {})
-        id_list += search_results.get('idlist', [])
-    response = requests.get(esummary_url, params={'db': 'Assembly', 'id': ','.join(id_list), 'retmode': 'JSON'})
-    summary_list = response.json()
-    if summary_list and 'result' in summary_list:
-        return [summary_list.get('result').get(uid) for uid in summary_list.get('result').get('uids')]
+    """Search for all assemblies associated with a species and return their summaries"""
+    return metadata_client.assembly_summaries_for_species([species])[species]
 
 
 def most_recent_assembly(assembly_list):
@@ -83,44 +45,42 @@ def best_assembly(assembly_list):
 
 def retrieve_species_names_from_tax_id(taxid):
     """Search for a species scientific name based on the taxonomy id"""
-    if str(taxid) not in cache['taxid_to_name']:
-        logger.info(f'Query NCBI for taxonomy {taxid}', )
-        payload = {'db': 'Taxonomy', 'id': taxid}
-        r = requests.get(efetch_url, params=payload)
-        match = re.search('<Rank>(.+?)</Rank>', r.text, re.MULTILINE)
-        rank = None
-        if match:
-            rank = match.group(1)
-        if rank not in ['species', 'subspecies']:
-            logger.warning('Taxonomy id %s does not point to a species', taxid)
-        match = re.search('<ScientificName>(.+?)</ScientificName>', r.text, re.MULTILINE)
-        if match:
-            cache['taxid_to_name'][str(taxid)] = match.group(1)
-        else:
-            logger.warning('No species found for %s' % taxid)
-            cache['taxid_to_name'][str(taxid)] = None
-    return taxid, cache['taxid_to_name'].get(str(taxid))
+    rank, scientific_name = metadata_client.species_for_taxonomies([taxid])[taxid]
+    if rank not in ['species', 'subspecies']:
+        logger.warning('Taxonomy id %s does not point to a species', taxid)
+    if not scientific_name:
+        logger.warning('No species found for %s' % taxid)
+    return taxid, scientific_name
 
 
 def retrieve_species_name_from_assembly_accession(assembly_accession):
     """Search for a species scientific name based on an assembly accession"""
-    if assembly_accession not in cache['assembly_to_species']:
-        logger.info(f'Query NCBI for assembly {assembly_accession}', )
-        payload = {'db': 'Assembly', 'term': '"{}"'.format(assembly_accession), 'retmode': 'JSON'}
-        data = requests.get(esearch_url, params=payload).json()
-        if data:
-            assembly_id_list = data.get('esearchresult').get('idlist')
-            payload = {'db': 'Assembly', 'id': ','.join(assembly_id_list), 'retmode': 'JSON'}
-            summary_list = requests.get(esummary_url, params=payload).json()
-            all_species_names = set()
-            for assembly_id in summary_list.get('result', {}).get('uids', []):
-                assembly_info = summary_list.get('result').get(assembly_id)
-                all_species_names.add((assembly_info.get('speciestaxid'), assembly_info.get('speciesname')))
-            if len(all_species_names) == 1:
-                cache['assembly_to_species'][assembly_accession] = all_species_names.pop()
-            else:
-                logger.warning('%s taxons found for assembly %s ' % (len(all_species_names), assembly_accession))
-    return cache['assembly_to_species'].get(assembly_accession) or (None, None)
+    all_species_names = metadata_client.species_for_assemblies([assembly_accession])[assembly_accession]
+    if len(all_species_names) == 1:
+        return next(iter(all_species_names))
+    logger.warning('%s taxons found for assembly %s ' % (len(all_species_names), assembly_accession))
+    return None, None
+
+
+def prefetch_current_ensembl_assemblies(taxids_or_assemblies):
+    """
+    Run the NCBI and Ensembl lookups for all the taxids and assembly accessions in batches and concurrently so that
+    the subsequent calls to retrieve_current_ensembl_assemblies are answered from the cache.
+    """
+    taxids = set()
+    assemblies = set()
+    for taxid_or_assembly in taxids_or_assemblies:
+        if taxid_or_assembly and str(taxid_or_assembly).isdigit():
+            taxids.add(taxid_or_assembly)
+        elif taxid_or_assembly:
+            assemblies.add(taxid_or_assembly)
+    scientific_names = set()
+    for rank, scientific_name in metadata_client.species_for_taxonomies(list(taxids)).values():
+        scientific_names.add(scientific_name)
+    for all_species_names in metadata_client.species_for_assemblies(list(assemblies)).values():
+        if len(all_species_names) == 1:
+            scientific_names.add(next(iter(all_species_names))[1])
+    metadata_client.ensembl_assemblies([name for name in scientific_names if name])
 
 
 def retrieve_current_ensembl_assemblies(taxid_or_assembly):
@@ -139,18 +99,40 @@ def retrieve_current_ensembl_assemblies(taxid_or_assembly):
         taxid, scientific_name = retrieve_species_name_from_assembly_accession(taxid_or_assembly)
     if scientific_name:
         logger.debug('Found %s', scientific_name)
-        if scientific_name not in cache['scientific_name_to_ensembl']:
-            logger.info(f'Query Ensembl for species {scientific_name}', )
-            url = ensembl_url + '/' + scientific_name.lower().replace(' ', '_')
-            response = requests.get(url, params={'content-type': 'application/json'})
-            data = response.json()
-            assembly_accession = str(data.get('assembly_accession'))
-            cache['scientific_name_to_ensembl'][scientific_name] = assembly_accession
-        return [str(taxid), str(scientific_name), cache['scientific_name_to_ensembl'].get(scientific_name)]
+        data = metadata_client.ensembl_assemblies([scientific_name])[scientific_name] or {}
+        return [str(taxid), str(scientific_name), str(data.get('assembly_accession'))]
 
     return ['NA', 'NA', 'NA']
 
 
+def get_ensembl_assembly_table(taxids_or_assemblies, key_column, assembly_column):
+    """
+    Resolve each distinct taxid or assembly accession once and return a frame with the scientific name and the
+    current Ensembl assembly for each of them, ready to be merged on key_column.
+    """
+    keys = pd.unique(pd.Series(taxids_or_assemblies).dropna())
+    prefetch_current_ensembl_assemblies(keys)
+    return pd.DataFrame(
+        [[key] + retrieve_current_ensembl_assemblies(key) for key in keys],
+        columns=[key_column, 'Taxid from NCBI', 'Scientific Name', assembly_column]
+    )[[key_column, 'Scientific Name', assembly_column]]
+
+
+def add_ensembl_assemblies(df):
+    """Add the scientific name and the Ensembl assemblies found from the taxid and from the assembly to the frame"""
+    df = df.drop(columns=['Scientific Name', 'Ensembl assembly from taxid', 'Ensembl assembly from assembly',
+                          'Target Assembly'], errors='ignore')
+    from_taxid = get_ensembl_assembly_table(df['Taxid'], 'Taxid', 'Ensembl assembly from taxid')
+    from_assembly = get_ensembl_assembly_table(df['Assembly'], 'Assembly', 'Ensembl assembly from assembly')
+    df = df.merge(from_taxid, on='Taxid', how='left').merge(
+        from_assembly.drop(columns='Scientific Name'), on='Assembly', how='left'
+    )
+    df['Target Assembly'] = df['Ensembl assembly from taxid'].where(
+        df['Ensembl assembly from taxid'].fillna('').astype(bool), df['Ensembl assembly from assembly']
+    )
+    return df
+
+
 def find_all_eva_studies(accession_counts, private_config_xml_file):
     metadata_uri = get_pg_metadata_uri_for_eva_profile("development", private_config_xml_file)
     with psycopg2.connect(metadata_uri, user="evadev") as pg_conn:
@@ -163,38 +145,34 @@ def find_all_eva_studies(accession_counts, private_config_xml_file):
             'WHERE p.ena_status=4 '   # Ensure that the project is public
             'ORDER BY pt.taxonomy_id, a.vcf_reference_accession'
         )
-        data = []
-        for assembly, tax_id, study in filter_studies(get_all_results_for_query(pg_conn, query)):
-            taxid_from_ensembl, scientific_name, ensembl_assembly_from_taxid = retrieve_current_ensembl_assemblies(tax_id)
-            _, _, ensembl_assembly_from_assembly = retrieve_current_ensembl_assemblies(assembly)
-
-            count_ssid = 0
-            if study in accession_counts:
-                assembly_from_mongo, taxid_from_mongo, project_accession, count_ssid = accession_counts.pop(study)
-                if assembly_from_mongo != assembly:
-                    logger.error(
-                        'For study %s, assembly from accessioning (%s) is different'
-                        ' from assembly from metadata (%s) database.', study, assembly_from_mongo, assembly
-                    )
-                if taxid_from_mongo != tax_id:
-                    logger.error(
-                        'For study %s, taxonomy from accessioning (%s) is different'
-                        ' from taxonomy from metadata (%s) database.', study, taxid_from_mongo, tax_id
-                    )
-            data.append({
-                'Source': 'EVA',
-                'Assembly': assembly,
-                'Taxid': tax_id,
-                'Scientific Name': scientific_name,
-                'Study': study,
-                'Number Of Variants (submitted variants)': count_ssid or 0,
-                'Ensembl assembly from taxid': ensembl_assembly_from_taxid,
-                'Ensembl assembly from assembly': ensembl_assembly_from_assembly,
-                'Target Assembly': ensembl_assembly_from_taxid or ensembl_assembly_from_assembly
-            })
-    if len(accession_counts) > 0:
-        logger.error('Accessioning database has studies (%s) absent from the metadata database', ', '.join(accession_counts))
-    df = pd.DataFrame(data)
+        studies = pd.DataFrame(list(filter_studies(get_all_results_for_query(pg_conn, query))),
+                               columns=['Assembly', 'Taxid', 'Study'])
+    counts = pd.DataFrame(list(accession_counts.values()),
+                          columns=['Assembly from accessioning', 'Taxid from accessioning', 'Study',
+                                   'Number Of Variants (submitted variants)'])
+    # Only the first assembly of a study gets the variants of the study
+    first_rows = ~studies.duplicated('Study')
+    df = studies[first_rows].merge(counts, on='Study', how='left')
+    df = pd.concat([df, studies[~first_rows]]).sort_index(kind='stable')
+    with_counts = df['Assembly from accessioning'].notna()
+    for _, row in df[with_counts & (df['Assembly from accessioning'] != df['Assembly'])].iterrows():
+        logger.error(
+            'For study %s, assembly from accessioning (%s) is different'
+            ' from assembly from metadata (%s) database.', row['Study'], row['Assembly from accessioning'],
+            row['Assembly']
+        )
+    for _, row in df[with_counts & (df['Taxid from accessioning'] != df['Taxid'])].iterrows():
+        logger.error(
+            'For study %s, taxonomy from accessioning (%s) is different'
+            ' from taxonomy from metadata (%s) database.', row['Study'], row['Taxid from accessioning'], row['Taxid']
+        )
+    absent_studies = counts[~counts['Study'].isin(studies['Study'])]['Study']
+    if len(absent_studies) > 0:
+        logger.error('Accessioning database has studies (%s) absent from the metadata database',
+                     ', '.join(absent_studies))
+    df['Number Of Variants (submitted variants)'] = df['Number Of Variants (submitted variants)'].fillna(0).astype('int64')
+    df['Source'] = 'EVA'
+    df = add_ensembl_assemblies(df)
     df = df.groupby(
         ['Source', 'Assembly', 'Taxid', 'Scientific Name', 'Ensembl assembly from taxid',
          'Ensembl assembly from assembly', 'Target Assembly']
@@ -260,65 +238,101 @@ def filter_studies(query_results):
 
 def parse_dbsnp_csv(input_file, accession_counts):
     """Parse the CSV file generated in the past year to get the DBSNP data"""
-    df = pd.read_csv(input_file)
+    df = pd.read_csv(input_file, thousands=',')
     df = df[df.Source != 'EVA']
-    taxids = []
-    scientific_names = []
-    ensembl_assemblies_from_taxid = []
-    ensembl_assemblies_from_assembly = []
-    target_assemblies = []
-
-    for index, record in df.iterrows():
-        taxid, scientific_name, ensembl_assembly_from_taxid = retrieve_current_ensembl_assemblies(record['Taxid'])
-        _, _, ensembl_assembly_from_assembly = retrieve_current_ensembl_assemblies(record['Assembly'])
-        taxids.append(taxid)
-        scientific_names.append(scientific_name)
-        ensembl_assemblies_from_taxid.append(ensembl_assembly_from_taxid)
-        ensembl_assemblies_from_assembly.append(ensembl_assembly_from_assembly)
-        target_assemblies.append(ensembl_assembly_from_taxid or ensembl_assembly_from_assembly)
-        if record['Assembly'] != 'Unmapped':
-            _, _, count = accession_counts[record['Assembly']]
-            if count != int(record['Number Of Variants (submitted variants)'].replace(',', '')):
-                logger.error(
-                    'Count in spreadsheet (%s) and in database (%s) are different for accession %s',
-                    record['Number Of Variants (submitted variants)'], count, record['Assembly']
-                )
-    df['Scientific Name'] = scientific_names
-    df['Ensembl assembly from taxid'] = ensembl_assemblies_from_taxid
-    df['Ensembl assembly from assembly'] = ensembl_assemblies_from_assembly
-    df['Target Assembly'] = target_assemblies
-    df.replace(',', '', inplace=True)
+    df = add_ensembl_assemblies(df)
+    counts = pd.DataFrame(list(accession_counts.values()), columns=['Assembly', 'Taxid from accessioning', 'Count'])
+    counts = df[df['Assembly'] != 'Unmapped'].merge(counts, on='Assembly', how='left')
+    different_counts = counts[counts['Count'] != counts['Number Of Variants (submitted variants)']]
+    for _, record in different_counts.iterrows():
+        logger.error(
+            'Count in spreadsheet (%s) and in database (%s) are different for accession %s',
+            record['Number Of Variants (submitted variants)'], record['Count'], record['Assembly']
+        )
     return df
 
 
+progress_key_columns = ['source', 'taxid', 'assembly_accession', 'release_number']
+progress_value_columns = ['scientific_name', 'number_of_study', 'number_submitted_variants',
+                          'target_assembly_accession']
+
+
 def create_table_for_progress(private_config_xml_file):
     with psycopg2.connect(get_pg_metadata_uri_for_eva_profile("development", private_config_xml_file),
                           user="evadev") as metadata_connection_handle:
         query_create_table = (
             'CREATE TABLE IF NOT EXISTS remapping_progress '
             '(source TEXT, taxid INTEGER, scientific_name TEXT, assembly_accession TEXT, number_of_study INTEGER NOT NULL,'
-            'number_submitted_variants BIGINT NOT NULL, release_number INTEGER, `target_assembly_accession` TEXT, '
+            'number_submitted_variants BIGINT NOT NULL, release_number INTEGER, target_assembly_accession TEXT, '
             'report_time TIMESTAMP DEFAULT NOW(), progress_status TEXT, start_time TIMESTAMP, '
             'completion_time TIMESTAMP, remapping_version TEXT, nb_variant_extracted INTEGER, '
             'nb_variant_remapped INTEGER, nb_variant_ingested INTEGER, '
             'primary key(source, taxid, assembly_accession, release_number))'
         )
-    execute_query(metadata_connection_handle, query_create_table)
+        execute_query(metadata_connection_handle, query_create_table)
 
 
-def insert_remapping_progress_to_db(private_config_xml_file, dataframe):
-    list_to_remap = dataframe.values.tolist()
-    if len(list_to_remap) > 0:
-        with psycopg2.connect(get_pg_metadata_uri_for_eva_profile("development", private_config_xml_file),
-                              user="evadev") as metadata_connection_handle:
-            with metadata_connection_handle.cursor() as cursor:
-                query_insert = (
-                    'INSERT INTO remapping_progress '
-                    '(source, taxid, scientific_name, assembly_accession, number_of_study, '
-                    'number_submitted_variants, target_assembly_accession, release_number) '
-                    'VALUES %s'
-                )
-                psycopg2.extras.execute_values(cursor, query_insert, list_to_remap)
+def normalise_remapping_progress(dataframe):
+    dataframe = dataframe[progress_key_columns + progress_value_columns].copy()
+    for column in ['taxid', 'release_number', 'number_of_study', 'number_submitted_variants']:
+        dataframe[column] = dataframe[column].astype('int64')
+    return dataframe.astype(object).where(dataframe.notna(), None)
+
+
+def diff_remapping_progress(existing, new):
+    """
+    Compare the rows to load with the ones already in remapping_progress for the same releases. The returned frame
+    has one row per key with the existing and new values and a change column that is new, updated, unchanged or
+    not_in_input.
+    """
+    diff = existing.merge(new, on=progress_key_columns, how='outer', suffixes=(' existing', ''), indicator=True)
+    updated = pd.Series(False, index=diff.index)
+    for column in progress_value_columns:
+        updated |= diff[column + ' existing'].fillna('NA').astype(str) != diff[column].fillna('NA').astype(str)
+    diff['change'] = 'unchanged'
+    diff.loc[(diff['_merge'] == 'both') & updated, 'change'] = 'updated'
+    diff.loc[diff['_merge'] == 'right_only', 'change'] = 'new'
+    diff.loc[diff['_merge'] == 'left_only', 'change'] = 'not_in_input'
+    return diff.drop(columns='_merge')
+
+
+def insert_remapping_progress_to_db(private_config_xml_file, dataframe, diff_output=None, dry_run=False):
+    """
+    Upsert the rows in remapping_progress in a single batch, after logging the difference with the rows already
+    present for the same releases. With dry_run only the difference is produced.
+    """
+    dataframe = normalise_remapping_progress(dataframe)
+    duplicated = dataframe.duplicated(progress_key_columns, keep='last')
+    if duplicated.any():
+        logger.warning('%s rows are duplicated in the input: only the last one of each is loaded', duplicated.sum())
+        dataframe = dataframe[~duplicated]
+    if len(dataframe) == 0:
+        return
+    with psycopg2.connect(get_pg_metadata_uri_for_eva_profile("development", private_config_xml_file),
+                          user="evadev") as metadata_connection_handle:
+        releases = ', '.join(str(release) for release in dataframe['release_number'].unique())
+        query_existing = (
+            f'SELECT {", ".join(progress_key_columns + progress_value_columns)} FROM remapping_progress '
+            f'WHERE release_number IN ({releases})'
+        )
+        existing = normalise_remapping_progress(pd.DataFrame(
+            get_all_results_for_query(metadata_connection_handle, query_existing),
+            columns=progress_key_columns + progress_value_columns
+        ))
+        diff = diff_remapping_progress(existing, dataframe)
+        logger.info('Changes to remapping_progress: %s', diff['change'].value_counts().to_dict())
+        if diff_output:
+            diff.to_csv(diff_output, sep='\t', index=False)
+        if dry_run:
+            logger.info('Dry run: remapping_progress is not modified')
+            return
+        with metadata_connection_handle.cursor() as cursor:
+            query_upsert = (
+                f'INSERT INTO remapping_progress ({", ".join(progress_key_columns + progress_value_columns)}) '
+                f'VALUES %s ON CONFLICT ({", ".join(progress_key_columns)}) DO UPDATE SET '
+                + ', '.join(f'{column}=EXCLUDED.{column}' for column in progress_value_columns)
+            )
+            psycopg2.extras.execute_values(cursor, query_upsert, dataframe.values.tolist(), page_size=len(dataframe))
 
 
 def main():
@@ -333,7 +347,20 @@ def main():
     argparse.add_argument('--private_config_xml_file', required=True,
                           help='Path to the file containing the username/passwords tp access '
                                'production and development databases')
+    argparse.add_argument('--cache_file', default='metadata_cache.sqlite',
+                          help='Path to the SQLite file caching the responses from NCBI and Ensembl')
+    argparse.add_argument('--ncbi_api_key', default=os.environ.get('NCBI_API_KEY'),
+                          help='NCBI API key allowing 10 requests per second instead of 3 (default: $NCBI_API_KEY)')
+    argparse.add_argument('--num_workers', type=int, default=4,
+                          help='Number of concurrent requests made to NCBI and Ensembl')
+    argparse.add_argument('--release_number', type=int, default=3,
+                          help='Release the species and assemblies are gathered for')
+    argparse.add_argument('--diff_output',
+                          help='Path to the file that will contain the difference with the current remapping_progress')
+    argparse.add_argument('--dry_run', action='store_true', default=False,
+                          help='Only report the difference with the current remapping_progress without loading')
     args = argparse.parse_args()
+    init_metadata_client(args.cache_file, api_key=args.ncbi_api_key, num_workers=args.num_workers)
     output_header = ['Source', 'Taxid', 'Scientific Name', 'Assembly', 'number Of Studies',
                      'Number Of Variants (submitted variants)', 'Ensembl assembly from taxid',
                      'Ensembl assembly from assembly', 'Target Assembly']
@@ -346,12 +373,14 @@ def main():
     df = df[output_header]
     df.to_csv(args.output, quoting=False, sep='\t', index=False)
     create_table_for_progress(args.private_config_xml_file)
-    output_header = ['Source', 'Taxid', 'Scientific Name', 'Assembly', 'number Of Studies',
-                     'Number Of Variants (submitted variants)', 'Target Assembly']
-    df = df[output_header]
-    df['Release'] = 3
-    df = df[df['Source'] != 'DBSNP - filesystem']
-    insert_remapping_progress_to_db(args.private_config_xml_file, df)
+    df = df[df['Source'] != 'DBSNP - filesystem'].rename(columns={
+        'Source': 'source', 'Taxid': 'taxid', 'Scientific Name': 'scientific_name', 'Assembly': 'assembly_accession',
+        'number Of Studies': 'number_of_study', 'Number Of Variants (submitted variants)': 'number_submitted_variants',
+        'Target Assembly': 'target_assembly_accession'
+    })
+    df['release_number'] = args.release_number
+    insert_remapping_progress_to_db(args.private_config_xml_file, df, diff_output=args.diff_output,
+                                    dry_run=args.dry_run)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,29 @@
+import pandas as pd
+from unittest import TestCase
+
+from tasks.eva_2406.gather_release_species import diff_remapping_progress, normalise_remapping_progress, \
+    progress_key_columns, progress_value_columns
+
+
+class TestDiffRemappingProgress(TestCase):
+
+    def test_diff_remapping_progress(self):
+        columns = progress_key_columns + progress_value_columns
+        existing = pd.DataFrame([
+            ['EVA', 9031, 'GCA_000002315.5', 3, 'Gallus gallus', 2, 1000, 'GCA_000002315.5'],
+            ['EVA', 9913, 'GCA_000003055.5', 3, 'Bos taurus', 1, 500, 'GCA_002263795.2'],
+            ['DBSNP', 9823, 'GCA_000003025.6', 3, 'Sus scrofa', 4, 2000, 'GCA_000003025.6'],
+        ], columns=columns)
+        new = pd.DataFrame([
+            ['EVA', 9031, 'GCA_000002315.5', 3, 'Gallus gallus', 2, 1000, 'GCA_000002315.5'],
+            ['EVA', 9913, 'GCA_000003055.5', 3, 'Bos taurus', 2, 800, 'GCA_002263795.2'],
+            ['EVA', 9940, 'GCA_000298735.2', 3, 'Ovis aries', 1, 10.0, None],
+        ], columns=columns)
+        diff = diff_remapping_progress(normalise_remapping_progress(existing), normalise_remapping_progress(new))
+        changes = dict(zip(diff['assembly_accession'], diff['change']))
+        assert changes == {
+            'GCA_000002315.5': 'unchanged',
+            'GCA_000003055.5': 'updated',
+            'GCA_000298735.2': 'new',
+            'GCA_000003025.6': 'not_in_input'
+        }
@@ -0,0 +1,117 @@
+import json
+import os
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import TestCase
+from urllib.parse import urlparse, parse_qs
+
+from tasks.eva_2406.metadata_client import MetadataClient
+
+assembly_summaries = {
+    '1': {'uid': '1', 'assemblyaccession': 'GCA_000001.1', 'speciestaxid': '9031', 'speciesname': 'Gallus gallus'},
+    '2': {'uid': '2', 'assemblyaccession': 'GCA_000002.1', 'speciestaxid': '9913', 'speciesname': 'Bos taurus'},
+}
+taxonomy_summaries = {
+    '9031': {'uid': '9031', 'rank': 'species', 'scientificname': 'Gallus gallus'},
+}
+search_results = {'"GCA_000001.1"': ['1'], '"GCA_000002.1"': ['2']}
+
+
+class MockHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = {key: values[0] for key, values in parse_qs(url.query).items()}
+        self.server.requests.append((url.path, params))
+        if url.path.startswith('/ensembl/') and self.server.ensembl_failures > 0:
+            self.server.ensembl_failures -= 1
+            self.send_json({'error': 'Too many requests'}, status=429)
+        elif url.path == '/eutils/esearch.fcgi':
+            id_list = search_results.get(params['term'], [])
+            self.send_json({'esearchresult': {'count': str(len(id_list)), 'retmax': str(len(id_list)),
+                                              'retstart': '0', 'idlist': id_list}})
+        elif url.path == '/eutils/esummary.fcgi':
+            summaries = assembly_summaries if params['db'] == 'Assembly' else taxonomy_summaries
+            uids = [uid for uid in params['id'].split(',') if uid in summaries]
+            self.send_json({'result': dict({'uids': uids}, **{uid: summaries[uid] for uid in uids})})
+        elif url.path == '/ensembl/gallus_gallus':
+            self.send_json({'assembly_accession': 'GCA_000001.1'})
+        else:
+            self.send_json({'error': 'Not found'}, status=400)
+
+    def send_json(self, data, status=200):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestMetadataClient(TestCase):
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('localhost', 0), MockHandler)
+        self.server.requests = []
+        self.server.ensembl_failures = 0
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.base_url = f'http://localhost:{self.server.server_port}'
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.cache_file = os.path.join(self.tmp_dir.name, 'cache.sqlite')
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.tmp_dir.cleanup()
+
+    def get_client(self, **kwargs):
+        return MetadataClient(self.cache_file, eutils_base_url=self.base_url + '/eutils/',
+                              ensembl_base_url=self.base_url + '/ensembl', backoff_factor=0.01, ensembl_rate=100,
+                              **kwargs)
+
+    def requests_to(self, path):
+        return [params for request_path, params in self.server.requests if request_path == path]
+
+    def test_species_for_assemblies_batches_summaries(self):
+        client = self.get_client(api_key='secret')
+        species = client.species_for_assemblies(['GCA_000001.1', 'GCA_000002.1', 'GCA_000003.1'])
+        assert species == {
+            'GCA_000001.1': {('9031', 'Gallus gallus')},
+            'GCA_000002.1': {('9913', 'Bos taurus')},
+            'GCA_000003.1': set()
+        }
+        esummary_requests = self.requests_to('/eutils/esummary.fcgi')
+        assert len(esummary_requests) == 1
+        assert sorted(esummary_requests[0]['id'].split(',')) == ['1', '2']
+        assert all(params['api_key'] == 'secret' for _, params in self.server.requests)
+        client.close()
+
+    def test_cache_persists_between_clients(self):
+        client = self.get_client()
+        assert client.species_for_taxonomies([9031, 1]) == {9031: ('species', 'Gallus gallus'), 1: (None, None)}
+        client.close()
+        number_of_requests = len(self.server.requests)
+
+        client = self.get_client()
+        assert client.species_for_taxonomies([9031, 1]) == {9031: ('species', 'Gallus gallus'), 1: (None, None)}
+        assert len(self.server.requests) == number_of_requests
+        client.close()
+
+        # Expired entries are fetched again
+        client = self.get_client(ttls={'esummary_taxonomy': -1})
+        client.species_for_taxonomies([9031])
+        assert len(self.server.requests) == number_of_requests + 1
+        client.close()
+
+    def test_ensembl_assemblies_retry_on_429(self):
+        self.server.ensembl_failures = 2
+        client = self.get_client()
+        assemblies = client.ensembl_assemblies(['Gallus gallus', 'Unknown species'])
+        assert assemblies == {'Gallus gallus': {'assembly_accession': 'GCA_000001.1'},
+                              'Unknown species': {'error': 'Not found'}}
+        assert len(self.requests_to('/ensembl/gallus_gallus')) + len(self.requests_to('/ensembl/unknown_species')) == 4
+        client.close()
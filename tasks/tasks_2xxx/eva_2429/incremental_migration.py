@@ -5,6 +5,7 @@ from ebi_eva_common_pyutils.logger import logging_config
 
 from accession_incremental_migration import accession_export
 from migration_util import mongo_import_from_dir
+from replication import replicate
 from variant_incremental_migration import files_variants_export, annotations_export
 
 logger = logging_config.get_logger(__name__)
@@ -46,10 +47,24 @@ def main():
     parser.add_argument("--query-file-dir",
                         help="Top level directory where all the query files will be created. If not provided, script directory path will be taked by default",
                         required=False)
+    parser.add_argument("--replicate", action='store_true', default=False,
+                        help="Copy the changes directly from source to destination using change streams (or the "
+                             "studies processed since the last run when unavailable) instead of running the tasks")
+    parser.add_argument("--state-file",
+                        help="File where the change stream resume token and high-water date are persisted between runs",
+                        required=False, default='replication_state.json')
+    parser.add_argument("--follow", action='store_true', default=False,
+                        help="Keep tailing the change streams instead of stopping once caught up")
     parser.add_argument('--help', action='help', help='Show this help message and exit')
 
     args = parser.parse_args()
 
+    if args.replicate:
+        replicate(args.mongo_source_uri, args.mongo_source_secrets_file, args.mongo_dest_uri,
+                  args.mongo_dest_secrets_file, args.private_config_xml_file, args.state_file, args.start_time,
+                  args.end_time, follow=args.follow)
+        return
+
     if 'accession_export' in args.tasks:
         accession_export(args.mongo_source_uri, args.mongo_source_secrets_file, args.private_config_xml_file,
                          args.export_dir, args.query_file_dir, args.start_time, args.end_time)
@@ -0,0 +1,197 @@
+import os.path
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+
+from bson import json_util
+from ebi_eva_common_pyutils.logger import logging_config
+from ebi_eva_common_pyutils.mongodb import MongoDatabase
+from pymongo import ReplaceOne, DeleteOne
+from pymongo.errors import OperationFailure
+
+from accession_incremental_migration import find_accession_studies_eligible_for_migration, accession_db, \
+    accession_collection
+from variant_incremental_migration import find_variants_studies_eligible_for_migration, variant_collection, \
+    files_collection, annotation_collection, annotation_metadata_collection, get_annotation_ids_for_variant
+
+logger = logging_config.get_logger(__name__)
+
+replicated_collections = [accession_collection, variant_collection, files_collection, annotation_collection,
+                          annotation_metadata_collection]
+annotation_chunk_size = 10000
+annotation_fetch_workers = 8
+
+
+class ReplicationState:
+    """Resume token of the change stream and high-water date of the last scan, persisted between runs."""
+
+    def __init__(self, state_file):
+        self.state_file = state_file
+        self.resume_token = None
+        self.high_water = None
+        if os.path.isfile(state_file):
+            with open(state_file) as open_file:
+                state = json_util.loads(open_file.read())
+            self.resume_token = state.get('resume_token')
+            self.high_water = state.get('high_water')
+
+    def save(self):
+        with open(self.state_file + '.tmp', 'w') as open_file:
+            open_file.write(json_util.dumps({'resume_token': self.resume_token, 'high_water': self.high_water}))
+        os.replace(self.state_file + '.tmp', self.state_file)
+
+
+def upsert_documents(dest_collection, documents):
+    if not documents:
+        return 0
+    result = dest_collection.bulk_write([ReplaceOne({'_id': document['_id']}, document, upsert=True)
+                                         for document in documents], ordered=False)
+    return result.upserted_count + result.modified_count
+
+
+def copy_documents(source_collection, dest_collection, query, batch_size, on_batch=None):
+    total_copied = 0
+    with source_collection.find(query, no_cursor_timeout=True).batch_size(batch_size) as cursor:
+        while True:
+            documents = list(islice(cursor, batch_size))
+            if not documents:
+                break
+            total_copied += upsert_documents(dest_collection, documents)
+            if on_batch:
+                on_batch(documents)
+    logger.info(f'Copied {total_copied} documents to {dest_collection.full_name}')
+    return total_copied
+
+
+def copy_documents_by_ids(source_collection, dest_collection, ids):
+    ids = list(ids)
+    chunks = [ids[i:i + annotation_chunk_size] for i in range(0, len(ids), annotation_chunk_size)]
+    with ThreadPoolExecutor(max_workers=annotation_fetch_workers) as executor:
+        copied_counts = executor.map(
+            lambda chunk: upsert_documents(dest_collection, list(source_collection.find({'_id': {'$in': chunk}}))),
+            chunks
+        )
+        total_copied = sum(copied_counts)
+    logger.info(f'Copied {total_copied} documents to {dest_collection.full_name}')
+    return total_copied
+
+
+def change_to_write_operation(change):
+    if change['operationType'] in ('insert', 'replace', 'update'):
+        # fullDocument is None when the document was deleted after the update: the delete event will follow
+        if change.get('fullDocument') is not None:
+            return ReplaceOne(change['documentKey'], change['fullDocument'], upsert=True)
+    elif change['operationType'] == 'delete':
+        return DeleteOne(change['documentKey'])
+    return None
+
+
+def apply_changes(dest_client, changes):
+    operations_per_namespace = {}
+    for change in changes:
+        operation = change_to_write_operation(change)
+        if operation:
+            namespace = (change['ns']['db'], change['ns']['coll'])
+            operations_per_namespace.setdefault(namespace, []).append(operation)
+    for (db, collection), operations in operations_per_namespace.items():
+        # Keep the order so that successive changes to the same document are applied in sequence
+        dest_client[db][collection].bulk_write(operations, ordered=True)
+        logger.info(f'Applied {len(operations)} changes to {db}.{collection}')
+
+
+def get_change_stream_pipeline():
+    return [{'$match': {'ns.coll': {'$in': replicated_collections}}}]
+
+
+def get_current_resume_token(source_client):
+    """
+    Open the change stream of the source to get the resume token of the current position.
+    Raises OperationFailure when change streams are not available on the source.
+    """
+    with source_client.watch(get_change_stream_pipeline()) as stream:
+        return stream.resume_token
+
+
+def replicate_from_change_stream(source_client, dest_client, state, batch_size, follow):
+    with source_client.watch(get_change_stream_pipeline(), full_document='updateLookup',
+                             resume_after=state.resume_token) as stream:
+        while stream.alive:
+            changes = []
+            while len(changes) < batch_size:
+                change = stream.try_next()
+                if change is None:
+                    break
+                changes.append(change)
+            if changes:
+                apply_changes(dest_client, changes)
+            state.resume_token = stream.resume_token
+            state.save()
+            if not changes and not follow:
+                break
+
+
+def replicate_from_high_water(source_client, dest_client, private_config_xml_file, state, start_time, end_time,
+                              batch_size):
+    start_time = state.high_water or start_time
+    logger.info(f'Replicating studies processed between {start_time} and {end_time}')
+
+    study_seq_set = find_accession_studies_eligible_for_migration(private_config_xml_file, start_time, end_time)
+    if study_seq_set:
+        copy_documents(source_client[accession_db][accession_collection],
+                       dest_client[accession_db][accession_collection],
+                       {'$or': [{'study': study, 'seq': seq} for study, seq in study_seq_set]}, batch_size)
+
+    db_study_dict = find_variants_studies_eligible_for_migration(private_config_xml_file, start_time, end_time)
+    for db, study_vcf in db_study_dict.items():
+        files_filter = [{'sid': study, 'fid': vcf} for study, vcf in study_vcf]
+        copy_documents(source_client[db][files_collection], dest_client[db][files_collection],
+                       {'$or': files_filter}, batch_size)
+
+        annotation_ids = set()
+        annotation_metadata_ids = set()
+
+        def collect_annotation_ids(variants):
+            for variant in variants:
+                for annotation_id, annotation_metadata_id in get_annotation_ids_for_variant(variant):
+                    annotation_ids.add(annotation_id)
+                    annotation_metadata_ids.add(annotation_metadata_id)
+
+        copy_documents(source_client[db][variant_collection], dest_client[db][variant_collection],
+                       {'files': {'$elemMatch': {'$or': files_filter}}}, batch_size, on_batch=collect_annotation_ids)
+        copy_documents_by_ids(source_client[db][annotation_collection], dest_client[db][annotation_collection],
+                              annotation_ids)
+        copy_documents_by_ids(source_client[db][annotation_metadata_collection],
+                              dest_client[db][annotation_metadata_collection], annotation_metadata_ids)
+
+    state.high_water = end_time
+    state.save()
+
+
+def replicate(mongo_source_uri, mongo_source_secrets_file, mongo_dest_uri, mongo_dest_secrets_file,
+              private_config_xml_file, state_file, start_time, end_time, batch_size=1000, follow=False):
+    """
+    Copy new and modified documents straight from the source to the destination without intermediate files.
+    Tails the change streams of the source when available, otherwise falls back to the studies processed since the
+    high-water date recorded in the state file.
+    On the first run the change stream has no resume token: the studies processed between start_time and end_time are
+    copied first, and the stream is then resumed from the position taken before that copy so that nothing is missed.
+    """
+    state = ReplicationState(state_file)
+    source_client = MongoDatabase(uri=mongo_source_uri, secrets_file=mongo_source_secrets_file,
+                                  db_name='admin').mongo_handle
+    dest_client = MongoDatabase(uri=mongo_dest_uri, secrets_file=mongo_dest_secrets_file,
+                                db_name='admin').mongo_handle
+    if state.resume_token is None:
+        try:
+            resume_token = get_current_resume_token(source_client)
+        except OperationFailure as e:
+            logger.warning(f'Change streams are not available on the source ({e}): scanning by high-water date instead')
+            replicate_from_high_water(source_client, dest_client, private_config_xml_file, state, start_time, end_time,
+                                      batch_size)
+            return
+        logger.info('No resume token found: copying the studies processed before tailing the change stream')
+        replicate_from_high_water(source_client, dest_client, private_config_xml_file, state, start_time, end_time,
+                                  batch_size)
+        # Changes made during the copy are replayed from the stream, which is harmless as they are upserts
+        state.resume_token = resume_token
+        state.save()
+    replicate_from_change_stream(source_client, dest_client, state, batch_size, follow)
@@ -118,6 +118,11 @@ def export_annotations_data(mongo_source, db, collection, ids, export_dir, query
     mongo_source.export_data(export_file, mongo_annot_export_args)
 
 
+def get_annotation_ids_for_variant(variant):
+    return [(f'{variant["_id"]}_{annot["vepv"]}_{annot["cachev"]}', f'{annot["vepv"]}_{annot["cachev"]}')
+            for annot in variant.get("annot", [])]
+
+
 def get_annotations_ids(variant_batch):
     annotations_list = {
         "annotations_id": set(),
@@ -125,14 +130,9 @@ def get_annotations_ids(variant_batch):
     }
     for variant_str in variant_batch:
         variant = json.loads(variant_str)
-        if "annot" not in variant:
-            continue
-        else:
-            annot_array = variant["annot"]
-            for annot in annot_array:
-                annotations_list["annotations_id"].add(
-                    json.dumps(f'{variant["_id"]}_{annot["vepv"]}_{annot["cachev"]}')[1:-1])
-                annotations_list["annotations_metadata_id"].add(f'{annot["vepv"]}_{annot["cachev"]}')
+        for annotation_id, annotation_metadata_id in get_annotation_ids_for_variant(variant):
+            annotations_list["annotations_id"].add(json.dumps(annotation_id)[1:-1])
+            annotations_list["annotations_metadata_id"].add(annotation_metadata_id)
 
     return annotations_list
 
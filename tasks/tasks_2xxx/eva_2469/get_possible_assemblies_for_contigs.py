@@ -16,19 +16,25 @@
 # is present and insert it into a table
 
 from Bio import Entrez
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from ebi_eva_common_pyutils.assembly import NCBIAssembly
-from ebi_eva_common_pyutils.command_utils import run_command_with_output
 from ebi_eva_common_pyutils.config_utils import get_pg_metadata_uri_for_eva_profile
 from ebi_eva_common_pyutils.logger import logging_config
 from ebi_eva_common_pyutils.pg_utils import execute_query
-from typing import List
+from retry import retry
+from typing import Dict, List, Set
 
 import argparse
+import hashlib
 import os
 import psycopg2
 import psycopg2.extras
+import requests
 import sys
-import wget
+import tempfile
+import threading
+import time
 
 logger = logging_config.get_logger(__name__)
 logging_config.add_stdout_handler()
@@ -38,6 +44,7 @@ Entrez.tool = "eva"
 
 contig_analysis_table_name = "eva_tasks.eva2469_contig_analysis"
 possible_assemblies_table_name = "eva_tasks.eva2469_possible_assemblies_for_contigs"
+esummary_batch_size = 200
 
 
 def create_table_to_collect_possible_assemblies(private_config_xml_file):
@@ -53,56 +60,206 @@ def create_table_to_collect_possible_assemblies(private_config_xml_file):
 
 def insert_possible_assemblies_for_contig(metadata_connection_handle, contig_accession, possible_assemblies):
     if len(possible_assemblies) > 0:
+        logger.info(f"Inserting {len(possible_assemblies)} possible assemblies for {contig_accession}...")
         with metadata_connection_handle.cursor() as cursor:
-            for assembly_accession in possible_assemblies:
-                logger.info(f"Inserting possible assembly {assembly_accession} for {contig_accession}...")
-                psycopg2.extras.execute_values(cursor,
-                                               "INSERT INTO {0} (genbank_accession, assembly_accession) "
-                                               "VALUES %s"
-                                               .format(possible_assemblies_table_name),
-                                               [(contig_accession, assembly_accession)], page_size=100)
-            metadata_connection_handle.commit()
-
-
-def _does_contig_exist_in_assembly(contig_accession: str, assembly_accession: str):
-    logger.info(f"Obtaining assembly report for {assembly_accession}...")
-    asm = NCBIAssembly(assembly_accession, species_scientific_name=None,
-                       reference_directory=None)
-    try:
-        assembly_report_file_name = os.path.basename(asm.assembly_report_url)
-        os.system("rm -f " + assembly_report_file_name)
-        wget.download(asm.assembly_report_url)
-        output = run_command_with_output(f"Checking if contig {contig_accession} exists in assembly {assembly_accession}",
-                                         f'grep -w "{contig_accession}" "{assembly_report_file_name}" | cat',
-                                         return_process_output=True)
-        return output.strip() != ""
-    except Exception as ex:
-        logger.error(f"Could not download assembly report for {assembly_accession} due to: " + ex.__str__())
-        return False
-
-
-def _get_assembly_accession_for_id(assembly_id: str):
-    assembly_results_handle = Entrez.esummary(db="assembly", id=assembly_id, report="full")
-    assembly_results = Entrez.read(assembly_results_handle)
-    return assembly_results["DocumentSummarySet"]["DocumentSummary"][0]["Synonym"]["Genbank"]
-
-
-def get_assemblies_where_contig_appears(contig_accession: str) -> List[str]:
-    contig_results_handle = Entrez.esummary(db="nuccore", id=contig_accession)
-    contig_results = list(Entrez.parse(contig_results_handle))
-    if len(contig_results) == 0:
-        logger.error(f"No records returned for contig {contig_accession} when querying with eutils!")
-        return []
-    if len(contig_results) > 1:
-        logger.error(f"More than one record returned for contig {contig_accession} when querying with eutils!")
-        return []
-
-    taxonomy_id = int.__repr__(contig_results[0]['TaxId'])
+            psycopg2.extras.execute_values(cursor,
+                                           "INSERT INTO {0} (genbank_accession, assembly_accession) "
+                                           "VALUES %s"
+                                           .format(possible_assemblies_table_name),
+                                           [(contig_accession, assembly_accession)
+                                            for assembly_accession in possible_assemblies], page_size=1000)
+        metadata_connection_handle.commit()
+
+
+class RateLimiter:
+    """Spread the calls made from all threads so that no more than max_rate start in any second."""
+
+    def __init__(self, max_rate):
+        self.interval = 1.0 / max_rate
+        self.next_call = 0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            wait_time = self.next_call - now
+            self.next_call = max(now, self.next_call) + self.interval
+        if wait_time > 0:
+            time.sleep(wait_time)
+
+
+class AssemblyReportCache:
+    """
+    Local cache of the assembly reports. Each report is downloaded once and stored under the sha256 of its content,
+    with one small file per assembly accession pointing to it, so a report is never downloaded again by later runs.
+    Downloads run concurrently and their start is limited to max_rate per second.
+    """
+
+    def __init__(self, cache_dir, num_workers=4, max_rate=3):
+        self.objects_dir = os.path.join(cache_dir, 'objects')
+        self.refs_dir = os.path.join(cache_dir, 'refs')
+        os.makedirs(self.objects_dir, exist_ok=True)
+        os.makedirs(self.refs_dir, exist_ok=True)
+        self.num_workers = num_workers
+        self.rate_limiter = RateLimiter(max_rate)
+        self.session = requests.Session()
+        self.session.mount('https://', requests.adapters.HTTPAdapter(pool_maxsize=num_workers))
+
+    def _object_path(self, digest):
+        return os.path.join(self.objects_dir, digest[:2], digest)
+
+    def get_cached_report(self, assembly_accession):
+        ref_file = os.path.join(self.refs_dir, assembly_accession)
+        if os.path.exists(ref_file):
+            with open(ref_file) as open_file:
+                report_path = self._object_path(open_file.read().strip())
+            if os.path.exists(report_path):
+                return report_path
+        return None
+
+    def _store(self, assembly_accession, content):
+        digest = hashlib.sha256(content).hexdigest()
+        report_path = self._object_path(digest)
+        # Files are written to a temporary name first so that the cache never holds a partial file
+        for path, data in [(report_path, content), (os.path.join(self.refs_dir, assembly_accession), digest.encode())]:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with tempfile.NamedTemporaryFile(dir=os.path.dirname(path), delete=False) as open_file:
+                open_file.write(data)
+            os.replace(open_file.name, path)
+        return report_path
+
+    @retry(tries=4, delay=2, backoff=1.2, jitter=(1, 3))
+    def _download(self, assembly_accession, assembly_report_url):
+        self.rate_limiter.wait()
+        response = self.session.get(assembly_report_url, timeout=300)
+        response.raise_for_status()
+        return self._store(assembly_accession, response.content)
+
+    def get_report(self, assembly_accession, assembly_report_url=None):
+        report_path = self.get_cached_report(assembly_accession)
+        if report_path:
+            return report_path
+        logger.info(f"Obtaining assembly report for {assembly_accession}...")
+        try:
+            if not assembly_report_url:
+                assembly_report_url = NCBIAssembly(assembly_accession, species_scientific_name=None,
+                                                   reference_directory=None).assembly_report_url
+            return self._download(assembly_accession, assembly_report_url.replace('ftp://', 'https://'))
+        except Exception as ex:
+            logger.error(f"Could not download assembly report for {assembly_accession} due to: " + ex.__str__())
+            return None
+
+    def get_reports(self, assembly_report_urls: Dict[str, str]) -> Dict[str, str]:
+        """Returns the path to the report of each assembly, downloading concurrently the ones not in the cache."""
+        with ThreadPoolExecutor(max_workers=self.num_workers) as executor:
+            report_paths = executor.map(lambda item: self.get_report(*item), assembly_report_urls.items())
+            return {accession: path for accession, path in zip(assembly_report_urls, report_paths) if path}
+
+
+def parse_contig_accessions(assembly_report_path) -> Set[str]:
+    """Returns the GenBank and RefSeq accessions of the sequences in the assembly report."""
+    contig_accessions = set()
+    with open(assembly_report_path) as open_file:
+        for line in open_file:
+            if line.startswith('#') or not line.strip():
+                continue
+            line_components = line.rstrip('\n').split('\t')
+            for index in (4, 6):
+                if len(line_components) > index and line_components[index] not in ('', 'na'):
+                    contig_accessions.add(line_components[index])
+    return contig_accessions
+
+
+def build_contig_index(assembly_report_paths: Dict[str, str]) -> Dict[str, Set[str]]:
+    """
+    Build the inverted index of the contig accessions to the assemblies they appear in. Each accession is indexed with
+    and without its version so that contigs given without a version match any version of the accession.
+    """
+    contig_index = defaultdict(set)
+    for assembly_accession, assembly_report_path in assembly_report_paths.items():
+        for contig_accession in parse_contig_accessions(assembly_report_path):
+            contig_index[contig_accession].add(assembly_accession)
+            contig_index[contig_accession.split('.')[0]].add(assembly_accession)
+    return contig_index
+
+
+def batches(items, batch_size=esummary_batch_size):
+    items = list(items)
+    return [items[i:i + batch_size] for i in range(0, len(items), batch_size)]
+
+
+@retry(tries=4, delay=2, backoff=1.2, jitter=(1, 3))
+def _esummary(db, ids):
+    return Entrez.read(Entrez.esummary(db=db, id=','.join(ids)), validate=False)
+
+
+def get_taxonomy_for_contigs(contig_accessions: List[str]) -> Dict[str, int]:
+    """Returns the taxonomy of each contig, retrieved with batched esummary calls."""
+    taxonomy_per_accession = {}
+    for batch in batches(contig_accessions):
+        try:
+            contig_results = _esummary('nuccore', batch)
+        except Exception as ex:
+            # One unknown accession fails the whole batch so the contigs of this batch are retrieved one by one
+            logger.warning(f"Batched esummary failed ({ex}): querying the {len(batch)} contigs one by one")
+            contig_results = []
+            for contig_accession in batch:
+                try:
+                    contig_results.extend(_esummary('nuccore', [contig_accession]))
+                except Exception as ex:
+                    logger.error(f"No records returned for contig {contig_accession} when querying with eutils: {ex}")
+        for contig_result in contig_results:
+            # Contigs can be given with or without their version
+            for accession in (contig_result['AccessionVersion'], contig_result['Caption']):
+                taxonomy_per_accession[accession] = int(contig_result['TaxId'])
+    contig_to_taxonomy = {}
+    for contig_accession in contig_accessions:
+        if contig_accession in taxonomy_per_accession:
+            contig_to_taxonomy[contig_accession] = taxonomy_per_accession[contig_accession]
+        else:
+            logger.error(f"No records returned for contig {contig_accession} when querying with eutils!")
+    return contig_to_taxonomy
+
+
+def get_assembly_report_urls_for_taxonomy(taxonomy_id: int) -> Dict[str, str]:
+    """
+    Returns the GenBank accession of each assembly of the taxonomy with the url of its assembly report, from batched
+    esummary calls.
+    """
     assembly_results = Entrez.read(Entrez.esearch(db="assembly", term=f"txid{taxonomy_id}", retmax=100000))
-    assemblies_to_check = filter(lambda accession: accession.strip() != "",  [_get_assembly_accession_for_id(assembly_id)
-                                  for assembly_id in assembly_results["IdList"]])
-    return list(filter(lambda assembly_accession: _does_contig_exist_in_assembly(contig_accession, assembly_accession),
-                       assemblies_to_check))
+    assembly_report_urls = {}
+    for batch in batches(assembly_results["IdList"]):
+        summaries = _esummary('assembly', batch)
+        for summary in summaries["DocumentSummarySet"]["DocumentSummary"]:
+            assembly_accession = summary["Synonym"]["Genbank"].strip()
+            if assembly_accession:
+                assembly_report_urls[assembly_accession] = summary.get("FtpPath_Assembly_rpt", "")
+    return assembly_report_urls
+
+
+def get_assemblies_where_contigs_appear(contig_accessions: List[str], report_cache: AssemblyReportCache) \
+        -> Dict[str, List[str]]:
+    """
+    Returns the assemblies where each contig appears. The assembly reports of a taxonomy are retrieved and indexed
+    once for all the contigs of that taxonomy.
+    """
+    contigs_per_taxonomy = defaultdict(list)
+    for contig_accession, taxonomy_id in get_taxonomy_for_contigs(contig_accessions).items():
+        contigs_per_taxonomy[taxonomy_id].append(contig_accession)
+
+    possible_assemblies = {contig_accession: [] for contig_accession in contig_accessions}
+    for taxonomy_id, taxonomy_contigs in contigs_per_taxonomy.items():
+        assembly_report_urls = get_assembly_report_urls_for_taxonomy(taxonomy_id)
+        logger.info(f"Indexing {len(assembly_report_urls)} assembly reports for taxonomy {taxonomy_id} "
+                    f"to search {len(taxonomy_contigs)} contigs...")
+        contig_index = build_contig_index(report_cache.get_reports(assembly_report_urls))
+        for contig_accession in taxonomy_contigs:
+            possible_assemblies[contig_accession] = sorted(contig_index.get(contig_accession, []))
+    return possible_assemblies
+
+
+def get_assemblies_where_contig_appears(contig_accession: str, report_cache: AssemblyReportCache) -> List[str]:
+    return get_assemblies_where_contigs_appear([contig_accession], report_cache)[contig_accession]
 
 
 def main():
@@ -111,18 +268,26 @@ def main():
     parser.add_argument("--private-config-xml-file",
                         help="Full path to private configuration file (ex: /path/to/settings.xml)", required=True)
     parser.add_argument("--eutils-api-key", help="EUtils API key", required=True)
+    parser.add_argument("--cache-dir", help="Directory where the assembly reports are cached",
+                        default="assembly_report_cache")
+    parser.add_argument("--num-download-workers", help="Number of concurrent assembly report downloads", type=int,
+                        default=4)
+    parser.add_argument("--max-download-rate", help="Maximum number of assembly report downloads started per second",
+                        type=float, default=3)
     args = parser.parse_args()
 
     Entrez.api_key = args.eutils_api_key
     create_table_to_collect_possible_assemblies(args.private_config_xml_file)
+    report_cache = AssemblyReportCache(args.cache_dir, args.num_download_workers, args.max_download_rate)
+    contig_accessions = list(dict.fromkeys(line.strip() for line in sys.stdin if line.strip()))
+    logger.info(f"Getting possible assemblies for {len(contig_accessions)} contigs from EUtils...")
+    possible_assemblies = get_assemblies_where_contigs_appear(contig_accessions, report_cache)
     with psycopg2.connect(get_pg_metadata_uri_for_eva_profile("development", args.private_config_xml_file),
                           user="evadev") \
             as metadata_connection_handle:
-        for contig_accession in sys.stdin:
-            contig_accession = contig_accession.strip()
-            logger.info(f"Getting possible assemblies for {contig_accession} from EUtils...")
-            possible_assemblies = get_assemblies_where_contig_appears(contig_accession)
-            insert_possible_assemblies_for_contig(metadata_connection_handle, contig_accession, possible_assemblies)
+        for contig_accession in contig_accessions:
+            insert_possible_assemblies_for_contig(metadata_connection_handle, contig_accession,
+                                                  possible_assemblies[contig_accession])
 
 
 if __name__ == "__main__":
@@ -0,0 +1,43 @@
+import os
+import tempfile
+from unittest import TestCase
+
+from tasks.eva_2469.get_possible_assemblies_for_contigs import parse_contig_accessions, build_contig_index
+
+
+def write_assembly_report(report_dir, assembly_accession, rows):
+    report_path = os.path.join(report_dir, assembly_accession + '_assembly_report.txt')
+    with open(report_path, 'w') as open_file:
+        open_file.write('# Assembly name:  test\n')
+        open_file.write('# Sequence-Name\tSequence-Role\tAssigned-Molecule\tAssigned-Molecule-Location/Type\t'
+                        'GenBank-Accn\tRelationship\tRefSeq-Accn\tAssembly-Unit\tSequence-Length\tUCSC-style-name\n')
+        for name, genbank, refseq in rows:
+            open_file.write(f'{name}\tassembled-molecule\t1\tChromosome\t{genbank}\t=\t{refseq}\t'
+                            f'Primary Assembly\t1000\tna\n')
+    return report_path
+
+
+class TestContigIndex(TestCase):
+
+    def test_parse_contig_accessions(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            report_path = write_assembly_report(tmp_dir, 'GCA_000001.1', [
+                ('1', 'CM000001.1', 'NC_000001.1'),
+                ('2', 'CM000002.2', 'na'),
+            ])
+            assert parse_contig_accessions(report_path) == {'CM000001.1', 'NC_000001.1', 'CM000002.2'}
+
+    def test_build_contig_index(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            report_paths = {
+                'GCA_000001.1': write_assembly_report(tmp_dir, 'GCA_000001.1', [('1', 'CM000001.1', 'NC_000001.1')]),
+                'GCA_000001.2': write_assembly_report(tmp_dir, 'GCA_000001.2', [('1', 'CM000001.2', 'na')]),
+            }
+            contig_index = build_contig_index(report_paths)
+            assert contig_index['CM000001.1'] == {'GCA_000001.1'}
+            assert contig_index['CM000001.2'] == {'GCA_000001.2'}
+            assert contig_index['NC_000001.1'] == {'GCA_000001.1'}
+            # Contigs without a version match every version of the accession
+            assert contig_index['CM000001'] == {'GCA_000001.1', 'GCA_000001.2'}
+            assert contig_index['NC_000001'] == {'GCA_000001.1'}
+            assert 'CM000002' not in contig_index
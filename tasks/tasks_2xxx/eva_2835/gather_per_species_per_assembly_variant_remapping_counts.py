@@ -13,29 +13,34 @@
 # limitations under the License.
 
 # Importing relevant packages
+import csv
+import json
 import os
+import tempfile
 import yaml
 import argparse
 import xlsxwriter
-from string import ascii_uppercase
+from multiprocessing import Pool
 
+# Using the C implementation of the yaml loader when PyYAML was built with libyaml
+yaml_loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
 
-def generate_output(all_columns, all_columns_for_specific_taxid_assembly, all_values_for_specific_taxid_assembly,
-                    all_tax_id, all_assembly, output_path):
+
+def generate_output(all_columns, counts_per_taxid_assembly, output_path, parquet=False):
     """
     This function is used to generate the results in a spreadsheet containing the statistics of remapping
     and various reasons of remapping failures for different steps(i.e. flanking region length) for all the
-    taxonomies and their corresponding assemblies
+    taxonomies and their corresponding assemblies, along with a CSV (and optionally Parquet) version of the same table
 
-    Input: It accepts the remapping full path and the output path along with the Excel headers and its
-    corresponding values
+    Input: It accepts the sorted Excel headers, an iterable of the taxonomy, the assembly and the statistics of each
+    taxonomy and assembly, and the output path
 
-    Output: It generates an Excel spreadsheet with the statistics
+    Output: It generates an Excel spreadsheet and a CSV file with the statistics
 
     """
 
-    # Initializing the Excel workbook
-    workbook = xlsxwriter.Workbook(output_path + '/Gather_Stats.xlsx')
+    # Initializing the Excel workbook in constant memory mode so that each row is flushed to disk once written
+    workbook = xlsxwriter.Workbook(os.path.join(output_path, 'Gather_Stats.xlsx'), {'constant_memory': True})
     worksheet = workbook.add_worksheet('All counts.xlsx')
 
     # Creating the header format to be used during writing of the results
@@ -47,25 +52,6 @@ def generate_output(all_columns, all_columns_for_specific_taxid_assembly, all_va
         'fg_color': '#D7E4BC',
         'text_wrap': 1})
 
-    # Considering maximum reasons of failure to be restricted to 26*3
-    letters = list(ascii_uppercase[:3])
-    all_letters = list(ascii_uppercase)
-    excel_cell_headers = list(ascii_uppercase)
-
-    # Storing the Excel cell header subscripts in a list
-    for char in letters:
-        for char2 in all_letters:
-            excel_cell_headers.append(char + char2)
-
-    # Displaying the first two headers i.e. the taxonomy id and the assembly accession
-    worksheet.write('A1', 'Taxonomy', header_format)
-    worksheet.write('B1', 'Assembly Accession', header_format)
-
-    # Displaying the other column headers
-    for column in range(len(all_columns)):
-        cell_name = excel_cell_headers[column + 2] + "1"
-        worksheet.write(cell_name, all_columns[column], header_format)
-
     # Defining the cell format for the taxonomy ids and the assembly accession columns
     filename_fmt = workbook.add_format(
         {'align': 'left', 'valign': 'vcenter', 'border': 1, 'font_color': 'red', 'text_wrap': 1})
@@ -73,37 +59,36 @@ def generate_output(all_columns, all_columns_for_specific_taxid_assembly, all_va
     # Defining the cell format for the column values
     stats_fmt = workbook.add_format({'align': 'center', 'valign': 'vcenter', 'border': 1})
 
-    # Setting the starting row for entering the records
-    row = 1
+    headers = ['Taxonomy', 'Assembly Accession'] + list(all_columns)
+    csv_path = os.path.join(output_path, 'Gather_Stats.csv')
+    with open(csv_path, 'w', newline='') as csv_file:
+        csv_writer = csv.writer(csv_file)
 
-    # Populating the Excel with the values per taxonomy id and per assembly
-    for r in range(len(all_tax_id)):
-        worksheet.write(row, 0, all_tax_id[row - 1], filename_fmt)
-        worksheet.write(row, 1, all_assembly[row - 1], filename_fmt)
+        # Displaying the headers i.e. the taxonomy id, the assembly accession and the statistics columns
+        worksheet.write_row(0, 0, headers, header_format)
+        csv_writer.writerow(headers)
 
-        # Setting the index list which has values for a particular iteration
-        idx = []
+        # Populating the Excel with the values per taxonomy id and per assembly, one row at a time
+        for row, (taxid, assembly_accession, columns_values) in enumerate(counts_per_taxid_assembly, start=1):
+            stats = [columns_values.get(column, 0) for column in all_columns]
+            worksheet.write_row(row, 0, [taxid, assembly_accession], filename_fmt)
+            worksheet.write_row(row, 2, stats, stats_fmt)
+            csv_writer.writerow([taxid, assembly_accession] + stats)
 
-        for column in all_columns_for_specific_taxid_assembly[row - 1]:
-            position = all_columns.index(column)
-            idx.append(position)
-
-        # Populating the values for the other stats columns for a particular iteration
-        for col in range(len(all_columns)):
-            if col in idx:
-                key = all_columns[col]
-                position = all_columns_for_specific_taxid_assembly[row - 1].index(key)
-                stats = all_values_for_specific_taxid_assembly[row - 1][position]
-                worksheet.write(row, col + 2, stats, stats_fmt)
+    # Closing the workbook
+    workbook.close()
 
-            else:
-                worksheet.write(row, col + 2, 0, stats_fmt)
+    if parquet:
+        write_parquet(csv_path, os.path.join(output_path, 'Gather_Stats.parquet'))
 
-        # Incrementing the row to write the next record
-        row = row + 1
 
-    # Closing the workbook
-    workbook.close()
+def write_parquet(csv_path, parquet_path):
+    """
+    This function is used to convert the CSV version of the statistics to Parquet. It requires pyarrow which is only
+    imported when Parquet output is requested
+    """
+    from pyarrow import csv as pyarrow_csv, parquet
+    parquet.write_table(pyarrow_csv.read_csv(csv_path), parquet_path)
 
 
 def extract_taxid_assembly(remapping_root_path):
@@ -198,8 +183,8 @@ def gather_counts_per_file(filename):
 
     with open(filename, 'r') as file:
 
-        # Loading the data from the yaml file
-        data = yaml.safe_load(file)
+        # Loading the data from the yaml file with the C loader when libyaml is available
+        data = yaml.load(file, Loader=yaml_loader)
 
         # Iterating over the yml data for a particular file
         for column, value in data.items():
@@ -232,6 +217,49 @@ def gather_counts_per_file(filename):
     return columns_values
 
 
+def gather_counts_for_taxid_assembly(path_taxid_assembly):
+    """
+    This function is used as the worker of the process pool to gather the statistics of one taxonomy and assembly
+
+    Input: A tuple of the input files full path, the taxonomy id and the assembly accession
+
+    Output: The taxonomy id, the assembly accession and a dictionary of the statistics
+
+    """
+    columns, values, taxid, assembly_accession = gather_counts_per_tax_per_assembly(*path_taxid_assembly)
+    return taxid, assembly_accession, dict(zip(columns, values))
+
+
+def gather_all_counts(remapping_root_path, spool_file, num_processes):
+    """
+    This function is used to parse the yaml files of all the taxonomies and assemblies in a process pool. The
+    statistics are written to a JSON lines spool file as they arrive so that they are not all kept in memory
+
+    Input: The remapping full path, the path of the spool file and the number of processes
+
+    Output: The sorted list of all the columns found in the yaml files
+
+    """
+    tax_assembly = extract_taxid_assembly(remapping_root_path)
+    path_taxid_assembly_list = [(remapping_root_path, taxid, assembly_accession)
+                                for taxid, assemblies in tax_assembly.items() for assembly_accession in assemblies]
+
+    # Using a dictionary as an ordered set of the columns found so far
+    all_columns = {}
+    with Pool(num_processes) as pool, open(spool_file, 'w') as spool:
+        for taxid, assembly_accession, columns_values in pool.imap(gather_counts_for_taxid_assembly,
+                                                                   path_taxid_assembly_list, chunksize=4):
+            all_columns.update(dict.fromkeys(columns_values))
+            spool.write(json.dumps([taxid, assembly_accession, columns_values]) + '\n')
+    return sorted(all_columns)
+
+
+def read_spool(spool_file):
+    with open(spool_file) as spool:
+        for line in spool:
+            yield json.loads(line)
+
+
 def main():
     """
     This is the main function which accepts two arguments from the user, namely, remapping_root_path and
@@ -253,48 +281,25 @@ def main():
     parser.add_argument("--output_path", type=str,
                         help="Path to the output .", required=True)
 
+    # Number of processes parsing the yaml files in parallel
+    parser.add_argument("--num_processes", type=int, default=4,
+                        help="Number of processes used to parse the yaml files")
+
+    # Writing a Parquet version of the statistics in addition to the CSV (requires pyarrow)
+    parser.add_argument("--parquet", action='store_true', default=False,
+                        help="Also write the statistics in Parquet format")
+
     args = parser.parse_args()
 
-    # Initializing the final output columns for the output spreadsheet. These comprise the total number of
-    # variants,remapped variants, total number of variants for each flanking regions and the various reasons of
-    # failures for each flanking regions
-    all_columns = []
-
-    # Initializing the list to store all counts of remapped variants, total number of variants for each
-    # flanking regions and the various reasons of failures for each flanking regions and their corresponding
-    # counts for all taxonomies and assemblies
-    all_columns_for_specific_taxid_assembly = []
-    all_values_for_specific_taxid_assembly = []
-
-    # Initializing the list to store the values of all taxonomy ids and assembly accessions
-    all_tax_id = []
-    all_assembly = []
-
-    # Collecting the taxonomy-assembly information
-    tax_assembly = extract_taxid_assembly(args.remapping_root_path)
-
-    # Collect statistics for each taxonomy and each assembly
-    for taxid, assembly in tax_assembly.items():
-        for val in range(len(assembly)):
-            columns, values, taxid, assembly_accession = gather_counts_per_tax_per_assembly(args.remapping_root_path,
-                                                                                            taxid, assembly[val])
-
-            # Adding the fields and values to the master list for each taxonomy and assembly
-            all_columns_for_specific_taxid_assembly.append(columns)
-            all_values_for_specific_taxid_assembly.append(values)
-
-            # Adding the taxonomy and assembly accession for a particular file to the master list
-            all_tax_id.append(taxid)
-            all_assembly.append(assembly_accession)
-
-            # Updating the final output column in a sorted order every time from an individual yml file
-            all_columns.extend(columns)
-            all_columns = list(dict.fromkeys(all_columns))
-            all_columns.sort()
-
-    # Generating the final output spreadsheet using all the statistics gathered for all taxonomies and assemblies
-    generate_output(all_columns, all_columns_for_specific_taxid_assembly, all_values_for_specific_taxid_assembly,
-                    all_tax_id, all_assembly, args.output_path)
+    # Collecting the statistics for each taxonomy and each assembly in a temporary spool file along with the final
+    # output columns for the output spreadsheet. These comprise the total number of variants, remapped variants,
+    # total number of variants for each flanking regions and the various reasons of failures for each flanking regions
+    with tempfile.TemporaryDirectory(dir=args.output_path) as tmp_dir:
+        spool_file = os.path.join(tmp_dir, 'counts_per_taxid_assembly.jsonl')
+        all_columns = gather_all_counts(args.remapping_root_path, spool_file, args.num_processes)
+
+        # Generating the final output spreadsheet using all the statistics gathered for all taxonomies and assemblies
+        generate_output(all_columns, read_spool(spool_file), args.output_path, args.parquet)
 
 
 if __name__ == "__main__":
@@ -1,5 +1,7 @@
 import argparse
-from collections import defaultdict
+import os
+from collections import defaultdict, deque, Counter
+from concurrent.futures import ThreadPoolExecutor
 from itertools import zip_longest
 
 from ebi_eva_common_pyutils.mongodb import MongoDatabase
@@ -10,31 +12,48 @@ def grouper(iterable, n, fillvalue=None):
     return zip_longest(fillvalue=fillvalue, *args)
 
 
+def get_variants_per_assembly(sve_collection, ssids):
+    """
+    Retrieve the variants of the ssids in all assemblies with a single aggregation grouping them by accession and
+    assembly. Only the fields needed for the categorisation are returned.
+    """
+    pipeline = [
+        {'$match': {'accession': {'$in': ssids}}},
+        # Only keep the fields used for the categorisation, the flags being checked for presence
+        {'$project': {'_id': 0, 'accession': 1, 'seq': 1, 'contig': 1, 'start': 1, 'ref': 1, 'alt': 1,
+                      'remappedFrom': 1, 'allelesMatch': 1, 'mapWeight': 1}},
+        {'$group': {'_id': {'accession': '$accession', 'seq': '$seq'}, 'variants': {'$push': '$$ROOT'}}}
+    ]
+    variants_per_assembly = defaultdict(dict)
+    for group in sve_collection.aggregate(pipeline, allowDiskUse=True):
+        variants_per_assembly[group['_id']['accession']][group['_id']['seq']] = group['variants']
+    return variants_per_assembly
+
+
 def categorise_batch_duplicate_ss(mongo_db, ssids, assembly_accession):
     sve_collection = mongo_db.mongo_handle[mongo_db.db_name]['dbsnpSubmittedVariantEntity']
-    cursor = sve_collection.find({'seq': assembly_accession, 'accession': {'$in': ssids}})
+    variants_per_assembly = get_variants_per_assembly(sve_collection, ssids)
     ssid_to_type_set = defaultdict(list)
     ssid_to_positions = defaultdict(set)
     ssid_to_changes = defaultdict(set)
     # Check each variant independently
-    for variant_rec in cursor:
-        reasons = set()
-        position = f"{variant_rec['contig']}:{variant_rec['start']}"
-        change = f"{variant_rec['ref']}-{variant_rec['alt']}"
-
-        if 'allelesMatch' in variant_rec or 'mapWeight' in variant_rec:
-            # Ingore the variant that have multimapped or allele mismatch flag set because they are ignored anyway
-            continue
-        if not reasons:
-            ssid_to_positions[variant_rec['accession']].add(position)
-            ssid_to_changes[variant_rec['accession']].add(change)
+    for accession, variants_in_assemblies in variants_per_assembly.items():
+        for variant_rec in variants_in_assemblies.get(assembly_accession, []):
+            reasons = set()
+            position = f"{variant_rec['contig']}:{variant_rec['start']}"
+            change = f"{variant_rec['ref']}-{variant_rec['alt']}"
+
+            if 'allelesMatch' in variant_rec or 'mapWeight' in variant_rec:
+                # Ingore the variant that have multimapped or allele mismatch flag set because they are ignored anyway
+                continue
+            ssid_to_positions[accession].add(position)
+            ssid_to_changes[accession].add(change)
 
             if 'remappedFrom' in variant_rec:
                 reasons.add('Remapped')
             if not reasons:
                 reasons.add('In_original_assembly')
-        ssid_to_type_set[variant_rec['accession']].append(','.join(sorted(reasons)))
-    cursor.close()
+            ssid_to_type_set[accession].append(','.join(sorted(reasons)))
     # Check variants per ssids
     for accession in ssid_to_positions:
         if len(ssid_to_positions[accession]) > 1:
@@ -48,13 +67,13 @@ def categorise_batch_duplicate_ss(mongo_db, ssids, assembly_accession):
     ssids = list([ssid for ssid in ssid_to_positions if 'Remapped' in ssid_to_type_set[ssid]])
     ssid_to_positions = defaultdict(set)
     ssid_to_changes = defaultdict(set)
-    cursor = sve_collection.find({'seq': {'$ne': assembly_accession}, 'accession': {'$in': ssids}})
-    for variant_rec in cursor:
-        position = f"{variant_rec['contig']}:{variant_rec['start']}"
-        change = f"{variant_rec['ref']}-{variant_rec['alt']}"
-        ssid_to_positions[variant_rec['accession']].add(position)
-        ssid_to_changes[variant_rec['accession']].add(change)
-    cursor.close()
+    for accession in ssids:
+        for assembly, variant_recs in variants_per_assembly[accession].items():
+            if assembly == assembly_accession:
+                continue
+            for variant_rec in variant_recs:
+                ssid_to_positions[accession].add(f"{variant_rec['contig']}:{variant_rec['start']}")
+                ssid_to_changes[accession].add(f"{variant_rec['ref']}-{variant_rec['alt']}")
 
     for accession in ssid_to_positions:
         if len(ssid_to_positions[accession]) > 1:
@@ -66,35 +85,116 @@ def categorise_batch_duplicate_ss(mongo_db, ssids, assembly_accession):
     return ssid_to_type_set
 
 
-def categorise_all_ss(mongo_db, duplicate_ss_file, output_file, batch_size):
-    all_ss_accessions = []
-    assemblies = set()
+def format_batch(mongo_db, ssids, assembly):
+    ssid_to_types = categorise_batch_duplicate_ss(mongo_db, ssids, assembly)
+    return [f"{ssid}\t{assembly}\t{','.join(sorted(set(ssid_to_types[ssid])))}\n" for ssid in ssid_to_types]
+
+
+def read_ssids_per_assembly(duplicate_ss_file):
+    """Partition the ssids of the input file by assembly, keeping the order of the file."""
+    ssids_per_assembly = defaultdict(list)
     with open(duplicate_ss_file) as open_file:
         for line in open_file:
             if line.strip():
                 count, assembly, ssid = line.strip().split()
-                all_ss_accessions.append(int(ssid))
-                assemblies.add(assembly)
+                ssids_per_assembly[assembly].append(int(ssid))
+    return ssids_per_assembly
+
+
+def load_completed_batches(resume_file, batch_size):
+    """
+    Returns the (assembly, batch index) already written to the output. The batch size is recorded on the first line
+    since the batches would not be the same with another size.
+    """
+    completed_batches = set()
+    if os.path.exists(resume_file):
+        with open(resume_file) as open_file:
+            recorded_batch_size = int(open_file.readline().strip().split('\t')[1])
+            if recorded_batch_size != batch_size:
+                raise ValueError(f'{resume_file} was created with a batch size of {recorded_batch_size} '
+                                 f'instead of {batch_size}')
+            for line in open_file:
+                assembly, batch_index = line.strip().split('\t')
+                completed_batches.add((assembly, int(batch_index)))
+    else:
+        with open(resume_file, 'w') as open_file:
+            print(f'batch_size\t{batch_size}', file=open_file)
+    return completed_batches
+
+
+def summarise_output(output_file):
+    """Returns the number of ssids in each category for each assembly of the output file."""
+    summary = Counter()
+    with open(output_file) as open_file:
+        for line in open_file:
+            ssid, assembly, types = line.rstrip('\n').split('\t')
+            for category in types.split(','):
+                summary[(assembly, category)] += 1
+    return summary
+
+
+def write_summary(summary, summary_file):
+    with open(summary_file, 'w') as open_file:
+        print('assembly\tcategory\tnumber_of_ssids', file=open_file)
+        for (assembly, category), count in sorted(summary.items()):
+            print(f'{assembly}\t{category}\t{count}', file=open_file)
+
+
+def categorise_all_ss(mongo_db, duplicate_ss_file, output_file, batch_size, num_workers=1, resume_file=None,
+                      summary_file=None):
+    """
+    Categorise the ssids of each assembly of the input file by batches processed concurrently. The results are written
+    in the order of the input and each written batch is recorded in the resume file so that an interrupted run can
+    restart where it stopped.
+    """
+    batch_size = int(batch_size)
+    resume_file = resume_file or output_file + '.resume'
+    ssids_per_assembly = read_ssids_per_assembly(duplicate_ss_file)
+    completed_batches = load_completed_batches(resume_file, batch_size)
+    print(f'{sum(len(ssids) for ssids in ssids_per_assembly.values())} ssids to process '
+          f'in {len(ssids_per_assembly)} assemblies')
+    if completed_batches:
+        print(f'Resuming after {len(completed_batches)} batches already processed')
 
     nb_processed = 0
-    assert len(assemblies) == 1, 'Only one assembly per file is expected'
-    assembly = assemblies.pop()
-    print(f'{len(all_ss_accessions)} ssids to process')
-    with open(output_file, 'w') as open_file:
-        for ssids in grouper(all_ss_accessions, batch_size):
-            ssids = [ssid for ssid in ssids if ssid is not None]
-            ssid_to_types = categorise_batch_duplicate_ss(mongo_db, ssids, assembly)
-            for ssid in ssid_to_types:
-                print(f"{ssid}\t{assembly}\t{','.join(sorted(set(ssid_to_types[ssid])))}", file=open_file)
-            nb_processed += len(ssid_to_types)
+    with open(output_file, 'a' if completed_batches else 'w') as open_output, open(resume_file, 'a') as open_resume, \
+            ThreadPoolExecutor(max_workers=num_workers) as executor:
+        def write_batch(assembly, batch_index, future):
+            nonlocal nb_processed
+            lines = future.result()
+            open_output.writelines(lines)
+            open_output.flush()
+            print(f'{assembly}\t{batch_index}', file=open_resume, flush=True)
+            nb_processed += len(lines)
             print(f"{nb_processed}")
 
+        pending_batches = deque()
+        for assembly, all_ss_accessions in ssids_per_assembly.items():
+            for batch_index, ssids in enumerate(grouper(all_ss_accessions, batch_size)):
+                if (assembly, batch_index) in completed_batches:
+                    continue
+                ssids = [ssid for ssid in ssids if ssid is not None]
+                pending_batches.append((assembly, batch_index, executor.submit(format_batch, mongo_db, ssids, assembly)))
+                # Bound the number of batches in flight and write them in the order of the input
+                if len(pending_batches) >= 2 * num_workers:
+                    write_batch(*pending_batches.popleft())
+        while pending_batches:
+            write_batch(*pending_batches.popleft())
+
+    summary = summarise_output(output_file)
+    for (assembly, category), count in sorted(summary.items()):
+        print(f'{assembly}\t{category}\t{count}')
+    if summary_file:
+        write_summary(summary, summary_file)
+    return summary
+
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Check if the RS entities referenced in SS entities all exist in '
                                                  'the database')
     parser.add_argument("--duplicate_ss_file",
-                        help="Input file containing the SSids that have duplicate entries in one assembly", required=True)
+                        help="Input file containing the SSids that have duplicate entries in one or more assemblies",
+                        required=True)
     parser.add_argument("--output_file",
                         help="Output file containing the duplicate SSids annotated with the type", required=True)
     parser.add_argument("--mongo-db-uri",
@@ -102,10 +202,18 @@ if __name__ == '__main__':
     parser.add_argument("--mongo-db-secrets-file",
                         help="Full path to the Mongo Database secrets file (ex: /path/to/mongo/db/secret)",
                         required=True)
-    parser.add_argument("--batch_size", help="Number of ssids search at once", default=1000, required=False)
+    parser.add_argument("--batch_size", help="Number of ssids search at once", type=int, default=1000, required=False)
+    parser.add_argument("--num_workers", help="Number of batches processed concurrently", type=int, default=4,
+                        required=False)
+    parser.add_argument("--resume_file",
+                        help="File recording the batches already written (default: <output_file>.resume). "
+                             "Delete it to start from scratch", required=False)
+    parser.add_argument("--summary_file", help="Output file containing the number of SSids in each category",
+                        required=False)
 
     args = parser.parse_args()
     mongo_db = MongoDatabase(uri=args.mongo_db_uri, secrets_file=args.mongo_db_secrets_file,
                              db_name="eva_accession_sharded")
-    categorise_all_ss(mongo_db, args.duplicate_ss_file, args.output_file, args.batch_size)
+    categorise_all_ss(mongo_db, args.duplicate_ss_file, args.output_file, args.batch_size,
+                      num_workers=args.num_workers, resume_file=args.resume_file, summary_file=args.summary_file)
     mongo_db.mongo_handle.close()
@@ -14,7 +14,7 @@ from unittest.mock import patch
 
 from tasks.eva_2778.check_rs_exist import find_rs_entity_not_exist_in_collection, find_rs_references_in_ss_collection, \
     check_rs_for_assembly
-from tasks.eva_2840.categorise_duplicate_ss import categorise_batch_duplicate_ss
+from tasks.eva_2840.categorise_duplicate_ss import categorise_batch_duplicate_ss, categorise_all_ss
 
 
 def calculate_id(ss):
@@ -72,3 +72,25 @@ class TestCategoriseSsExist(TestCase):
         annotated_ssids = categorise_batch_duplicate_ss(self.mongo_db, ssids, assembly_accession='GCA_000181335.4')
         pprint(annotated_ssids)
 
+    def test_categorise_all_ss(self):
+        resources = os.path.dirname(__file__)
+        duplicate_ss_file = os.path.join(resources, 'duplicate_ss.txt')
+        output_file = os.path.join(resources, 'duplicate_ss_categorised.tsv')
+        with open(duplicate_ss_file, 'w') as open_file:
+            open_file.write('2 GCA_000181335.4 1000\n2 GCA_000181335.4 1001\n2 GCA_000181335.3 1001\n')
+        try:
+            summary = categorise_all_ss(self.mongo_db, duplicate_ss_file, output_file, batch_size='1', num_workers=2)
+            with open(output_file) as open_file:
+                assert open_file.readlines() == [
+                    '1001\tGCA_000181335.4\tIn_original_assembly,Multi_position_ssid,Remapped\n'
+                ]
+            assert summary[('GCA_000181335.4', 'Remapped')] == 1
+
+            # All the batches are recorded as done so nothing is processed again
+            categorise_all_ss(self.mongo_db, duplicate_ss_file, output_file, batch_size=1, num_workers=2)
+            with open(output_file) as open_file:
+                assert len(open_file.readlines()) == 1
+        finally:
+            for file_path in [duplicate_ss_file, output_file, output_file + '.resume']:
+                if os.path.exists(file_path):
+                    os.remove(file_path)
@@ -7,6 +7,7 @@ from datetime import datetime
 from itertools import islice
 
 import pymongo.read_preferences
+from bson import json_util
 from ebi_eva_common_pyutils.logger import logging_config
 from ebi_eva_common_pyutils.mongodb import MongoDatabase
 from pymongo.read_concern import ReadConcern
@@ -41,7 +42,7 @@ def get_clustered_SHA1(variant_rec):
     return get_SHA1('_'.join([str(variant_rec[key]) for key in keys]))
 
 
-def fix_discordant_variants(mongo_source, assembly, rs_file, batch_size=1000):
+def fix_discordant_variants(mongo_source, assembly, rs_file, batch_size=1000, split_candidates_handle=None):
     logger.info(f"\n\nStarted processing assembly : {assembly}")
 
     with open(rs_file, 'r') as rs_file:
@@ -141,6 +142,8 @@ def fix_discordant_variants(mongo_source, assembly, rs_file, batch_size=1000):
                     else:
                         logger.error(
                             f"For RS {rs}, Not all original SS has same info. Case for Split: \nSS Records {ss_records}")
+                        if split_candidates_handle:
+                            split_candidates_handle.write(json_util.dumps({'rs': rs, 'ss_records': ss_records}) + '\n')
 
                 rs_list = rs_list_to_process.copy()
                 rs_list_to_process.clear()
@@ -401,6 +404,9 @@ if __name__ == "__main__":
                         help="Full path to the Mongo Source secrets file (ex: /path/to/mongo/source/secret)",
                         required=True)
     parser.add_argument("--discordant-rs-dir", help="File containing discordant rs ids", required=True)
+    parser.add_argument("--split-candidates-file",
+                        help="JSON Lines file where the SS records of the RS that need to be split are written",
+                        required=False)
     args = parser.parse_args()
 
     mongo_source = MongoDatabase(uri=args.mongo_source_uri, secrets_file=args.mongo_source_secrets_file,
@@ -409,8 +415,12 @@ if __name__ == "__main__":
     # Sometimes the cluster creates hidden files like .nfs<numeric ID> in the folder when a file is being read. So we just want to focus on the ones that start with GCA
     all_files = [os.path.join(args.discordant_rs_dir, filename) for filename in os.listdir(args.discordant_rs_dir) if
                  filename.startswith("GCA")]
+    split_candidates_handle = open(args.split_candidates_file, 'a') if args.split_candidates_file else None
     for file in sorted(all_files, key=lambda x: os.stat(x).st_size):
         assembly = os.path.basename(file)
-        fix_discordant_variants(mongo_source, assembly, os.path.join(args.discordant_rs_dir, assembly))
+        fix_discordant_variants(mongo_source, assembly, os.path.join(args.discordant_rs_dir, assembly),
+                                split_candidates_handle=split_candidates_handle)
+    if split_candidates_handle:
+        split_candidates_handle.close()
 
     logger.info(f"Process Finished")
@@ -14,11 +14,15 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 import argparse
+import fcntl
 import os
-import re
 import shutil
 import sys
-import urllib
+import threading
+import time
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
 from copy import copy
 from csv import DictReader, excel_tab, DictWriter
 from typing import List, Dict
@@ -34,6 +38,40 @@ sys.path.append(os.path.dirname(__file__))
 
 from remapping_config import load_config
 
+efetch_url = 'https://eutils.ncbi.nlm.nih.gov/entrez/eutils/efetch.fcgi'
+efetch_batch_size = 100
+efetch_workers = 4
+fasta_line_length = 70
+# ioctl request cloning a file on Linux (see ioctl_ficlone(2))
+FICLONE = 0x40049409
+
+
+class RateLimiter:
+    """Spread the calls made from all threads so that no more than max_rate start in any second."""
+
+    def __init__(self, max_rate):
+        self.interval = 1.0 / max_rate
+        self.next_call = 0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            wait_time = self.next_call - now
+            self.next_call = max(now, self.next_call) + self.interval
+        if wait_time > 0:
+            time.sleep(wait_time)
+
+
+def clone_or_copy(source, destination):
+    """Clone the file sharing its blocks when the filesystem supports it (btrfs, xfs) and copy it otherwise."""
+    with open(source, 'rb') as source_file, open(destination, 'wb') as destination_file:
+        try:
+            fcntl.ioctl(destination_file.fileno(), FICLONE, source_file.fileno())
+        except OSError:
+            shutil.copyfileobj(source_file, destination_file, 16 * 1024 * 1024)
+    shutil.copystat(source, destination)
+
 
 class CustomAssembly(AppLogger):
     """
@@ -47,6 +85,8 @@ class CustomAssembly(AppLogger):
         self.assembly_report_path = assembly_report_path
         self.eutils_api_key = eutils_api_key or cfg.get('eutils_api_key')
         self.assembly_report_headers = None
+        # NCBI allows 10 requests per second with an API key and 3 without
+        self.eutils_rate_limiter = RateLimiter(10 if self.eutils_api_key else 3)
 
     @property
     def output_assembly_report_path(self):
@@ -117,21 +157,47 @@ class CustomAssembly(AppLogger):
         return [contig_dict for contig_dict in self.required_contigs if contig_dict['genbank'] not in genbank_contigs]
 
     @staticmethod
-    def get_contig_accessions_in_fasta(fasta_path):
-        written_contigs = []
-        match = re.compile(r'>(.*?)\s')
-        if os.path.isfile(fasta_path):
-            with open(fasta_path, 'r') as file:
-                for line in file:
-                    written_contigs.extend(match.findall(line))
-        return written_contigs
+    def build_fasta_index(fasta_path):
+        """Write the samtools compatible .fai index of the fasta file."""
+        index = []
+        name = length = offset = line_bases = line_width = None
+        position = 0
+        with open(fasta_path, 'rb') as open_file:
+            for line in open_file:
+                if line.startswith(b'>'):
+                    if name:
+                        index.append((name, length, offset, line_bases, line_width))
+                    name = line[1:].split()[0].decode()
+                    length, offset, line_bases, line_width = 0, position + len(line), None, None
+                elif line.strip():
+                    if line_bases is None:
+                        line_bases, line_width = len(line.rstrip(b'\r\n')), len(line)
+                    length += len(line.rstrip(b'\r\n'))
+                position += len(line)
+        if name:
+            index.append((name, length, offset, line_bases, line_width))
+        with open(fasta_path + '.fai', 'w') as open_index:
+            for entry in index:
+                open_index.write('\t'.join(str(value) for value in entry) + '\n')
+
+    @classmethod
+    def get_contig_accessions_in_fasta(cls, fasta_path):
+        """Return the contigs present in the fasta from its .fai index, building the index if missing or outdated."""
+        if not os.path.isfile(fasta_path):
+            return []
+        index_path = fasta_path + '.fai'
+        if not os.path.isfile(index_path) or os.path.getmtime(index_path) < os.path.getmtime(fasta_path):
+            cls.build_fasta_index(fasta_path)
+        with open(index_path) as open_index:
+            return [line.split('\t')[0] for line in open_index]
 
     @retry(tries=4, delay=2, backoff=1.2, jitter=(1, 3))
-    def download_contig_from_ncbi(self, contig_accession):
-        sequence_tmp_path = os.path.join(self.assembly_directory, contig_accession + '.fa')
+    def download_contigs_from_ncbi(self, contig_accessions):
+        """Download the sequences of the contigs in a single efetch call and return the path of the fasta file."""
+        sequence_tmp_path = os.path.join(self.assembly_directory, contig_accessions[0] + '_batch.fa')
         parameters = {
             'db': 'nuccore',
-            'id': contig_accession,
+            'id': ','.join(contig_accessions),
             'rettype': 'fasta',
             'retmode': 'text',
             'tool': 'eva',
@@ -139,11 +205,81 @@ class CustomAssembly(AppLogger):
         }
         if self.eutils_api_key:
             parameters['api_key'] = self.eutils_api_key
-        url = 'https://eutils.ncbi.nlm.nih.gov/entrez/eutils/efetch.fcgi?' + urllib.parse.urlencode(parameters)
-        self.info('Downloading ' + contig_accession)
-        urllib.request.urlretrieve(url, sequence_tmp_path)
+        self.info(f'Downloading {len(contig_accessions)} contigs starting with {contig_accessions[0]}')
+        self.eutils_rate_limiter.wait()
+        # POST the ids so that the size of the batch is not limited by the length of the url
+        with urllib.request.urlopen(efetch_url, data=urllib.parse.urlencode(parameters).encode()) as response, \
+                open(sequence_tmp_path, 'wb') as open_file:
+            shutil.copyfileobj(response, open_file)
+        downloaded_contigs = set(self.get_contig_accessions_in_fasta(sequence_tmp_path))
+        missing_contigs = [contig for contig in contig_accessions if contig not in downloaded_contigs]
+        if missing_contigs:
+            raise ValueError(f'Contigs {", ".join(missing_contigs)} are missing from the efetch response')
+        os.remove(sequence_tmp_path + '.fai')
         return sequence_tmp_path
 
+    def download_all_contigs_from_ncbi(self, contig_accessions):
+        """
+        Download the contigs in batches of efetch_batch_size, several batches at a time within the NCBI rate limit.
+        Return the paths of the fasta files in the order of the contigs.
+        """
+        batches = [contig_accessions[i:i + efetch_batch_size]
+                   for i in range(0, len(contig_accessions), efetch_batch_size)]
+        with ThreadPoolExecutor(max_workers=efetch_workers) as executor:
+            return list(executor.map(self.download_contigs_from_ncbi, batches))
+
+    @staticmethod
+    def append_contigs_to_fasta(fasta_path, sequence_paths):
+        """
+        Append the sequences to the fasta file in place, wrapping them at a fixed width, and add their entries to the
+        .fai index which must be up to date before the call.
+        """
+        index_entries = []
+        rebuild_index = False
+        with open(fasta_path, 'rb+') as fasta:
+            fasta.seek(0, os.SEEK_END)
+            position = fasta.tell()
+            # Make sure the first appended header starts on its own line
+            if position > 0:
+                fasta.seek(-1, os.SEEK_END)
+                if fasta.read(1) != b'\n':
+                    fasta.write(b'\n')
+                    position += 1
+                    # The line width of the last contig changes with the new line
+                    rebuild_index = True
+            for sequence_path in sequence_paths:
+                for header, sequence in CustomAssembly._read_fasta_records(sequence_path):
+                    header_line = (header + '\n').encode()
+                    fasta.write(header_line)
+                    position += len(header_line)
+                    index_entries.append((header[1:].split()[0], len(sequence), position, fasta_line_length,
+                                          fasta_line_length + 1))
+                    for start in range(0, len(sequence), fasta_line_length):
+                        sequence_line = (sequence[start:start + fasta_line_length] + '\n').encode()
+                        fasta.write(sequence_line)
+                        position += len(sequence_line)
+        if rebuild_index:
+            CustomAssembly.build_fasta_index(fasta_path)
+            return
+        with open(fasta_path + '.fai', 'a') as open_index:
+            for entry in index_entries:
+                open_index.write('\t'.join(str(value) for value in entry) + '\n')
+
+    @staticmethod
+    def _read_fasta_records(fasta_path):
+        header, sequence_lines = None, []
+        with open(fasta_path) as open_file:
+            for line in open_file:
+                line = line.strip()
+                if line.startswith('>'):
+                    if header:
+                        yield header, ''.join(sequence_lines)
+                    header, sequence_lines = line, []
+                elif line:
+                    sequence_lines.append(line)
+        if header:
+            yield header, ''.join(sequence_lines)
+
     def generate_assembly_report(self):
         if self.genbank_contig_to_add:
             self.info(f'Create custom assembly report for {self.assembly_accession}')
@@ -157,28 +293,32 @@ class CustomAssembly(AppLogger):
 
     def generate_fasta(self):
         """
-        Check if custom contig needs to be added to the assembly. If yes then copy the fasta file and append the new
-        contigs otherwise create a symlink to the normal assembly.
+        Check if custom contig needs to be added to the assembly. If yes then append the new contigs to the custom
+        fasta, creating it as a clone of the assembly fasta the first time, otherwise create a symlink to the normal
+        assembly. Contigs already present in an existing custom fasta are not downloaded again.
         """
         if self.genbank_contig_to_add:
             self.info(f'Create custom assembly fasta for {self.assembly_accession}')
-            written_contigs = self.get_contig_accessions_in_fasta(self.assembly_fasta_path)
+            custom_fasta_exists = os.path.isfile(self.output_assembly_fasta_path) and \
+                not os.path.islink(self.output_assembly_fasta_path)
+            if custom_fasta_exists:
+                written_contigs = set(self.get_contig_accessions_in_fasta(self.output_assembly_fasta_path))
+            else:
+                written_contigs = set(self.get_contig_accessions_in_fasta(self.assembly_fasta_path))
             # Now find out what are the contigs that needs to be appended to the assembly
-            contig_to_append = []
-            for contig_dict in self.genbank_contig_to_add:
-                if contig_dict['genbank'] not in written_contigs:
-                    contig_to_append.append(self.download_contig_from_ncbi(contig_dict['genbank']))
+            contig_to_append = [contig_dict['genbank'] for contig_dict in self.genbank_contig_to_add
+                                if contig_dict['genbank'] not in written_contigs]
             if contig_to_append:
-                shutil.copy(self.assembly_fasta_path, self.output_assembly_fasta_path, follow_symlinks=True)
-                with open(self.output_assembly_fasta_path, 'a+') as fasta:
-                    for contig_path in contig_to_append:
-                        with open(contig_path) as sequence:
-                            for line in sequence:
-                                # Check that the line is not empty
-                                if line.strip():
-                                    fasta.write(line)
-                        os.remove(contig_path)
-            else:
+                sequence_paths = self.download_all_contigs_from_ncbi(contig_to_append)
+                if not custom_fasta_exists:
+                    if os.path.islink(self.output_assembly_fasta_path):
+                        os.remove(self.output_assembly_fasta_path)
+                    clone_or_copy(self.assembly_fasta_path, self.output_assembly_fasta_path)
+                    clone_or_copy(self.assembly_fasta_path + '.fai', self.output_assembly_fasta_path + '.fai')
+                self.append_contigs_to_fasta(self.output_assembly_fasta_path, sequence_paths)
+                for sequence_path in sequence_paths:
+                    os.remove(sequence_path)
+            elif not os.path.exists(self.output_assembly_fasta_path):
                 os.symlink(self.assembly_fasta_path, self.output_assembly_fasta_path)
         else:
             os.symlink(self.assembly_fasta_path, self.output_assembly_fasta_path)
@@ -1,16 +1,27 @@
 import argparse
+import datetime
+import json
 import os
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 
 import requests
 from ebi_eva_common_pyutils.config_utils import get_contig_alias_db_creds_for_profile
 from ebi_eva_common_pyutils.logger import logging_config
 from ebi_eva_common_pyutils.metadata_utils import get_metadata_connection_handle
 from ebi_eva_common_pyutils.pg_utils import get_all_results_for_query
-from retry import retry
+from retry.api import retry_call
 
 logging_config.add_stdout_handler()
 logger = logging_config.get_logger(__name__)
 
+LOADED = 'loaded'
+ALREADY_PRESENT = 'already_present'
+FAILED = 'failed'
+SKIPPED = 'skipped'
+
 
 class InternalServerError(Exception):
     pass
@@ -25,54 +36,152 @@ def get_assemblies_from_evapro(profile, private_config_xml_file):
         return [asm[0] for asm in evapro_assemblies]
 
 
-def load_assembly_to_contig_alias(assemblies, contig_alias_url, contig_alias_user, contig_alias_pass, overwrite):
-    logger.info(f"A total of {len(assemblies)} assemblies to be loaded into contig-alias database: {assemblies}")
-
-    for assembly in assemblies:
-        full_url = os.path.join(contig_alias_url, f'v1/admin/assemblies/{assembly}')
-        if overwrite:
-            # delete request for assembly
-            del_request(assembly, full_url, contig_alias_user, contig_alias_pass)
-
+class LoadState:
+    """
+    JSON file recording the outcome of the last load of each assembly: its status, how long it took, the error if it
+    failed and when it happened. The file is rewritten after each assembly so that an interrupted run loses nothing.
+    """
+
+    def __init__(self, state_file):
+        self.state_file = state_file
+        self.lock = threading.Lock()
+        self.outcomes = {}
+        if state_file and os.path.isfile(state_file):
+            with open(state_file) as open_file:
+                self.outcomes = json.load(open_file)
+
+    def get(self, assembly):
+        return self.outcomes.get(assembly)
+
+    def is_loaded(self, assembly):
+        return (self.get(assembly) or {}).get('status') in (LOADED, ALREADY_PRESENT)
+
+    def set(self, assembly, outcome):
+        with self.lock:
+            self.outcomes[assembly] = outcome
+            if self.state_file:
+                with open(self.state_file + '.tmp', 'w') as open_file:
+                    json.dump(self.outcomes, open_file, indent=2, sort_keys=True)
+                os.replace(self.state_file + '.tmp', self.state_file)
+
+
+class ContigAliasLoader:
+    """
+    Load assemblies into the contig-alias database with concurrent requests. Each request is retried with an
+    exponential backoff on 5xx responses and connection errors, and the outcome of each assembly is saved in the state
+    file. Assemblies already loaded are skipped unless they are overwritten.
+    """
+
+    def __init__(self, contig_alias_url, contig_alias_user, contig_alias_pass, state_file=None, num_workers=4,
+                 tries=5, delay=2, backoff=2, max_delay=300, timeout=3600):
+        self.contig_alias_url = contig_alias_url
+        self.auth = (contig_alias_user, contig_alias_pass)
+        self.state = LoadState(state_file)
+        self.num_workers = num_workers
+        self.tries = tries
+        self.delay = delay
+        self.backoff = backoff
+        self.max_delay = max_delay
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=num_workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def _request(self, method, url):
+        response = self.session.request(method, url, auth=self.auth, timeout=self.timeout)
+        if response.status_code >= 500:
+            raise InternalServerError(f'{response.status_code} {response.text}')
+        return response
+
+    def _request_with_retry(self, method, url):
+        return retry_call(self._request, fargs=[method, url],
+                          exceptions=(InternalServerError, requests.ConnectionError), tries=self.tries,
+                          delay=self.delay, backoff=self.backoff, max_delay=self.max_delay, logger=logger)
+
+    def del_request(self, assembly, url):
+        response = self._request_with_retry('DELETE', url)
+        if response.status_code == 200:
+            logger.info(f'Assembly accession {assembly} successfully deleted from Contig-Alias DB')
+        else:
+            logger.error(f'Assembly accession {assembly} could not be deleted. Response: {response.text}')
+
+    def insert_request(self, assembly, url):
+        response = self._request_with_retry('PUT', url)
+        if response.status_code == 200:
+            logger.info(f'Assembly accession {assembly} successfully added to Contig-Alias DB')
+            return LOADED, None
+        elif response.status_code == 409:
+            logger.warning(f'Assembly accession {assembly} already exist in Contig-Alias DB. Response: {response.text}')
+            return ALREADY_PRESENT, None
+        else:
+            logger.error(f'Could not save Assembly accession {assembly} to Contig-Alias DB. Error : {response.text}')
+            return FAILED, f'{response.status_code} {response.text}'
+
+    def load_assembly(self, assembly, overwrite):
+        if not overwrite and self.state.is_loaded(assembly):
+            logger.info(f'Assembly accession {assembly} already loaded in a previous run')
+            return SKIPPED
+        full_url = os.path.join(self.contig_alias_url, f'v1/admin/assemblies/{assembly}')
+        start_time = time.perf_counter()
         try:
+            if overwrite:
+                # delete request for assembly
+                self.del_request(assembly, full_url)
             # insert request for assembly
-            insert_request(assembly, full_url, contig_alias_user, contig_alias_pass)
-        except InternalServerError as err:
+            status, error = self.insert_request(assembly, full_url)
+        except (InternalServerError, requests.RequestException) as err:
             logger.error(f'Could not save Assembly accession {assembly} to Contig-Alias DB. Error : {err}')
-
-
-@retry(InternalServerError, tries=3, delay=2, backoff=1.5, jitter=(1, 3))
-def del_request(assembly, url, user, password):
-    response = requests.delete(url, auth=(user, password))
-    if response.status_code == 200:
-        logger.info(f'Assembly accession {assembly} successfully deleted from Contig-Alias DB')
-    elif response.status_code == 500:
-        logger.error(f'Assembly accession {assembly} could not be deleted. Response: {response.text}')
-        raise InternalServerError
-    else:
-        logger.error(f'Assembly accession {assembly} could not be deleted. Response: {response.text}')
-
-
-@retry(InternalServerError, tries=3, delay=2, backoff=1.5, jitter=(1, 3))
-def insert_request(assembly, url, user, password):
-    response = requests.put(url, auth=(user, password))
-    if response.status_code == 200:
-        logger.info(f'Assembly accession {assembly} successfully added to Contig-Alias DB')
-    elif response.status_code == 409:
-        logger.warning(f'Assembly accession {assembly} already exist in Contig-Alias DB. Response: {response.text}')
-    elif response.status_code == 500:
-        logger.error(f'Could not save Assembly accession {assembly} to Contig-Alias DB. Error : {response.text}')
-        raise InternalServerError
-    else:
-        logger.error(f'Could not save Assembly accession {assembly} to Contig-Alias DB. Error : {response.text}')
-
-
-def load_data_to_contig_alias(private_config_xml_file, profile, assembly_list, overwrite):
+            status, error = FAILED, str(err)
+        self.state.set(assembly, {
+            'status': status,
+            'seconds': round(time.perf_counter() - start_time, 3),
+            'error': error,
+            'updated': datetime.datetime.now().isoformat(timespec='seconds')
+        })
+        return status
+
+    def load_assemblies(self, assemblies, overwrite):
+        """Returns the status of each assembly."""
+        with ThreadPoolExecutor(max_workers=self.num_workers) as executor:
+            statuses = executor.map(lambda assembly: self.load_assembly(assembly, overwrite), assemblies)
+            return dict(zip(assemblies, statuses))
+
+    def close(self):
+        self.session.close()
+
+
+def log_summary(statuses, state, elapsed_seconds):
+    counts = Counter(statuses.values())
+    logger.info(f'Processed {len(statuses)} assemblies in {elapsed_seconds:.1f}s: ' +
+                ', '.join(f'{counts[status]} {status}' for status in [LOADED, ALREADY_PRESENT, SKIPPED, FAILED]))
+    for assembly, status in statuses.items():
+        if status == FAILED:
+            logger.error(f'Failed to load {assembly}: {state.get(assembly)["error"]}')
+
+
+def load_assembly_to_contig_alias(assemblies, contig_alias_url, contig_alias_user, contig_alias_pass, overwrite,
+                                  state_file=None, num_workers=4, **loader_options):
+    logger.info(f"A total of {len(assemblies)} assemblies to be loaded into contig-alias database: {assemblies}")
+    start_time = time.perf_counter()
+    loader = ContigAliasLoader(contig_alias_url, contig_alias_user, contig_alias_pass, state_file=state_file,
+                               num_workers=num_workers, **loader_options)
+    try:
+        statuses = loader.load_assemblies(assemblies, overwrite)
+    finally:
+        loader.close()
+    log_summary(statuses, loader.state, time.perf_counter() - start_time)
+    return statuses
+
+
+def load_data_to_contig_alias(private_config_xml_file, profile, assembly_list, overwrite, state_file=None,
+                              num_workers=4):
     assemblies = assembly_list if assembly_list else get_assemblies_from_evapro(profile, private_config_xml_file)
     contig_alias_url, contig_alias_user, contig_alias_pass = get_contig_alias_db_creds_for_profile(
         profile, private_config_xml_file)
 
-    load_assembly_to_contig_alias(assemblies, contig_alias_url, contig_alias_user, contig_alias_pass, overwrite)
+    return load_assembly_to_contig_alias(assemblies, contig_alias_url, contig_alias_user, contig_alias_pass, overwrite,
+                                         state_file=state_file, num_workers=num_workers)
 
 
 if __name__ == "__main__":
@@ -82,9 +191,14 @@ if __name__ == "__main__":
                         help="Profile to decide whether to run this for development or production", required=True)
     parser.add_argument("--assembly-list", help="Assembly list e.g. GCA_000181335.4", required=False, nargs='+')
     parser.add_argument("--overwrite", action="store_true", default=False,
-                        help="Whether to delete and re-insert assembly information")
+                        help="Whether to delete and re-insert assembly information, including the assemblies "
+                             "already loaded according to the state file")
+    parser.add_argument("--state-file", default='contig_alias_load_state.json',
+                        help="JSON file where the outcome of each assembly is recorded")
+    parser.add_argument("--num-workers", type=int, default=4,
+                        help="Number of assemblies loaded concurrently")
 
     args = parser.parse_args()
 
-    load_data_to_contig_alias(args.private_config_xml_file, args.profile, args.assembly_list, args.overwrite)
-
+    load_data_to_contig_alias(args.private_config_xml_file, args.profile, args.assembly_list, args.overwrite,
+                              state_file=args.state_file, num_workers=args.num_workers)
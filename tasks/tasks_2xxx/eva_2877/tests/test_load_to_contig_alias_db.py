@@ -0,0 +1,111 @@
+import json
+import os
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import TestCase
+
+from tasks.eva_2877.load_to_contig_alias_db import load_assembly_to_contig_alias, LOADED, ALREADY_PRESENT, \
+    FAILED, SKIPPED
+
+
+class StubContigAliasHandler(BaseHTTPRequestHandler):
+
+    def do_PUT(self):
+        assembly = self.path.rsplit('/', 1)[-1]
+        self.server.requests.append(('PUT', assembly))
+        if self.server.failures.get(assembly, 0) > 0:
+            self.server.failures[assembly] -= 1
+            self.send_text('Internal error', status=503)
+        elif assembly in self.server.rejected:
+            self.send_text('Bad request', status=400)
+        elif assembly in self.server.assemblies:
+            self.send_text('Already exists', status=409)
+        else:
+            self.server.assemblies.add(assembly)
+            self.send_text('Loaded')
+
+    def do_DELETE(self):
+        assembly = self.path.rsplit('/', 1)[-1]
+        self.server.requests.append(('DELETE', assembly))
+        self.server.assemblies.discard(assembly)
+        self.send_text('Deleted')
+
+    def send_text(self, text, status=200):
+        body = text.encode()
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestLoadToContigAliasDb(TestCase):
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('localhost', 0), StubContigAliasHandler)
+        self.server.requests = []
+        self.server.assemblies = {'GCA_000000003.1'}
+        self.server.failures = {}
+        self.server.rejected = set()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = f'http://localhost:{self.server.server_port}/'
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.state_file = os.path.join(self.tmp_dir.name, 'state.json')
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.tmp_dir.cleanup()
+
+    def load(self, assemblies, overwrite=False):
+        return load_assembly_to_contig_alias(assemblies, self.url, 'user', 'pass', overwrite,
+                                             state_file=self.state_file, num_workers=3, tries=3, delay=0.01)
+
+    def test_load_assemblies(self):
+        self.server.failures = {'GCA_000000002.1': 2, 'GCA_000000004.1': 3}
+        self.server.rejected = {'GCA_000000005.1'}
+        statuses = self.load(['GCA_000000001.1', 'GCA_000000002.1', 'GCA_000000003.1', 'GCA_000000004.1',
+                              'GCA_000000005.1'])
+        assert statuses == {
+            'GCA_000000001.1': LOADED,
+            # Loaded after two retries
+            'GCA_000000002.1': LOADED,
+            'GCA_000000003.1': ALREADY_PRESENT,
+            # Still failing after three tries
+            'GCA_000000004.1': FAILED,
+            'GCA_000000005.1': FAILED
+        }
+        assert self.server.requests.count(('PUT', 'GCA_000000004.1')) == 3
+        assert self.server.requests.count(('PUT', 'GCA_000000005.1')) == 1
+        with open(self.state_file) as open_file:
+            state = json.load(open_file)
+        assert state['GCA_000000002.1']['status'] == LOADED
+        assert state['GCA_000000004.1']['error'] == '503 Internal error'
+        assert state['GCA_000000005.1']['error'] == '400 Bad request'
+        assert all(outcome['seconds'] >= 0 for outcome in state.values())
+
+    def test_skip_loaded_assemblies(self):
+        self.server.rejected = {'GCA_000000002.1'}
+        self.load(['GCA_000000001.1', 'GCA_000000002.1', 'GCA_000000003.1'])
+        self.server.rejected = set()
+        self.server.requests = []
+
+        statuses = self.load(['GCA_000000001.1', 'GCA_000000002.1', 'GCA_000000003.1'])
+        # Only the assembly that failed is loaded again
+        assert statuses == {'GCA_000000001.1': SKIPPED, 'GCA_000000002.1': LOADED, 'GCA_000000003.1': SKIPPED}
+        assert self.server.requests == [('PUT', 'GCA_000000002.1')]
+
+        statuses = self.load(['GCA_000000001.1'], overwrite=True)
+        assert statuses == {'GCA_000000001.1': LOADED}
+        assert self.server.requests[1:] == [('DELETE', 'GCA_000000001.1'), ('PUT', 'GCA_000000001.1')]
+
+    def test_connection_error(self):
+        self.server.shutdown()
+        self.server.server_close()
+        statuses = self.load(['GCA_000000001.1'])
+        assert statuses == {'GCA_000000001.1': FAILED}
+        with open(self.state_file) as open_file:
+            assert 'Connection' in json.load(open_file)['GCA_000000001.1']['error']
@@ -1,18 +1,26 @@
 import argparse
 import os
 import sys
+from collections import defaultdict, namedtuple, deque
+from multiprocessing import Pool
 
 import itertools
 
-from Bio import pairwise2
+from Bio.Align import PairwiseAligner
 from Bio.Seq import Seq
-from ebi_eva_common_pyutils.command_utils import run_command_with_output
 from ebi_eva_common_pyutils.config import cfg
 from ebi_eva_common_pyutils.config_utils import get_primary_mongo_creds_for_profile
 from ebi_eva_common_pyutils.taxonomy.taxonomy import get_scientific_name_from_ensembl
+from pyfaidx import Fasta
 from pymongo import MongoClient
 
 cache = {'scientific_name_from_taxonomy': {}}
+# Open fasta handles of each worker process, one per genome
+fasta_handles = {}
+flank_size = 50
+# Same scoring as pairwise2.align.globalms(s1, s2, 1, -3, -10, -10)
+aligner = PairwiseAligner(mode='global', match_score=1, mismatch_score=-3, open_gap_score=-10, extend_gap_score=-10)
+FlankAlignment = namedtuple('FlankAlignment', ['score', 'seqA', 'seqB'])
 
 
 def revcomp(seq):
@@ -34,19 +42,22 @@ def get_genome(taxonomy, assembly_accession):
     )
 
 
-def compare_variant_flanks(sequence1, sequence2):
-    alignments1 = pairwise2.align.globalms(sequence1, sequence2, 1, -3, -10, -10, one_alignment_only=True)
-    alignments2 = pairwise2.align.globalms(sequence1, revcomp(sequence2), 1, -3, -10, -10, one_alignment_only=True)
+def align(sequence1, sequence2):
+    alignment = aligner.align(sequence1, sequence2)[0]
+    return FlankAlignment(alignment.score, alignment[0], alignment[1])
+
 
-    if alignments1 and alignments2:
-        if alignments2[0].score > alignments1[0].score:
-            return alignments2[0], '-'
-        else:
-            return alignments1[0], '+'
-    elif alignments1:
-        return alignments1, '+'
-    elif alignments2:
-        return alignments2, '-'
+def compare_variant_flanks(sequence1, sequence2):
+    # Identical or reverse complemented sequences have the best possible score so there is nothing to align
+    if sequence1 == sequence2:
+        return FlankAlignment(float(len(sequence1)), sequence1, sequence2), '+'
+    sequence2_revcomp = revcomp(sequence2)
+    if sequence1 == sequence2_revcomp:
+        return FlankAlignment(float(len(sequence1)), sequence1, sequence2_revcomp), '-'
+    # Only the alignment with the best score needs the traceback
+    if aligner.score(sequence1, sequence2_revcomp) > aligner.score(sequence1, sequence2):
+        return align(sequence1, sequence2_revcomp), '-'
+    return align(sequence1, sequence2), '+'
 
 
 def format_output(ssid, variant1, variant2, alignment, strand, flank_up1, flank_down1, flank_up2, flank_down2):
@@ -65,34 +76,110 @@ def format_output(ssid, variant1, variant2, alignment, strand, flank_up1, flank_
     return '\t'.join([str(s) for s in out])
 
 
-def check_submitted_variant_flanks(mongo_client, ssid):
-    samtools = cfg.query('executable', 'samtools', ret_default='samtools')
+def get_fasta(genome_assembly_fasta):
+    if genome_assembly_fasta not in fasta_handles:
+        # The .fai index is created next to the fasta if it does not exist yet
+        fasta_handles[genome_assembly_fasta] = Fasta(genome_assembly_fasta, as_raw=True, sequence_always_upper=True)
+    return fasta_handles[genome_assembly_fasta]
+
+
+def get_flanks(genome_assembly_fasta, contig, start):
+    # Same 1-based regions as samtools faidx contig:start-50-start-1 and contig:start+1-start+50
+    sequence = get_fasta(genome_assembly_fasta)[contig]
+    flank_up = sequence[max(start - flank_size - 1, 0):start - 1]
+    flank_down = sequence[start:start + flank_size]
+    return flank_up, flank_down
+
+
+def get_submitted_variants(mongo_client, ssids):
+    """Returns the variant records of each ssid, retrieved with a single query for the whole batch."""
     sve_collection = mongo_client['eva_accession_sharded']['dbsnpSubmittedVariantEntity']
-    cursor = sve_collection.find({'accession': int(ssid), 'remappedFrom': {'$exists': False}})
-    flank_size = 50
-    variant_records = list(cursor)
+    variant_records_per_ssid = defaultdict(list)
+    cursor = sve_collection.find({'accession': {'$in': [int(ssid) for ssid in ssids]},
+                                  'remappedFrom': {'$exists': False}})
+    for variant_rec in cursor:
+        variant_records_per_ssid[variant_rec['accession']].append(variant_rec)
+    return variant_records_per_ssid
+
+
+def check_submitted_variant_flanks(ssid, variant_records):
+    """Compare the flanks of every pair of variant records of the ssid and return the output lines."""
     id_2_info = {}
     for variant_rec in variant_records:
-        flank_up_coord = f"{variant_rec['contig']}:{variant_rec['start'] - flank_size}-{variant_rec['start'] - 1}"
-        flank_down_coord = f"{variant_rec['contig']}:{variant_rec['start'] + 1}-{variant_rec['start'] + flank_size}"
-        genome_assembly_fasta = get_genome(assembly_accession=variant_rec['seq'], taxonomy=variant_rec['tax'])
-        command = f"{samtools} faidx {genome_assembly_fasta} {flank_up_coord} | grep -v '^>' | sed 's/\\n//' "
-        flank_up = run_command_with_output(f'Extract upstream sequence using {flank_up_coord}',  command, return_process_output=True).strip().upper()
-        command = f"{samtools} faidx {genome_assembly_fasta} {flank_down_coord} | grep -v '^>' | sed 's/\\n//' "
-        flank_down = run_command_with_output(f'Extract downstream sequence using {flank_down_coord}',  command, return_process_output=True).strip().upper()
+        flank_up, flank_down = get_flanks(variant_rec['genome'], variant_rec['contig'], variant_rec['start'])
         id_2_info[variant_rec['_id']] = {'variant_rec': variant_rec, 'flank_up': flank_up, 'flank_down': flank_down}
 
-    for variant_id1, variant_id2 in list(itertools.combinations(id_2_info, 2)):
+    outputs = []
+    for variant_id1, variant_id2 in itertools.combinations(id_2_info, 2):
         alignment, strand = compare_variant_flanks(
             id_2_info[variant_id1]['flank_up'] + id_2_info[variant_id1]['variant_rec']['ref'] + id_2_info[variant_id1]['flank_down'],
             id_2_info[variant_id2]['flank_up'] + id_2_info[variant_id2]['variant_rec']['ref'] + id_2_info[variant_id2]['flank_down']
         )
-        output = format_output(
+        outputs.append(format_output(
             ssid, id_2_info[variant_id1]['variant_rec'], id_2_info[variant_id2]['variant_rec'], alignment, strand,
             id_2_info[variant_id1]['flank_up'], id_2_info[variant_id1]['flank_down'],
             id_2_info[variant_id2]['flank_up'], id_2_info[variant_id2]['flank_down']
-        )
-        print(output)
+        ))
+    return outputs
+
+
+def check_batch(batch):
+    outputs = [output for ssid, variant_records in batch
+               for output in check_submitted_variant_flanks(ssid, variant_records)]
+    return len(batch), outputs
+
+
+def read_ssid_batches(ssid_file, batch_size):
+    batch = []
+    with open(ssid_file) as open_file:
+        for line in open_file:
+            if line.strip():
+                batch.append(line.strip())
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+    if batch:
+        yield batch
+
+
+def get_variant_batches(mongo_client, ssid_file, batch_size):
+    """
+    Yield each batch of ssids with their variant records, in the order of the ssid file. The genome of each record is
+    resolved here so that the worker processes only need to read the fasta files.
+    """
+    for ssids in read_ssid_batches(ssid_file, batch_size):
+        variant_records_per_ssid = get_submitted_variants(mongo_client, ssids)
+        batch = []
+        for ssid in ssids:
+            variant_records = variant_records_per_ssid.get(int(ssid), [])
+            for variant_rec in variant_records:
+                variant_rec['genome'] = get_genome(assembly_accession=variant_rec['seq'], taxonomy=variant_rec['tax'])
+            batch.append((ssid, variant_records))
+        yield batch
+
+
+def check_all_submitted_variant_flanks(mongo_client, ssid_file, output_file, batch_size=5000, num_processes=4):
+    nb_ssids = 0
+
+    def write_batch(result):
+        nonlocal nb_ssids
+        nb_batch_ssids, outputs = result.get()
+        for output in outputs:
+            print(output, file=output_file)
+        nb_ssids += nb_batch_ssids
+        print(f'Processed {nb_ssids} ssids', file=sys.stderr)
+
+    with Pool(num_processes) as pool:
+        # Only twice as many batches as processes are retrieved ahead, and the results are written in the order of
+        # the batches so the output follows the ssid file
+        pending_batches = deque()
+        for batch in get_variant_batches(mongo_client, ssid_file, batch_size):
+            pending_batches.append(pool.apply_async(check_batch, (batch,)))
+            if len(pending_batches) >= 2 * num_processes:
+                write_batch(pending_batches.popleft())
+        while pending_batches:
+            write_batch(pending_batches.popleft())
+    return nb_ssids
 
 
 def load_config(*args):
@@ -106,6 +193,9 @@ if __name__ == '__main__':
     parser.add_argument("--profile_name",
                         help="Maven profile to use when connecting to mongodb")
     parser.add_argument("--ssid_file", help="file containing a single ssid per line", type=str, required=True)
+    parser.add_argument("--batch_size", help="number of ssids retrieved and processed together", type=int,
+                        default=5000)
+    parser.add_argument("--num_processes", help="number of processes comparing the flanks", type=int, default=4)
     args = parser.parse_args()
     # Get the config file loaded
     load_config()
@@ -114,11 +204,6 @@ if __name__ == '__main__':
     mongo_host, mongo_user, mongo_pass = get_primary_mongo_creds_for_profile(profile_name, cfg['maven']['settings_file'])
     mongo_uri = f'mongodb://{mongo_user}:@{mongo_host}:27017/eva_accession_sharded?authSource=admin'
     mongo_client = MongoClient(mongo_uri, password=mongo_pass)
-    nb_ssids = 0
-    with open(args.ssid_file) as open_file:
-        for line in open_file:
-            nb_ssids += 1
-            if nb_ssids % 1000 == 0 :
-                print(f'Processed {nb_ssids} ssids', file=sys.stderr)
-            check_submitted_variant_flanks(mongo_client, line.strip())
+    check_all_submitted_variant_flanks(mongo_client, args.ssid_file, sys.stdout, batch_size=args.batch_size,
+                                       num_processes=args.num_processes)
     mongo_client.close()
@@ -0,0 +1,70 @@
+import random
+import tempfile
+import time
+from argparse import ArgumentParser
+
+from ebi_eva_common_pyutils.logger import logging_config
+from pyfaidx import Fasta
+
+from tasks.eva_2950.packed_genome import PackedGenome
+from tasks.eva_2950.split_rs_with_inconsistent_ss import add_contex_base, leftnorm
+
+logger = logging_config.get_logger(__name__)
+logging_config.add_stdout_handler()
+
+
+def random_insertions(genome, num_variants, seed=0):
+    """
+    Generate insertions of a base repeated a few times at random positions: they need to be left-aligned through
+    any homopolymer they fall in, which is the expensive case of the normalisation.
+    """
+    rng = random.Random(seed)
+    contigs = [contig for contig in genome.index if genome.index[contig][1] > 2]
+    weights = [genome.index[contig][1] for contig in contigs]
+    variants = []
+    for contig in rng.choices(contigs, weights=weights, k=num_variants):
+        pos = rng.randint(2, genome.index[contig][1])
+        variants.append((contig, pos, '', genome[contig][pos - 2] * rng.randint(1, 5)))
+    return variants
+
+
+def normalise_all(genome_object, variants):
+    results = []
+    for contig, pos, ref, alt in variants:
+        context_pos, context_ref, context_alt = add_contex_base(genome_object, contig, pos, ref, alt)
+        results.append(leftnorm(contig, context_pos, context_ref, context_alt, fa=genome_object))
+    return results
+
+
+def benchmark(fasta_path, num_variants):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        start = time.perf_counter()
+        PackedGenome.build(fasta_path, tmp_dir + '/genome.packed')
+        logger.info(f'Building the packed genome took {time.perf_counter() - start:.2f}s')
+        packed_genome = PackedGenome(tmp_dir + '/genome.packed')
+        variants = random_insertions(packed_genome, num_variants)
+
+        start = time.perf_counter()
+        pyfaidx_results = normalise_all(Fasta(fasta_path, as_raw=True, read_ahead=40000), variants)
+        pyfaidx_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        packed_results = normalise_all(packed_genome, variants)
+        packed_time = time.perf_counter() - start
+        packed_genome.close()
+
+    assert pyfaidx_results == packed_results, 'pyfaidx and packed genome normalisations differ'
+    logger.info(f'Normalised {num_variants} variants: pyfaidx {pyfaidx_time:.2f}s, packed genome {packed_time:.2f}s '
+                f'({pyfaidx_time / packed_time:.1f}x)')
+
+
+def main():
+    parser = ArgumentParser(description='Compare the normalisation speed using pyfaidx and the packed genome')
+    parser.add_argument('--fasta', required=True)
+    parser.add_argument('--num_variants', type=int, default=100000)
+    args = parser.parse_args()
+    benchmark(args.fasta, args.num_variants)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,141 @@
+import ast
+import datetime
+import re
+from typing import NamedTuple, List
+
+from bson import json_util
+
+# Split candidates are written as JSON Lines by eva_2850's fix_discordant_variants.py with --split-candidates-file.
+# Older diagnostic logs only have the python representation of the records in the log line following the split message.
+split_message = 'Not all original SS has same info'
+json_options = json_util.JSONOptions(json_mode=json_util.JSONMode.RELAXED, tz_aware=False)
+
+_token_pattern = re.compile(r'''\s*(?:
+    (?P<string>'(?:[^'\\]|\\.)*'|"(?:[^"\\]|\\.)*")|
+    (?P<number>-?\d+(?:\.\d*)?(?:[eE][-+]?\d+)?)|
+    (?P<datetime>datetime\.datetime\()|
+    (?P<constant>True|False|None)|
+    (?P<punctuation>[\[\]{}(),:])
+)''', re.VERBOSE)
+_constants = {'True': True, 'False': False, 'None': None}
+_assembly_pattern = re.compile(r'''["']seq["']\s*:\s*["']([^"']+)["']''')
+
+
+class SplitCandidate(NamedTuple):
+    rsid: int
+    ss_entities: List[dict]
+
+
+class _LiteralParser:
+    """
+    Parser for the python representation of the submitted variant documents as they appear in the logs: dicts, lists,
+    tuples, strings, numbers, booleans, None and datetime.datetime(...) calls. Nothing is evaluated.
+    """
+
+    def __init__(self, text):
+        self.text = text
+        self.position = 0
+
+    def next_token(self):
+        match = _token_pattern.match(self.text, self.position)
+        if not match:
+            raise ValueError(f'Unexpected content at position {self.position}: {self.text[self.position:][:50]}')
+        self.position = match.end()
+        return match.lastgroup, match.group(match.lastgroup)
+
+    def parse(self):
+        value = self.parse_value(*self.next_token())
+        if self.text[self.position:].strip():
+            raise ValueError(f'Unexpected content at position {self.position}: {self.text[self.position:][:50]}')
+        return value
+
+    def parse_value(self, token_type, token):
+        if token_type == 'string':
+            # Only strings with escape sequences need the full literal parsing
+            return ast.literal_eval(token) if '\\' in token else token[1:-1]
+        if token_type == 'number':
+            return float(token) if '.' in token or 'e' in token or 'E' in token else int(token)
+        if token_type == 'constant':
+            return _constants[token]
+        if token_type == 'datetime':
+            return datetime.datetime(*self.parse_items(')'))
+        if token == '[':
+            return self.parse_items(']')
+        if token == '(':
+            return tuple(self.parse_items(')'))
+        if token == '{':
+            return self.parse_dict()
+        raise ValueError(f'Unexpected {token} at position {self.position}')
+
+    def parse_items(self, closing):
+        items = []
+        token_type, token = self.next_token()
+        while token != closing:
+            items.append(self.parse_value(token_type, token))
+            token_type, token = self.next_token()
+            if token == ',':
+                token_type, token = self.next_token()
+            elif token != closing:
+                raise ValueError(f'Expected , or {closing} at position {self.position}')
+        return items
+
+    def parse_dict(self):
+        dictionary = {}
+        token_type, token = self.next_token()
+        while token != '}':
+            key = self.parse_value(token_type, token)
+            if self.next_token()[1] != ':':
+                raise ValueError(f'Expected : at position {self.position}')
+            dictionary[key] = self.parse_value(*self.next_token())
+            token_type, token = self.next_token()
+            if token == ',':
+                token_type, token = self.next_token()
+            elif token != '}':
+                raise ValueError(f'Expected , or }} at position {self.position}')
+        return dictionary
+
+
+def parse_python_literal(text):
+    return _LiteralParser(text).parse()
+
+
+def iter_raw_split_candidates(log_file):
+    """
+    Stream the split candidates of a diagnostic log or a JSON Lines file without parsing the records. Each item is a
+    tuple of the RS id (None for JSON Lines) and the text to give to parse_raw_split_candidate.
+    """
+    rsid = None
+    with open(log_file) as open_file:
+        for line in open_file:
+            if line.startswith('{'):
+                yield None, line
+                continue
+            line = line.strip()
+            if rsid:
+                # We are parsing the line just after finding the RS id
+                yield rsid, line[11:]
+                rsid = None
+            if split_message in line:
+                sp_line = line.split()
+                rsid = int(sp_line[4].strip(','))
+
+
+def get_assemblies(log_file):
+    """Returns the assemblies of the split candidates found in the log, without parsing the records."""
+    assemblies = set()
+    for _, text in iter_raw_split_candidates(log_file):
+        assemblies.update(_assembly_pattern.findall(text))
+    return assemblies
+
+
+def parse_raw_split_candidate(raw_split_candidate):
+    rsid, text = raw_split_candidate
+    if rsid is None:
+        split_candidate = json_util.loads(text, json_options=json_options)
+        return SplitCandidate(split_candidate['rs'], split_candidate['ss_records'])
+    return SplitCandidate(rsid, parse_python_literal(text))
+
+
+def parse_diagnostic_log(log_file):
+    for raw_split_candidate in iter_raw_split_candidates(log_file):
+        yield parse_raw_split_candidate(raw_split_candidate)
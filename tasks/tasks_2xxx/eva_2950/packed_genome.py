@@ -0,0 +1,115 @@
+import json
+import mmap
+import os
+import shutil
+import tempfile
+
+from ebi_eva_common_pyutils.logger import logging_config
+
+logger = logging_config.get_logger(__name__)
+
+sequence_file_name = 'sequences.bin'
+index_file_name = 'index.json'
+
+
+class PackedContig:
+    """
+    Read-only view of one contig in the packed genome that can be indexed and sliced like pyfaidx's raw sequences.
+    """
+
+    def __init__(self, buffer, offset, length):
+        self.buffer = buffer
+        self.offset = offset
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            start, stop, step = item.indices(self.length)
+            return self.buffer[self.offset + start:self.offset + stop:step].decode('ascii')
+        if item < 0:
+            item += self.length
+        if not 0 <= item < self.length:
+            raise IndexError(f'Position {item} is outside of the contig')
+        return chr(self.buffer[self.offset + item])
+
+
+class PackedGenome:
+    """
+    Genome stored as the upper-cased sequences of all the contigs one after the other in a single file, with an index
+    of where each contig starts. The bases are not bit-packed: the file holds one ASCII byte per base, "packed" only
+    means that the line breaks and headers of the fasta are removed. The file is memory-mapped read-only so that all
+    the processes using the same assembly share the pages loaded by the operating system instead of each keeping its
+    own copy.
+    """
+
+    def __init__(self, store_dir):
+        with open(os.path.join(store_dir, index_file_name)) as open_file:
+            self.index = json.load(open_file)
+        with open(os.path.join(store_dir, sequence_file_name), 'rb') as open_file:
+            self.buffer = mmap.mmap(open_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __contains__(self, contig):
+        return contig in self.index
+
+    def __getitem__(self, contig):
+        offset, length = self.index[contig]
+        return PackedContig(self.buffer, offset, length)
+
+    def close(self):
+        self.buffer.close()
+
+    @staticmethod
+    def build(fasta_path, store_dir):
+        """
+        Create the packed store of the fasta file in store_dir. The store is written to a temporary directory first so
+        that an interrupted build never leaves a partial store behind.
+        """
+        tmp_dir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(store_dir)))
+        try:
+            index = {}
+            offset = 0
+            contig = None
+            with open(fasta_path) as fasta, open(os.path.join(tmp_dir, sequence_file_name), 'wb') as sequences:
+                for line in fasta:
+                    if line.startswith('>'):
+                        if contig:
+                            index[contig] = [index[contig], offset - index[contig]]
+                        contig = line[1:].split()[0]
+                        index[contig] = offset
+                    else:
+                        sequence = line.strip().upper().encode('ascii')
+                        sequences.write(sequence)
+                        offset += len(sequence)
+                if contig:
+                    index[contig] = [index[contig], offset - index[contig]]
+            with open(os.path.join(tmp_dir, index_file_name), 'w') as open_file:
+                json.dump(index, open_file)
+            os.rename(tmp_dir, store_dir)
+        except BaseException:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            raise
+        logger.info(f'Packed {len(index)} contigs from {fasta_path} into {store_dir}')
+
+    @staticmethod
+    def get_store_dir(fasta_path):
+        return fasta_path + '.packed'
+
+    @classmethod
+    def build_if_missing(cls, fasta_path):
+        """
+        Build the packed store next to the fasta file unless it already exists. Only one process should call this for a
+        given assembly, before the processes reading the genome are started.
+        """
+        store_dir = cls.get_store_dir(fasta_path)
+        if not os.path.isdir(store_dir):
+            cls.build(fasta_path, store_dir)
+
+    @classmethod
+    def from_fasta(cls, fasta_path):
+        store_dir = cls.get_store_dir(fasta_path)
+        if not os.path.isdir(store_dir):
+            raise ValueError(f'No packed genome found for {fasta_path}: it needs to be built with build_if_missing')
+        return cls(store_dir)
@@ -1,18 +1,24 @@
 import os
-import ast
 import glob
 from argparse import ArgumentParser
-from collections import defaultdict
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
 from itertools import zip_longest
+from multiprocessing import Pool
 
 from ebi_eva_common_pyutils.config_utils import get_mongo_uri_for_eva_profile
 from ebi_eva_common_pyutils.logger import logging_config
-import datetime
 
 from pyfaidx import Fasta
 from pymongo import MongoClient, WriteConcern, ReadPreference
+from pymongo.errors import BulkWriteError
 from pymongo.read_concern import ReadConcern
 
+from tasks.eva_2950.diagnostic_log_parser import parse_diagnostic_log, iter_raw_split_candidates, \
+    parse_raw_split_candidate, get_assemblies
+from tasks.eva_2950.packed_genome import PackedGenome
+from tasks.eva_2950.sve_shelf import SubmittedVariantShelf
+
 logger = logging_config.get_logger(__name__)
 logging_config.add_stdout_handler()
 
@@ -152,56 +158,39 @@ def add_contex_base(fa, chrom, pos, ref, alt):
     return pos, ref, alt
 
 
-def ast_parse_with_datetime(astr):
-    """
-    Parse a string representing a python data structure into a python data structure
-    Based on https://stackoverflow.com/questions/4235606/way-to-use-ast-literal-eval-to-convert-string-into-a-datetime
-    """
-    try:
-        tree = ast.parse(astr)
-    except SyntaxError:
-        raise ValueError(astr)
-    for node in ast.walk(tree):
-        if isinstance(node, (ast.Module, ast.Expr, ast.Dict, ast.Str, ast.List, ast.Constant,
-                            ast.Attribute, ast.Num, ast.Name, ast.Load, ast.Tuple)):
-            continue
-        if isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute) and node.func.attr == 'datetime':
-            continue
-        raise ValueError(astr)
-    return eval(astr)
-
-
 def parse_eva2850_diagnostic_log(log_file):
-    rsid = None
-    with open(log_file) as open_file:
-        for line in open_file:
-            line = line.strip()
-            if rsid:
-                # We are parsing the line just after finding the RS id
-                list_of_ssids = ast_parse_with_datetime(line.strip()[11:])
-                yield rsid, list_of_ssids
-                rsid = None
-            if 'Not all original SS has same info' in line:
-                sp_line = line.split()
-                rsid = int(sp_line[4].strip(','))
-
-        if rsid:
-            list_of_ssids = ast_parse_with_datetime(line.strip()[11:])
-            yield rsid, list_of_ssids
+    return parse_diagnostic_log(log_file)
 
 
 genome_cache = {}
 
 
-def get_genome_object(ref_genome_directory, genome_accession):
-    if genome_accession not in genome_cache:
-        path_to_search = os.path.join(ref_genome_directory, '*', genome_accession, genome_accession + '.fa')
-        genome_paths = glob.glob(path_to_search)
-        if len(genome_paths) == 0:
-            raise ValueError(f'Cannot locate genome for {genome_accession} in {ref_genome_directory}')
-        genome_path = genome_paths[0]
-        genome_cache[genome_accession] = Fasta(genome_path, as_raw=True, read_ahead=40000)
-    return genome_cache[genome_accession]
+def get_genome_path(ref_genome_directory, genome_accession):
+    path_to_search = os.path.join(ref_genome_directory, '*', genome_accession, genome_accession + '.fa')
+    genome_paths = glob.glob(path_to_search)
+    if len(genome_paths) == 0:
+        raise ValueError(f'Cannot locate genome for {genome_accession} in {ref_genome_directory}')
+    return genome_paths[0]
+
+
+def get_genome_object(ref_genome_directory, genome_accession, packed=False):
+    """
+    Return the genome of the assembly either as a pyfaidx Fasta or, when packed is set, as a memory-mapped PackedGenome
+    that must have been built beforehand with build_packed_genomes.
+    """
+    if (genome_accession, packed) not in genome_cache:
+        genome_path = get_genome_path(ref_genome_directory, genome_accession)
+        if packed:
+            genome_cache[(genome_accession, packed)] = PackedGenome.from_fasta(genome_path)
+        else:
+            genome_cache[(genome_accession, packed)] = Fasta(genome_path, as_raw=True, read_ahead=40000)
+    return genome_cache[(genome_accession, packed)]
+
+
+def build_packed_genomes(log_file, ref_genome_directory):
+    """Build the packed genome of every assembly in the log that does not have one yet."""
+    for genome_accession in sorted(get_assemblies(log_file)):
+        PackedGenome.build_if_missing(get_genome_path(ref_genome_directory, genome_accession))
 
 
 def variant_type(ref, alt):
@@ -219,30 +208,60 @@ def grouper(iterable, n, fillvalue=None):
     return zip_longest(fillvalue=fillvalue, *args)
 
 
-def shelve_submitted_variant_entities(mongo_handle, submitted_variant_ids, input_collection='dbsnpSubmittedVariantEntity'):
+def _shelve_batch(mongo_handle, batch_sve_ids, input_collection, output_collection):
+    query_filter = {'_id': {'$in': batch_sve_ids}}
+    documents = [d for d in mongo_handle["eva_accession_sharded"][input_collection].
+                 with_options(read_concern=ReadConcern("majority"), read_preference=ReadPreference.PRIMARY).
+                 find(query_filter)]
+    if documents:
+        try:
+            mongo_handle["eva_accession_sharded"][output_collection].\
+                with_options(write_concern=WriteConcern("majority")).\
+                insert_many(documents, ordered=False)
+        except BulkWriteError as e:
+            # Documents shelved by a previous interrupted run are already in the output collection
+            if any(error['code'] != 11000 for error in e.details['writeErrors']):
+                raise
+    return documents
+
+
+def shelve_submitted_variant_entities(mongo_handle, submitted_variant_ids, input_collection='dbsnpSubmittedVariantEntity',
+                                      shelf=None, num_workers=4):
     output_collection = 'eva2950_' + input_collection
     batch_size = 1000
     missing_ids = set()
+    if shelf:
+        already_shelved_ids = shelf.shelved_ids()
+        logger.info(f'{len(already_shelved_ids & set(submitted_variant_ids))} variants were shelved in a previous run')
+        submitted_variant_ids = set(submitted_variant_ids) - already_shelved_ids
     logger.info(f'Will Shelve {len(submitted_variant_ids)}')
-    for batch_sve_ids in grouper(submitted_variant_ids, batch_size):
-        # remove None
-        batch_sve_ids = [sve for sve in batch_sve_ids if sve]
-
-        query_filter = {'_id': {'$in': batch_sve_ids}}
-        documents = [d for d in mongo_handle["eva_accession_sharded"][input_collection].
-                     with_options(read_concern=ReadConcern("majority"), read_preference=ReadPreference.PRIMARY).
-                     find(query_filter)]
-        insert_results = mongo_handle["eva_accession_sharded"][output_collection].\
-            with_options(write_concern=WriteConcern("majority")).\
-            insert_many(documents)
-        if len(insert_results.inserted_ids) != len(batch_sve_ids):
-            logger.error(f'Only {len(insert_results.inserted_ids)} variants out of {len(batch_sve_ids)} were transfer '
+
+    def write_batch(batch_sve_ids, future):
+        documents = future.result()
+        if shelf:
+            shelf.add_documents(documents, input_collection)
+        if len(documents) != len(batch_sve_ids):
+            logger.error(f'Only {len(documents)} variants out of {len(batch_sve_ids)} were transfer '
                          f'to the output collection {output_collection}')
-            missing_ids.update(set(batch_sve_ids) - set(insert_results.inserted_ids))
+            missing_ids.update(set(batch_sve_ids) - set(document['_id'] for document in documents))
+
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        pending_batches = deque()
+        for batch_sve_ids in grouper(submitted_variant_ids, batch_size):
+            # remove None
+            batch_sve_ids = [sve for sve in batch_sve_ids if sve]
+            pending_batches.append((batch_sve_ids, executor.submit(_shelve_batch, mongo_handle, batch_sve_ids,
+                                                                   input_collection, output_collection)))
+            # Bound the number of batches in flight so that only their documents are held in memory
+            if len(pending_batches) >= 2 * num_workers:
+                write_batch(*pending_batches.popleft())
+        while pending_batches:
+            write_batch(*pending_batches.popleft())
     if missing_ids and input_collection == 'dbsnpSubmittedVariantEntity':
         logger.warning(f'{len(missing_ids)} variants were not transfer to the output collection {output_collection}')
         logger.warning('Attempting to shelve from EVA variant')
-        shelve_submitted_variant_entities(mongo_handle, missing_ids, input_collection='submittedVariantEntity')
+        shelve_submitted_variant_entities(mongo_handle, missing_ids, input_collection='submittedVariantEntity',
+                                          shelf=shelf, num_workers=num_workers)
     elif missing_ids:
         logger.error(f'{len(missing_ids)} variants were not transfer to the output collection {output_collection}')
         logger.error(str(missing_ids))
@@ -250,36 +269,78 @@ def shelve_submitted_variant_entities(mongo_handle, submitted_variant_ids, input
         # assert response.deleted_count == len(batch_sve_ids), 'Not all variants were deleted from dbsnpSubmittedVariantEntity'
 
 
-def process_diagnostic_log(log_file, ref_genome_directory, mongo_handle=None):
+def normalise_ss_entities(list_of_ss_entities, ref_genome_directory, packed=False):
+    variant_to_entities = defaultdict(list)
+    for ss_entity in list_of_ss_entities:
+        genome_object = get_genome_object(ref_genome_directory, ss_entity['seq'], packed)
+        context_pos, context_ref, context_alt = add_contex_base(
+            genome_object, ss_entity['contig'], ss_entity['start'], ss_entity['ref'], ss_entity['alt']
+        )
+        normalised_pos, normalised_ref, normalised_alt = leftnorm(
+            ss_entity['contig'], context_pos, context_ref, context_alt, fa=genome_object
+        )
+        context_entity = {'start': context_pos, 'ref': context_ref, 'alt': context_alt}
+        normalised_clustered_variant_definition = (normalised_pos, variant_type(normalised_ref, normalised_alt))
+        normalised_entity = {'start': normalised_pos, 'ref': normalised_ref, 'alt': normalised_alt}
+        variant_to_entities[normalised_clustered_variant_definition].append((ss_entity, context_entity, normalised_entity))
+    return variant_to_entities
+
+
+_worker_ref_genome_directory = None
+_worker_packed = False
+
+
+def _init_normalisation_worker(ref_genome_directory, packed):
+    global _worker_ref_genome_directory, _worker_packed
+    _worker_ref_genome_directory = ref_genome_directory
+    _worker_packed = packed
+
+
+def _normalise_rs_in_worker(raw_split_candidate):
+    rsid, list_of_ss_entities = parse_raw_split_candidate(raw_split_candidate)
+    try:
+        return rsid, list_of_ss_entities, normalise_ss_entities(list_of_ss_entities, _worker_ref_genome_directory,
+                                                                _worker_packed), None
+    except ReferenceError as e:
+        return rsid, list_of_ss_entities, None, str(e)
+
+
+def normalise_all_rs(log_file, ref_genome_directory, num_processes=1, packed=False):
+    """
+    Normalise the submitted variants of each RS found in the diagnostic log, in a pool of processes if requested.
+    The log is only split into records in the main process, parsing them is done by the workers as well.
+    Results are returned in the order of the log. Packed genomes are built here before any worker starts so that the
+    workers only open them.
+    """
+    if packed:
+        build_packed_genomes(log_file, ref_genome_directory)
+    if num_processes > 1:
+        with Pool(num_processes, initializer=_init_normalisation_worker,
+                  initargs=(ref_genome_directory, packed)) as pool:
+            yield from pool.imap(_normalise_rs_in_worker, iter_raw_split_candidates(log_file), chunksize=100)
+    else:
+        _init_normalisation_worker(ref_genome_directory, packed)
+        yield from map(_normalise_rs_in_worker, iter_raw_split_candidates(log_file))
+
+
+def process_diagnostic_log(log_file, ref_genome_directory, mongo_handle=None, num_processes=1, packed=False,
+                           shelf=None):
     count_normalisation = count_splits = 0
     all_submitted_variant_ids = set()
-    for rsid, list_of_ss_entities in parse_eva2850_diagnostic_log(log_file):
-        try:
-            variant_to_entities = defaultdict(list)
-            for ss_entity in list_of_ss_entities:
-                all_submitted_variant_ids.add(ss_entity['_id'])
-                genome_object = get_genome_object(ref_genome_directory, ss_entity['seq'])
-                context_pos, context_ref, context_alt = add_contex_base(
-                    genome_object, ss_entity['contig'], ss_entity['start'], ss_entity['ref'], ss_entity['alt']
-                )
-                normalised_pos, normalised_ref, normalised_alt = leftnorm(
-                    ss_entity['contig'], context_pos, context_ref, context_alt, fa=genome_object
-                )
-                context_entity = {'start': context_pos, 'ref': context_ref, 'alt': context_alt}
-                normalised_clustered_variant_definition = (normalised_pos, variant_type(normalised_ref, normalised_alt))
-                ss_entity['contig'] + str(ss_entity['start']) + ss_entity['ref'] + ss_entity['alt']
-                normalised_entity = {'start': normalised_pos, 'ref': normalised_ref, 'alt': normalised_alt}
-                variant_to_entities[normalised_clustered_variant_definition].append((ss_entity, context_entity, normalised_entity))
-            count_normalisation += process_renormalisation(variant_to_entities)
-            count_splits += process_split(rsid, variant_to_entities)
-        except ReferenceError as e:
+    for rsid, list_of_ss_entities, variant_to_entities, error in normalise_all_rs(log_file, ref_genome_directory,
+                                                                                  num_processes, packed):
+        all_submitted_variant_ids.update(ss_entity['_id'] for ss_entity in list_of_ss_entities)
+        if error:
             logger.error(f'Cannot Process rs{rsid} because one of the ssid cannot be normalised')
-            logger.error(str(e))
+            logger.error(error)
+            continue
+        count_normalisation += process_renormalisation(variant_to_entities)
+        count_splits += process_split(rsid, variant_to_entities)
     logger.info(f'{count_normalisation} submitted variants need to be renormalised')
     logger.info(f'{count_splits} clustered variants need to be created')
 
     if mongo_handle:
-        shelve_submitted_variant_entities(mongo_handle, all_submitted_variant_ids)
+        shelve_submitted_variant_entities(mongo_handle, all_submitted_variant_ids, shelf=shelf)
     logger.info(f'{len(all_submitted_variant_ids)} submitted variant have been shelved to a separate collection')
 
 
@@ -322,17 +383,31 @@ def process_renormalisation(variant_to_entities):
 
 def main():
     parser = ArgumentParser()
-    parser.add_argument('--diagnostic_file')
+    parser.add_argument('--diagnostic_file',
+                        help='Log of eva_2850 fix_discordant_variants.py or the split candidates JSON Lines file')
     parser.add_argument('--ref_genome_directory')
     parser.add_argument('--settings_xml_file')
     parser.add_argument('--profile', default='development')
+    parser.add_argument('--num_processes', type=int, default=1,
+                        help='Number of processes used to normalise the submitted variants')
+    parser.add_argument('--packed_genome', action='store_true', default=False,
+                        help='Read the reference from a memory-mapped packed copy of the genome built on first use '
+                             'instead of pyfaidx')
+    parser.add_argument('--shelve_db',
+                        help='SQLite file keeping a local copy of the shelved variants indexed by RS. It is also used '
+                             'to only fetch the variants not shelved yet when rerunning')
     args = parser.parse_args()
     if args.settings_xml_file:
         mongo_uri = get_mongo_uri_for_eva_profile(args.profile, args.settings_xml_file)
+        shelf = SubmittedVariantShelf(args.shelve_db) if args.shelve_db else None
         with MongoClient(mongo_uri) as mongo_handle:
-            process_diagnostic_log(args.diagnostic_file, args.ref_genome_directory, mongo_handle)
+            process_diagnostic_log(args.diagnostic_file, args.ref_genome_directory, mongo_handle,
+                                   num_processes=args.num_processes, packed=args.packed_genome, shelf=shelf)
+        if shelf:
+            shelf.close()
     else:
-        process_diagnostic_log(args.diagnostic_file, args.ref_genome_directory)
+        process_diagnostic_log(args.diagnostic_file, args.ref_genome_directory, num_processes=args.num_processes,
+                               packed=args.packed_genome)
 
 
 if __name__ == '__main__':
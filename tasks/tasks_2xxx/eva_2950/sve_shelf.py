@@ -0,0 +1,46 @@
+import sqlite3
+
+from bson import json_util
+
+from tasks.eva_2950.diagnostic_log_parser import json_options
+
+
+class SubmittedVariantShelf:
+    """
+    Local copy of the shelved submitted variant entities in an SQLite file in WAL mode.
+    Documents are inserted one batch per transaction and indexed by RS so that the entities of an RS can be retrieved
+    without scanning the store. The ids already shelved are used to resume an interrupted run.
+    """
+
+    def __init__(self, sqlite_file):
+        self.connection = sqlite3.connect(sqlite_file)
+        self.connection.execute('pragma journal_mode=wal')
+        self.connection.execute('pragma synchronous=normal')
+        self.connection.execute(
+            'create table if not exists submitted_variant_entity ('
+            'id text primary key, rs integer, accession integer, source_collection text, document text)'
+        )
+        self.connection.execute('create index if not exists submitted_variant_entity_rs on submitted_variant_entity (rs)')
+        self.connection.commit()
+
+    def add_documents(self, documents, source_collection):
+        with self.connection:
+            self.connection.executemany(
+                'insert or replace into submitted_variant_entity values (?, ?, ?, ?, ?)',
+                [(document['_id'], document.get('rs'), document.get('accession'), source_collection,
+                  json_util.dumps(document)) for document in documents]
+            )
+
+    def shelved_ids(self):
+        return set(row[0] for row in self.connection.execute('select id from submitted_variant_entity'))
+
+    def get_by_rs(self, rs):
+        return [json_util.loads(row[0], json_options=json_options) for row in self.connection.execute(
+            'select document from submitted_variant_entity where rs = ? order by accession', (rs,)
+        )]
+
+    def __len__(self):
+        return self.connection.execute('select count(*) from submitted_variant_entity').fetchone()[0]
+
+    def close(self):
+        self.connection.close()
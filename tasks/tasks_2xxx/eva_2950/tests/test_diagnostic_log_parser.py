@@ -0,0 +1,38 @@
+import datetime
+import os.path
+import tempfile
+from unittest import TestCase
+
+from bson import json_util
+
+from tasks.eva_2950.diagnostic_log_parser import parse_python_literal, parse_diagnostic_log, SplitCandidate
+
+
+class TestDiagnosticLogParser(TestCase):
+
+    test_dir = os.path.dirname(__file__)
+
+    def test_parse_python_literal(self):
+        assert parse_python_literal(
+            "{'_id': 'A64C5F', 'tax': 9615, 'start': 20647, 'ref': '', 'evidence': False, 'remappedFrom': None, "
+            "'createdDate': datetime.datetime(2003, 10, 27, 15, 57), 'study': \"it's\", 'alleles': ('A', 'T')}"
+        ) == {'_id': 'A64C5F', 'tax': 9615, 'start': 20647, 'ref': '', 'evidence': False, 'remappedFrom': None,
+              'createdDate': datetime.datetime(2003, 10, 27, 15, 57), 'study': "it's", 'alleles': ('A', 'T')}
+
+    def test_parse_python_literal_refuses_code(self):
+        with self.assertRaises(ValueError):
+            parse_python_literal("[__import__('os').system('ls')]")
+
+    def test_parse_diagnostic_log_in_both_formats(self):
+        diagnostic_file = os.path.join(self.test_dir, 'diagnostic_output_log.out')
+        split_candidates = list(parse_diagnostic_log(diagnostic_file))
+        assert [split_candidate.rsid for split_candidate in split_candidates] == [54131737, 53378121, 54319631]
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            json_lines_file = os.path.join(tmp_dir, 'split_candidates.jsonl')
+            with open(json_lines_file, 'w') as open_file:
+                for split_candidate in split_candidates:
+                    open_file.write(json_util.dumps({'rs': split_candidate.rsid,
+                                                     'ss_records': split_candidate.ss_entities}) + '\n')
+            assert list(parse_diagnostic_log(json_lines_file)) == split_candidates
+        assert isinstance(split_candidates[0], SplitCandidate)
@@ -1,10 +1,13 @@
 import os.path
+import tempfile
 from pprint import pprint
 from unittest import TestCase
 
 from pyfaidx import Fasta
 
-from tasks.eva_2950.split_rs_with_inconsistent_ss import leftnorm, parse_eva2850_diagnositc_log, process_diagnostic_log
+from tasks.eva_2950.diagnostic_log_parser import get_assemblies
+from tasks.eva_2950.packed_genome import PackedGenome
+from tasks.eva_2950.split_rs_with_inconsistent_ss import leftnorm, parse_eva2850_diagnostic_log, process_diagnostic_log
 
 
 class TestNormalisation(TestCase):
@@ -33,6 +36,33 @@ class TestNormalisation(TestCase):
         alt = 'T'
         assert (leftnorm(chrom, pos, ref, alt, fa=fa)) == (80, 'C', 'CT')
 
+    def test_leftnorm_with_packed_genome(self):
+        fasta_file = os.path.join(self.test_dir, 'fasta_file.fa')
+        fa = Fasta(fasta_file, as_raw=True, read_ahead=40000)
+        chrom = 'AP014957.1'
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            PackedGenome.build(fasta_file, os.path.join(tmp_dir, 'fasta_file.fa.packed'))
+            packed_genome = PackedGenome(os.path.join(tmp_dir, 'fasta_file.fa.packed'))
+            assert len(packed_genome[chrom]) == len(fa[chrom])
+            assert packed_genome[chrom][75:95] == fa[chrom][75:95].upper()
+            assert packed_genome[chrom][79] == fa[chrom][79].upper()
+            assert (leftnorm(chrom, 91, '', 'TTTTT', fa=packed_genome)) == (80, 'C', 'CTTTTT')
+            assert (leftnorm(chrom, 81, '', 'T', fa=packed_genome)) == (80, 'C', 'CT')
+            packed_genome.close()
+
+    def test_packed_genome_is_only_opened_once_built(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            fasta_file = os.path.join(tmp_dir, 'fasta_file.fa')
+            with open(os.path.join(self.test_dir, 'fasta_file.fa')) as source, open(fasta_file, 'w') as copy:
+                copy.write(source.read())
+            with self.assertRaises(ValueError):
+                PackedGenome.from_fasta(fasta_file)
+            PackedGenome.build_if_missing(fasta_file)
+            packed_genome = PackedGenome.from_fasta(fasta_file)
+            assert 'AP014957.1' in packed_genome
+            packed_genome.close()
+            assert sorted(os.listdir(tmp_dir)) == ['fasta_file.fa', 'fasta_file.fa.packed']
+
 
 class TestSplitRS(TestCase):
 
@@ -42,7 +72,7 @@ class TestSplitRS(TestCase):
         diagnostic_file = os.path.join(self.test_dir, 'diagnostic_output_log.out')
         rsids = []
         lists_of_ssids = []
-        for rsid, list_of_ssids in parse_eva2850_diagnositc_log(diagnostic_file):
+        for rsid, list_of_ssids in parse_eva2850_diagnostic_log(diagnostic_file):
             rsids.append(rsid)
             lists_of_ssids.append(list_of_ssids)
 
@@ -52,6 +82,10 @@ class TestSplitRS(TestCase):
         ]
         assert rsids == [54131737, 53378121, 54319631]
 
+    def test_get_assemblies(self):
+        diagnostic_file = os.path.join(self.test_dir, 'diagnostic_output_log.out')
+        assert get_assemblies(diagnostic_file) == {'GCA_001433935.1'}
+
     def test_process_diagnostic_log(self):
         diagnostic_file = os.path.join(self.test_dir, 'diagnostic_output_log.out')
         ref_genome_dir = os.path.join(self.test_dir, 'references')
@@ -0,0 +1,32 @@
+import datetime
+import os.path
+import tempfile
+from unittest import TestCase
+
+from tasks.eva_2950.sve_shelf import SubmittedVariantShelf
+
+
+class TestSubmittedVariantShelf(TestCase):
+
+    def test_add_and_get_by_rs(self):
+        documents = [
+            {'_id': 'A64C5F', 'rs': 54131737, 'accession': 1961656906, 'start': 38342081,
+             'createdDate': datetime.datetime(2007, 5, 23, 17, 0)},
+            {'_id': '7CD32F', 'rs': 54131737, 'accession': 71656146, 'start': 38342091,
+             'createdDate': datetime.datetime(2015, 12, 21, 19, 46)},
+            {'_id': '61BB4D', 'rs': 54319631, 'accession': 1964358410, 'start': 14729472,
+             'createdDate': datetime.datetime(2015, 12, 21, 19, 46)}
+        ]
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            shelf = SubmittedVariantShelf(os.path.join(tmp_dir, 'shelf.sqlite'))
+            shelf.add_documents(documents[:2], 'dbsnpSubmittedVariantEntity')
+            shelf.add_documents(documents[1:], 'submittedVariantEntity')
+            shelf.close()
+
+            # Reopen the store as a rerun would
+            shelf = SubmittedVariantShelf(os.path.join(tmp_dir, 'shelf.sqlite'))
+            assert len(shelf) == 3
+            assert shelf.shelved_ids() == {'A64C5F', '7CD32F', '61BB4D'}
+            assert shelf.get_by_rs(54131737) == [documents[1], documents[0]]
+            assert shelf.get_by_rs(1) == []
+            shelf.close()